@@ -1,6 +1,12 @@
+import os
+import sys
 import numpy as np
 import xarray as xr
 
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '../../scripts'))
+from gridweights import GridWeights
+from xarray_funcs import area_mean
+
 paths = "/data2/imau/users/jasper/ihesp/rcp8.5/ens/mon/*.nc"
 print(f"Reading \n {paths}")
 ds = xr.open_mfdataset(paths)
@@ -8,6 +14,6 @@ print(ds)
 print(ds.TREFHT)
 print(ds.cosp_sza)
 sinLat = np.sin(np.deg2rad(ds.lat))
-gw = ds.area / ds.area.sum()
-T0 = ds.TREFHT.weighted(gw).mean(dim=['time','ncol']).compute()
+gw = GridWeights.from_dataset(ds).weights # normalised ne120 weights
+T0 = area_mean(ds.TREFHT, gw, dims=['time','ncol']).compute()
 print(f"Mean ensemble surface temperature: {T0.item():.3f}K")
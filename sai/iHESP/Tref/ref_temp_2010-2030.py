@@ -1,17 +1,22 @@
 import glob
+import os
+import sys
 import xarray as xr
 
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '../../scripts'))
+from load_SAIdata import open_mfdataset
+
 GPATH = '/nethome/6272487/sai-git/sai/prep/data/'
 DPATH1 = '/data2/imau/users/jasper/ihesp/hrmip/0.25deg/hist/tas/'
 DPATH2 = '/data2/imau/users/jasper/ihesp/hrmip/0.25deg/rcp8.5/tas/'
 
 fnameg = GPATH + 'ne120_t12.grid.nc'
-fname1 = glob.glob(DPATH1+'*.nc')
-fname2 = glob.glob(DPATH2+'*.nc')
+fname1 = sorted(glob.glob(DPATH1+'*.nc'))
+fname2 = sorted(glob.glob(DPATH2+'*.nc'))
 
 with xr.open_dataset(fnameg) as dsg:
-    with xr.open_mfdataset(fname1) as ds1:
-        with xr.open_mfdataset(fname2) as ds2:
+    with open_mfdataset(fname1, chunks={}) as ds1:
+        with open_mfdataset(fname2, chunks={}) as ds2:
             area = dsg.area
             tas1 = ds1.tas.where(ds1.time.dt.year >= 2010, drop=True)
             tas2 = ds2.tas.where(ds2.time.dt.year < 2030, drop=True)
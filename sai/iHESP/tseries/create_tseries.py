@@ -1,8 +1,11 @@
 #!/bin/usr/env python3
 
+import os
 import sys
 import time
-import xarray
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '../../scripts'))
+from load_SAIdata import open_mfdataset
 
 variable = 'TREFHT'
 newvariable = 'TREFHTGA' # global average
@@ -31,7 +34,7 @@ def main():
     files = argparse()
     outputfile = outfile(files)
     print(f'creating: {outputfile}')
-    with xarray.open_mfdataset(files, parallel=True) as ds:
+    with open_mfdataset(files, variables=[variable], chunks={}) as ds:
         gmean = ds[variable].weighted(ds.area).mean('ncol')
         gmean.to_netcdf(outputfile)
 
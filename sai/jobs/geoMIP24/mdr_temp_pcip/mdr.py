@@ -12,28 +12,26 @@ def main():
     parser = argparse.ArgumentParser(
         description='Calculate temperature gradients T0, T1 and T2 time series as in GLENS')
     parser.add_argument('infiles', nargs='+', help='input netCDF files')
-    parser.add_argument('outfile', help='output netCDF file')
+    parser.add_argument('outfile', help='output netCDF file or Zarr store')
+    add_output_arguments(parser)
     args = parser.parse_args()
-    if os.path.exists(args.outfile):
-        raise ValueError(f'output file {args.outfile} already exists.')
+    check_outfile(args)
     
-    # open dataset and set time to center of time_bnds
-    ds = xr.open_mfdataset(args.infiles, data_vars="minimal", coords="minimal", 
-    join="exact", compat="override", chunks=None)
+    # open dataset with time at center of time_bnds (cached by the loader)
+    ds = open_mfdataset(args.infiles, verbose=False, center_time=True, chunks={},
+                        variables=['OCNFRAC','TREFHT','PRECL','PRECC'])
     print(f"+{perf_counter()-t0:.1f} sec: opened dataset")
-    time = ('time', ds.time_bnds.mean('nbnd').data, ds.time.attrs)
-    ds = ds.assign_coords({'ctime':time}).swap_dims({'time':'ctime'})
-    ds = ds.drop_vars('time').rename({'ctime':'time'})
 
     # calculate MDR means and tropical mean
-    gmean = lambda da: da.weighted(ds.gw).mean(('lat','lon'), keep_attrs=True)
-    ds['TNA'] = gmean(ds.TREFHT.sel(regions['NA']))
-    ds['TWP'] = gmean(ds.TREFHT.sel(regions['WNP']))
-    ds['TTROP'] = gmean(ds.TREFHT.sel(regions['TROP']))
-    ds['PLNA'] = gmean(ds.PRECL.sel(regions['NA']))
-    ds['PCNA'] = gmean(ds.PRECC.sel(regions['NA']))
-    ds['PLWP'] = gmean(ds.PRECL.sel(regions['WNP']))
-    ds['PCWP'] = gmean(ds.PRECC.sel(regions['WNP']))
+    # (all regions and variables in one sparse matrix product per chunk)
+    rm = region_means(ds, regions, ['TREFHT','PRECL','PRECC'])
+    ds['TNA'] = rm.TREFHT.sel(region='NA', drop=True)
+    ds['TWP'] = rm.TREFHT.sel(region='WNP', drop=True)
+    ds['TTROP'] = rm.TREFHT.sel(region='TROP', drop=True)
+    ds['PLNA'] = rm.PRECL.sel(region='NA', drop=True)
+    ds['PCNA'] = rm.PRECC.sel(region='NA', drop=True)
+    ds['PLWP'] = rm.PRECL.sel(region='WNP', drop=True)
+    ds['PCWP'] = rm.PRECC.sel(region='WNP', drop=True)
     ds.TNA.attrs.update({'long_name':f'North Atlantic surface temperature {reglabels["NA"]}'})
     ds.TWP.attrs.update({'long_name':f'Western North Pacific surface temperature {reglabels["WNP"]}'})
     ds.TTROP.attrs.update({'long_name':f'Tropical surface temperature {reglabels["TROP"]}'})
@@ -50,7 +48,7 @@ def main():
         'description':'Surface temperatures in different main development regions and the tropics',
         'history':f'python MDR_relative_temp_pcip.py [{args.infiles[0]} - {args.infiles[-1]}] {args.outfile}'
     })
-    ds.to_netcdf(args.outfile)
+    write_output(ds, args.outfile, args.output_format, args.append)
     print(f"+{perf_counter()-t0:.1f} sec: created {args.outfile}")
     
 
@@ -63,6 +61,10 @@ if __name__ == '__main__':
     import xarray as xr
     import dask
     from dask.distributed import Client
+    sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '../../../scripts'))
+    from regions import region_means
+    from load_SAIdata import open_mfdataset
+    from output import add_output_arguments, check_outfile, write_output
     t0 = perf_counter()
     client = Client() # for parallel opening
     print(f"+{perf_counter()-t0:.1f} sec: {client}")
@@ -1,6 +1,16 @@
 #!/usr/bin/env python3
 # *_* coding: utf-8 *_*
 
+import os
+import sys
+import argparse
+from time import perf_counter
+t0 = perf_counter()
+import numpy as np
+import xarray as xr
+import dask
+from dask.distributed import Client
+
 
 def main():
     # read script arguments 
@@ -52,15 +62,6 @@ def main():
     
 
 if __name__ == '__main__':
-    import os
-    import sys
-    import argparse
-    from time import perf_counter
-    import numpy as np
-    import xarray as xr
-    import dask
-    from dask.distributed import Client
-    t0 = perf_counter()
     client = Client() # for parallel opening
     print(f"+{perf_counter()-t0:.1f} sec: {client}")
     main()
@@ -6,23 +6,29 @@ import logging
 #print(f'Python version: {sys.version}')
 #print(f'Path: {sys.path}')
 
-from numba import guvectorize
 import numpy as np
 from dask.distributed import Client
 import xarray as xr
 xr.set_options(keep_attrs=True)
 #xr.show_versions()
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '../../../../scripts'))
+from vertinterp import interpolate
+from chunkplan import plan_chunks
+from load_SAIdata import open_mfdataset
+from output import add_output_arguments, check_outfile, write_output
 
 PLEVS = (250, 850)  # pressure levels (hPa) for shear calculation
 
-# variable names (change values if needed)
-# VARS = {'U':'U','V':'V','P':'P','gw':'gw', 'time_bnds':'time_bnds','lsm':'lsm'} # pressure levels
+# variable names (change values if needed), the cheapest source of U and V
+# is selected per run: single level fields U850 (CAM h1/h2), U on pressure
+# levels (e.g. vertinterp.py output) or U on model levels (interpolated)
+# VARS = {'U':'U','V':'V','P':'P','gw':'gw', 'time_bnds':'time_bnds','lsm':'lsm'} # pressure on model levels
 VARS = {'U':'U','V':'V','hyam':'hyam', 'hybm':'hybm','P0':'P0','PS':'PS',
         'gw':'gw', 'time_bnds':'time_bnds','lsm':'LANDFRAC'} # hybrid model levels
 
 LABEL = 'upper' # ['upper','lower'], level where VSHEAR is defined
 VDIM = 'lev'  # vertical dimension (e.g. 'lev','plev','z','hybrid')
-CHUNKS = {'time':1,'ncol':'auto', VDIM:-1} # array chunk size for parallel computation
+PRESSURE_UNITS = {'Pa':0.01, 'pa':0.01, 'hPa':1, 'hpa':1, 'mb':1, 'mbar':1, 'millibars':1} # to hPa
 NEWPRES = xr.DataArray(
     data=100*np.array(sorted(PLEVS), dtype='float64'),
     dims='plev',
@@ -33,67 +39,93 @@ NEWPRES = xr.DataArray(
 )
 
 
-@guvectorize([
-    "(float64[:], float64[:], float64[:], float64[:])",
-    "(float32[:], float32[:], float64[:], float32[:])"
-], " (n), (n), (m) -> (m)", nopython=True, cache=True)
-def logpressure_interp1d_gu(f, p, pi, out):
-    """interpolate field f(p) to pi in ln(p) coordinates"""
-    i, imax, p0, f0 = 0, len(pi), p[0], f[0]
-    while pi[i]<p0 and i < imax:
-        out[i] = np.nan      
-        i = i + 1 
-    for p1,f1 in zip(p[1:], f[1:]):
-        while pi[i] <= p1 and i < imax:
-            out[i] = (f1-f0)/np.log(p1/p0)*np.log(pi[i]/p0)+f0
-            i = i + 1
-        p0, f0 = p1, f1
-    while i < imax:
-        out[i] = np.nan
-        i = i + 1
+def select_source(ds):
+    """Return the cheapest source of U and V on PLEVS in ds
+    
+    In order of preference:
+    'single': single level fields, e.g. U850 and V850 (CAM h1/h2 streams)
+    'plev': U and V on a pressure dimension that contains all PLEVS
+    'model': U and V on VDIM, interpolated to PLEVS
+    Returns (source, dimension of the levels, variables to read)
+    """
+    single = [f"{VARS[w]}{p}" for p in sorted(PLEVS) for w in ['U','V']]
+    if all(v in ds for v in single):
+        return 'single', None, single
+    winds = [VARS['U'], VARS['V']]
+    if not all(v in ds for v in winds):
+        return 'model', VDIM, winds # reported by check_model_levels()
+    for dim in ds[VARS['U']].dims:
+        if _plev_index(ds, dim) is not None:
+            return 'plev', dim, winds
+    pvars = ['P'] if 'P' in VARS else ['PS','hyam','hybm','P0']
+    return 'model', VDIM, winds + [VARS[v] for v in pvars]
+
+
+def _plev_index(ds, dim):
+    """Return indices of PLEVS along pressure coordinate dim, None if absent"""
+    if (dim not in ds.coords) or (ds[dim].attrs.get('units') not in PRESSURE_UNITS):
+        return None
+    attrs = ds[dim].attrs
+    if ('formula_terms' in attrs) or ('hybrid' in attrs.get('standard_name','') + attrs.get('long_name','')) \
+            or (VARS['hyam'] in ds and dim in ds[VARS['hyam']].dims):
+        return None # hybrid model levels (CAM lev is in hPa)
+    plev = ds[dim].values * PRESSURE_UNITS[ds[dim].attrs['units']] # hPa
+    index = [int(np.argmin(abs(plev - p))) for p in sorted(PLEVS)]
+    if not np.allclose(plev[index], sorted(PLEVS)):
+        return None
+    return index
+
+
+def winds_on_pressure(ds, source, dim):
+    """Return U and V on NEWPRES from the source selected by select_source()"""
+    if source == 'single':
+        logging.info(f"using single level fields {VARS['U']}{{p}}, {VARS['V']}{{p}}")
+        dsp = xr.Dataset({VARS[w]: xr.concat([ds[f"{VARS[w]}{p}"] for p in sorted(PLEVS)],
+                                             NEWPRES.dims[0], coords='minimal', compat='override')
+                          for w in ['U','V']})
+        for w in ['U','V']: # level specific names
+            dsp[VARS[w]].attrs.pop('long_name', None)
+    elif source == 'plev':
+        logging.info(f"selecting {PLEVS} hPa along pressure dimension {dim}")
+        dsp = ds[[VARS['U'], VARS['V']]].isel({dim: _plev_index(ds, dim)})
+        dsp = dsp.drop_vars(dim).rename({dim: NEWPRES.dims[0]})
+    else:
+        return xr_interpolate_pressure(ds)
+    dsp = dsp.assign_coords({NEWPRES.name:NEWPRES}).transpose(*NEWPRES.dims,...)
+    return dsp
 
 
 def xr_interpolate_pressure(ds):
-    """wrapper for logpressure_interp1d_gu"""
-    # calculate pressure if needed and interpolate
+    """Interpolate variables with VDIM to NEWPRES (see vertinterp.interpolate)"""
+    # pressure is computed from PS within the kernel if needed
+    vdimvars = [v for v in ds.data_vars if VDIM in ds[v].dims and ds[v].dims[-1] != VDIM]
+    logging.info(f"new coordinate: {NEWPRES.dims[0]} {PLEVS} hPa")
+    logging.info(f"starting interpolation of {vdimvars}...")
     if 'P' not in VARS:
-        logging.info(f"calculating 'P' from hybrid parameters")
-        pres = ds[VARS['hyam']] * ds[VARS['P0']] + ds[VARS['hybm']] * ds[VARS['PS']]
+        logging.info(f"calculating 'P' from hybrid parameters on the fly")
+        dsp = interpolate(ds[vdimvars], sorted(PLEVS), ps=ds[VARS['PS']], hyam=ds[VARS['hyam']],
+                          hybm=ds[VARS['hybm']], p0=ds[VARS['P0']], vdim=VDIM)
     else:
-        pres = ds[VARS['P']]
-    ds = ds.assign_coords({NEWPRES.name:NEWPRES})
-    logging.info(f"new coordinate: {ds[NEWPRES.name].coords}")
-    logging.info("starting interpolation...")
-    vdimvars = [v for v in ds.data_vars if hasattr(ds[v], VDIM)]
-    if len(vdimvars) == 1:
-        vdimvars = vdimvars[0]
-    ds[vdimvars] = xr.apply_ufunc(
-        logpressure_interp1d_gu,  ds[vdimvars], pres, NEWPRES,
-        input_core_dims=[[VDIM], [VDIM], [*NEWPRES.dims]], 
-        output_core_dims=[[*NEWPRES.dims]], 
-        exclude_dims=set((VDIM,)),
-        dask="parallelized",
-        keep_attrs=True,
-    ).transpose(*NEWPRES.dims,...)
-    return ds
+        dsp = interpolate(ds[vdimvars], sorted(PLEVS), pres=ds[VARS['P']], vdim=VDIM)
+    dsp = dsp.assign_coords({NEWPRES.name:NEWPRES}).transpose(*NEWPRES.dims,...)
+    return dsp
     
 
-def check_globals(ds):
-    """Check global variables defined in this file
-    
-    When faulty, quits program with helpful error messages
+def check_model_levels(ds):
+    """Check variables needed for interpolation from model levels
+
+    Returns True if errors occurred
     """
     fatal = False
+    missing_winds = [VARS[w] for w in ['U','V'] if VARS[w] not in ds]
+    if any(missing_winds):
+        logging.error(f"{missing_winds} not in dataset")
+        fatal = True
     if VDIM not in ds:
         logging.error(f"vertical dimension {VDIM} not in dataset")
         fatal = True
     else:
         logging.info(f"vertical dimension: {VDIM}")
-    if any(p > 1100 for p in PLEVS):
-        logging.error(f"PLEVS {PLEVS} should be in hPa")
-        fatal = True
-    else:
-        logging.info(f"new pressure levels: {PLEVS} hPa")
     if ('P' not in VARS):
         missing_terms = [VARS[t] for t in ['hyam','hybm','P0','PS'] if VARS[t] not in ds]
         if any(missing_terms):
@@ -112,6 +144,22 @@ def check_globals(ds):
             logging.info(f"using {[VARS[v] for v in ['hyam','hybm','P0','PS']]} to calculate pressure")
     else:
         logging.info(f"using pressure '{VARS['P']}'")
+    return fatal
+
+
+def check_globals(ds, source='model'):
+    """Check global variables defined in this file
+    
+    When faulty, quits program with helpful error messages
+    """
+    fatal = False
+    if any(p > 1100 for p in PLEVS):
+        logging.error(f"PLEVS {PLEVS} should be in hPa")
+        fatal = True
+    else:
+        logging.info(f"new pressure levels: {PLEVS} hPa")
+    if source == 'model':
+        fatal = check_model_levels(ds) or fatal
     if fatal:
         logging.critical(f"fatal errors occurred for dataset:\n{ds}")
         logging.critical(f"resolve errors first, aborting...")
@@ -127,12 +175,12 @@ def main():
     parser = argparse.ArgumentParser()
     parser.add_argument('files', nargs='+', help='input file(s)')
     parser.add_argument('outfile', help='output file')
+    add_output_arguments(parser)
     parser.add_argument('-f', help='used by jupyter')
     parser.add_argument('-v', '--verbose', help='modify output verbosity', 
                         action='store_true')
     args = parser.parse_args()
-    if os.path.exists(args.outfile):
-        raise ValueError(f'file {args.outfile} already exists')
+    check_outfile(args)
 
     # set up logger 
     logging.basicConfig(
@@ -149,19 +197,25 @@ def main():
     # wind shear calculation
     time1 = perf_counter()  # start timer
     levstr = f'{max(PLEVS)}-{min(PLEVS)} hPa'
-    logging.info(f"opening [{args.files[0]} - {args.files[-1]}] with chunks {CHUNKS}")
-    with xr.open_mfdataset(args.files, data_vars="minimal", coords="minimal", 
-        join="exact", compat="override", chunks=CHUNKS) as ds:
+    with xr.open_dataset(args.files[0], decode_times=False) as ds0:
+        source, dim, variables = select_source(ds0)
+        ancillary = [VARS[v] for v in ['gw','time_bnds','lsm'] if VARS[v] in ds0]
+        whole_dims = [] if dim is None else [dim]
+        if (source == 'model') and (VARS['U'] in ds0) and (dim in ds0[VARS['U']].dims):
+            # interpolate() keeps the dimensions after VDIM whole (one block of columns)
+            udims = ds0[VARS['U']].dims
+            whole_dims += list(udims[udims.index(dim)+1:])
+    logging.info(f"source of winds: {source} ({variables})")
+    tvars = [v for v in variables + ancillary if v not in ('hyam','hybm','P0','gw','time_bnds')]
+    chunks = plan_chunks(args.files, tvars, whole_dims=whole_dims, per_file=False)
+    logging.info(f"opening [{args.files[0]} - {args.files[-1]}] with chunks {chunks}")
+    # time at center of time_bnds, cached next to the kerchunk references
+    with open_mfdataset(args.files, verbose=args.verbose, variables=tvars, 
+                        center_time=True, chunks=chunks) as ds:
         time2 = perf_counter()
         logging.info(f"...succes! opening took {time2-time1:.2f} seconds")
-        time = ('time', ds.time_bnds.mean('nbnd').data, ds.time.attrs)
-        ds = ds.assign_coords({'ctime':time}).swap_dims({'time':'ctime'})
-        ds = ds.drop_vars('time').rename({'ctime':'time'})
-        ds = ds[list(VARS.values())]
-        check_globals(ds)
-        hasplev = NEWPRES.dims[0] in ds.dims
-        if (not hasplev) or (hasplev and (not (ds[NEWPRES.dims[0]] == NEWPRES).all())):
-            ds = xr_interpolate_pressure(ds)
+        check_globals(ds, source)
+        ds = winds_on_pressure(ds[variables], source, dim).merge(ds[ancillary])
         USHEAR = ds[VARS['U']].diff(NEWPRES.dims[0], label=LABEL).squeeze()
         VSHEAR = ds[VARS['V']].diff(NEWPRES.dims[0], label=LABEL).squeeze()
         ds['VWS'] = np.sqrt(USHEAR**2 + VSHEAR**2)
@@ -174,7 +228,7 @@ def main():
             f'python windshear.py [{args.files[0]} - {args.files[-1]}] {args.outfile}'})
         ds.time.encoding['units'] = 'days since 0001-01-01'
         ds.VWS.encoding['dtype'] = 'float32'
-        ds[['VWS',VARS['gw'],VARS['time_bnds'],VARS['lsm']]].to_netcdf(args.outfile)
+        write_output(ds[['VWS'] + ancillary], args.outfile, args.output_format, args.append)
         time3 = perf_counter()
         logging.info(f"processed all data in {time3-time1:.2f} seconds")
     return
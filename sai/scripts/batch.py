@@ -0,0 +1,183 @@
+#!/usr/bin/env python3
+# *_* coding: utf-8 *_*
+
+"""Year-partitioned, restartable processing of a collection of files
+
+Long diagnostics (windshear, globalmean, temperature gradients) are run
+per partition of N years instead of for the whole archive at once. Each
+partition is written to its own file in <outfile>.parts/ and marked as
+done with a <partfile>.done marker, which lists the input files with
+their size and modification time. When a job is restarted (e.g. after
+hitting the SLURM wall clock) partitions with a marker for the same,
+unchanged input files are skipped. Partitions are processed
+concurrently in separate processes, after which the partition files are
+concatenated along time into outfile:
+
+    >> def process(files, outfile): # module level, writes outfile
+    >>     ...
+    >> run_partitions(files, outfile, process, years=10)
+
+The years of the files are taken from their CESM file names (see
+load_SAIdata._filename_date). The scripts add the options with
+add_arguments(parser) and call run_partitions(..., **batch_options(args)).
+"""
+
+import os
+import sys
+import json
+import logging
+from concurrent.futures import ProcessPoolExecutor
+
+import xarray as xr
+
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+from load_SAIdata import available_resources, _file_key, _filename_date
+from output import write_output
+
+THREADS_PER_PARTITION = 4 # dask threads per concurrently processed partition
+CONCAT_DIM = 'time' # dimension along which partitions are concatenated
+
+
+def file_year(fname):
+    """Return year of CESM file fname, e.g. 2050 for *.h0.2050-01.nc"""
+    date = _filename_date(fname)
+    if date is None:
+        raise ValueError(f'no date in file name {fname}')
+    return int(date[:4])
+
+
+def partition_files(files, years=1):
+    """Return {label: files} of consecutive periods of years
+
+    Labels are 'YYYY' (years=1) or 'YYYY-YYYY' (first and last year).
+    """
+    first = min(file_year(f) for f in files)
+    parts = {}
+    for f in sorted(files, key=file_year):
+        start = first + (file_year(f) - first) // years * years
+        label = f'{start:04d}' if years == 1 else f'{start:04d}-{start+years-1:04d}'
+        parts.setdefault(label, []).append(f)
+    return parts
+
+
+def part_path(outfile, label):
+    """Return path of partition label of outfile, in <outfile>.parts/"""
+    stem, ext = os.path.splitext(os.path.basename(outfile))
+    return os.path.join(f'{outfile}.parts', f'{stem}.{label}{ext}')
+
+
+def is_done(partfile, files):
+    """Return True if partfile was completed from the same, unchanged input files"""
+    try:
+        with open(f'{partfile}.done') as f:
+            return json.load(f) == _file_keys(files)
+    except (OSError, ValueError):
+        return False
+
+
+def _file_keys(files):
+    """Return [path, size, mtime] of files (see load_SAIdata._file_key)"""
+    return [_file_key(os.path.abspath(fname)) for fname in files]
+
+
+def run_partition(process, files, partfile, threads=None):
+    """Process files into partfile (via a temporary file) and mark it done"""
+    import dask
+    tmpfile = f'{partfile}.tmp'
+    keys = _file_keys(files) # state of the input before processing
+    if os.path.exists(tmpfile):
+        os.remove(tmpfile) # left behind by an interrupted job
+    with dask.config.set(scheduler='threads', num_workers=threads):
+        process(files, tmpfile)
+    os.replace(tmpfile, partfile)
+    with open(f'{partfile}.done', 'w') as f:
+        json.dump(keys, f)
+    return partfile
+
+
+def run_partitions(files, outfile, process, years=1, max_workers=None,
+                   threads=THREADS_PER_PARTITION, concat=True, output_format='netcdf',
+                   append=False):
+    """Process files per partition of years and concatenate the results
+
+    Input:
+    files : input files with CESM dates in their names
+    outfile : final output file, partitions are stored in <outfile>.parts/
+    process : function process(files, outfile) writing one partition,
+        must be defined at module level (it is run in other processes)
+    years : number of years per partition
+    max_workers : number of partitions processed at once (default:
+        available cores // threads)
+    threads : dask threads per partition
+    concat : concatenate the partitions into outfile when all are done
+    output_format, append : format of outfile and whether to append to
+        an existing Zarr store (see output.write_output), partitions are
+        always netCDF
+
+    Partitions completed before (same, unchanged input files) are not
+    processed again. Returns list of partition files.
+    """
+    parts = partition_files(files, years)
+    paths = {label: part_path(outfile, label) for label in parts}
+    todo = [label for label in parts if not is_done(paths[label], parts[label])]
+    logging.info(f"{len(parts)} partition(s) of {years} year(s), "
+                 f"{len(parts)-len(todo)} done before, {len(todo)} to do")
+    if todo:
+        os.makedirs(f'{outfile}.parts', exist_ok=True)
+        ncpus, _ = available_resources()
+        max_workers = max_workers or max(1, ncpus // threads)
+        max_workers = min(max_workers, len(todo))
+        if max_workers == 1:
+            for label in todo:
+                run_partition(process, parts[label], paths[label], threads)
+                logging.info(f"finished partition {label}")
+        else:
+            with ProcessPoolExecutor(max_workers) as pool:
+                futures = {label: pool.submit(run_partition, process, parts[label],
+                                              paths[label], threads) for label in todo}
+                failed = {}
+                for (label, future) in futures.items():
+                    try:
+                        future.result()
+                        logging.info(f"finished partition {label}")
+                    except Exception as e:
+                        logging.error(f"partition {label} failed: {e!r}")
+                        failed[label] = e
+            if failed:
+                raise RuntimeError(f"{len(failed)} partition(s) failed: {list(failed)}, "
+                                   "rerun to process only these")
+    partfiles = [paths[label] for label in parts]
+    if concat:
+        concat_partitions(partfiles, outfile, output_format=output_format, append=append)
+    return partfiles
+
+
+def concat_partitions(partfiles, outfile, dim=CONCAT_DIM, output_format='netcdf', append=False):
+    """Concatenate partition files along dim into outfile
+
+    Variables without dim are taken from the first partition.
+    """
+    logging.info(f"concatenating {len(partfiles)} partition(s) into {outfile}")
+    with xr.open_mfdataset(partfiles, combine='nested', concat_dim=dim, data_vars='minimal',
+                           coords='minimal', compat='override') as ds:
+        if append:
+            write_output(ds, outfile, output_format, append)
+            return
+        tmpfile = f'{outfile}.tmp'
+        write_output(ds, tmpfile, output_format)
+    os.replace(tmpfile, outfile)
+
+
+def add_arguments(parser):
+    """Add the batch options --years, -j/--jobs and --threads to parser"""
+    parser.add_argument('--years', type=int,
+                        help='process per partition of YEARS years (restartable)')
+    parser.add_argument('-j', '--jobs', type=int,
+                        help='number of partitions processed at once')
+    parser.add_argument('--threads', type=int, default=THREADS_PER_PARTITION,
+                        help=f'dask threads per partition (default: {THREADS_PER_PARTITION})')
+
+
+def batch_options(args):
+    """Return keyword arguments of run_partitions() from parsed arguments"""
+    return {'years': args.years, 'max_workers': args.jobs, 'threads': args.threads}
@@ -0,0 +1,256 @@
+#!/usr/bin/env python3
+# *_* coding: utf-8 *_*
+
+"""Choose dask chunks from the file layout and the available hardware
+
+The planner reads the layout of the first file of a collection (sizes,
+dtype and on-disk chunking of the variables, number of time steps per
+file) and the cores and memory of the job (SLURM allocation or cgroup
+limit, see load_SAIdata.available_resources). Chunks are as large as the
+memory budget of a worker allows, while leaving at least TASKS_PER_CORE
+chunks per core to keep all workers busy:
+
+    >> chunks = plan_chunks(files, ['U','V','PS'], whole_dims=['lev'])
+    >> ds = xr.open_mfdataset(files, chunks=chunks, ...)
+
+Chunks are split along time first. If a single time step does not fit in
+the budget, or there are too few time steps to occupy all cores, the
+largest other dimension is split as well. Chunk sizes are multiples of
+the on-disk chunks (netCDF4), such that no stored chunk is decompressed
+twice.
+
+Show the plan of a collection with
+    >> python chunkplan.py [-v] files [--variables ...] [--whole-dims ...]
+
+plan_periods splits a collection into calendar days or months, e.g. the
+daily tasks of the TC tracker:
+
+    >> plan = plan_periods(files, 'day')  # [(20930101, [(0, 0, 8)]), ...]
+
+The period of every time step (center of time_bnds) follows from the
+numeric times by integer arithmetic on the model calendar, without a
+date object per step. The (period, start, stop) segments of each file
+are cached in the file catalog (load_SAIdata.CATALOG), keyed by path,
+size and mtime, so a collection is only read once.
+"""
+
+import os
+import sys
+import json
+import math
+import argparse
+import logging
+
+import cftime
+import numpy as np
+import xarray as xr
+
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+from load_SAIdata import CATALOG, available_resources, _connect_catalog
+
+TDIM = 'time' # dimension along which chunks are split first
+MEMORY_FRACTION = 0.5 # fraction of the available memory used for chunks
+WORKING_FACTOR = 4 # peak memory of a task relative to its input chunk
+TASKS_PER_CORE = 2 # minimum number of chunks per core
+MAX_CHUNK_BYTES = 2**28 # upper limit of input per chunk (bytes)
+PERIODS = {'day': 10000, 'month': 100} # label multiplier of the year (YYYYMMDD, YYYYMM)
+MONTH_DAYS = { # days per month of calendars without leap years
+    'noleap': (31, 28, 31, 30, 31, 30, 31, 31, 30, 31, 30, 31),
+    '365_day': (31, 28, 31, 30, 31, 30, 31, 31, 30, 31, 30, 31),
+    'all_leap': (31, 29, 31, 30, 31, 30, 31, 31, 30, 31, 30, 31),
+    '366_day': (31, 29, 31, 30, 31, 30, 31, 31, 30, 31, 30, 31),
+    '360_day': (30,) * 12,
+}
+UNIT_DAYS = {'day': 1, 'hour': 1/24, 'minute': 1/1440, 'second': 1/86400}
+
+
+def plan_chunks(filepaths, variables=None, whole_dims=(), ncpus=None, memory=None,
+                per_file=True, working_factor=WORKING_FACTOR):
+    """Return dask chunks {dim: size} for the variables in filepaths
+
+    Input:
+    filepaths : (list of) netCDF file(s), the first is inspected
+    variables : variables read per task (default: all with TDIM)
+    whole_dims : dimensions that must not be split (e.g. the vertical)
+    ncpus, memory : available cores and memory (bytes), by default from
+        load_SAIdata.available_resources()
+    per_file : chunks cannot span several files (xr.open_mfdataset)
+    working_factor : peak memory of a task relative to its input
+
+    Dimensions in whole_dims are -1, TDIM and at most one other dimension
+    have sizes, all remaining dimensions are kept whole by dask.
+    """
+    filepaths = [filepaths] if isinstance(filepaths, str) else list(filepaths)
+    default_cpus, default_memory = available_resources()
+    ncpus = ncpus or default_cpus
+    memory = memory or default_memory
+    budget = min(MEMORY_FRACTION * memory / ncpus, MAX_CHUNK_BYTES * working_factor)
+
+    with xr.open_dataset(filepaths[0], decode_times=False) as ds:
+        if variables is None:
+            variables = [v for v in ds.data_vars if TDIM in ds[v].dims]
+        missing = [v for v in variables if v not in ds]
+        if missing:
+            raise ValueError(f'{missing} not in {filepaths[0]}')
+        sizes = {dim: size for v in variables for (dim, size) in ds[v].sizes.items()}
+        steps_per_file = ds.sizes.get(TDIM, 1)
+        # bytes per time step of all variables read by one task
+        step_bytes = sum(ds[v].dtype.itemsize
+                         * math.prod(s for (d, s) in ds[v].sizes.items() if d != TDIM)
+                         for v in variables)
+        # on-disk chunks (netCDF4), contiguous variables have none
+        disk = {}
+        for v in variables:
+            for (dim, size) in zip(ds[v].dims, ds[v].encoding.get('chunksizes') or ()):
+                disk[dim] = max(disk.get(dim, 1), size)
+        dtypes = sorted({str(ds[v].dtype) for v in variables})
+    ntime = steps_per_file * len(filepaths)
+    ntasks = TASKS_PER_CORE * ncpus
+
+    # time steps per chunk: fit in the budget and leave enough chunks
+    nt = int(budget // (working_factor * step_bytes))
+    nt = min(max(nt, 1), max(ntime // ntasks, 1))
+    if per_file:
+        nt = min(nt, steps_per_file)
+    nt = _align(nt, disk.get(TDIM, 1), steps_per_file if per_file else ntime)
+    chunks = {TDIM: nt} if TDIM in sizes else {}
+
+    # split another dimension if one step is too large or chunks are too few
+    nchunks = math.ceil(steps_per_file / nt) * len(filepaths) if per_file else math.ceil(ntime / nt)
+    nsplit = math.ceil(working_factor * step_bytes * nt / budget)
+    if nchunks < ncpus:
+        nsplit = max(nsplit, math.ceil(ncpus / nchunks))
+    splittable = {d: s for (d, s) in sizes.items() if (d != TDIM) and (d not in whole_dims)}
+    if (nsplit > 1) and splittable:
+        dim = max(splittable, key=splittable.get)
+        size = _align(math.ceil(splittable[dim] / nsplit), disk.get(dim, 1), splittable[dim])
+        chunks[dim] = size
+        nsplit = math.ceil(splittable[dim] / size)
+    else:
+        nsplit = 1
+    nchunks *= nsplit
+    chunks.update({dim: -1 for dim in whole_dims if dim in sizes})
+    chunk_bytes = step_bytes * nt / nsplit
+
+    logging.info(
+        f"chunk plan: {chunks} for {variables} ({', '.join(dtypes)}) on {dict(sizes)}"
+        f"\n    {len(filepaths)} file(s) with {steps_per_file} step(s), disk chunks {disk or 'none'}"
+        f"\n    {ncpus} cores, {memory/2**30:.1f} GiB, budget {budget/2**20:.0f} MiB per worker"
+        f"\n    {nchunks} chunks of {chunk_bytes/2**20:.1f} MiB "
+        f"(peak ~{working_factor*chunk_bytes/2**20:.1f} MiB per task)"
+    )
+    return chunks
+
+
+def _align(n, disk_chunk, total):
+    """Round n to a multiple of disk_chunk, within [1, total]"""
+    if disk_chunk > 1:
+        n = max(disk_chunk, n // disk_chunk * disk_chunk)
+    return int(max(1, min(n, total)))
+
+
+def plan_periods(filepaths, period='day', catalog=CATALOG):
+    """Return [(label, [(file index, start, stop), ...]), ...] of the periods in filepaths
+
+    Input:
+    filepaths : files sorted by time
+    period : 'day' (labels YYYYMMDD) or 'month' (YYYYMM)
+    catalog : SQLite file catalog in which the segments of each file are
+        cached (None: no cache)
+
+    Each period lists its steps start:stop in one or more files, periods
+    that continue in the next file are merged.
+    """
+    if period not in PERIODS:
+        raise ValueError(f'unknown period {period}, choose from {list(PERIODS)}')
+    con = _connect_catalog(catalog) if catalog else None
+    plan = []
+    try:
+        for (fid, filepath) in enumerate(filepaths):
+            for (label, start, stop) in _file_periods(filepath, period, con):
+                if plan and plan[-1][0] == label:
+                    plan[-1][1].append((fid, start, stop))
+                else:
+                    plan.append((label, [(fid, start, stop)]))
+    finally:
+        if con is not None:
+            con.commit()
+            con.close()
+    logging.info(f"{len(plan)} {period}s in {len(filepaths)} file(s)")
+    return plan
+
+
+def _file_periods(filepath, period, con=None):
+    """Return [(label, start, stop), ...] of the periods in filepath, cached in con"""
+    filepath = os.path.abspath(filepath)
+    stat = os.stat(filepath)
+    if con is not None:
+        row = con.execute('SELECT size, mtime, segments FROM periods WHERE path=? AND period=?',
+                          (filepath, period)).fetchone()
+        if (row is not None) and (row[:2] == (stat.st_size, stat.st_mtime_ns)):
+            return [tuple(segment) for segment in json.loads(row[2])]
+    with xr.open_dataset(filepath, decode_times=False) as ds:
+        time = (ds['time_bnds'].values.mean(axis=-1) if 'time_bnds' in ds
+                else ds['time'].values)
+        labels = period_labels(time, ds['time'].units, ds['time'].attrs.get('calendar', 'standard'),
+                               period)
+    starts = np.flatnonzero(np.diff(labels, prepend=-1))
+    stops = np.append(starts[1:], labels.size)
+    segments = [(int(labels[i]), int(i), int(j)) for (i, j) in zip(starts, stops)]
+    if con is not None:
+        con.execute('INSERT OR REPLACE INTO periods VALUES (?,?,?,?,?)',
+                    (filepath, period, stat.st_size, stat.st_mtime_ns, json.dumps(segments)))
+    return segments
+
+
+def period_labels(time, units, calendar='standard', period='day'):
+    """Return labels YYYYMMDD (day) or YYYYMM (month) of numeric times
+
+    For calendars without leap years (MONTH_DAYS) the dates follow from
+    the day number since the reference date by integer arithmetic. For
+    other calendars each day is converted once by cftime.
+    """
+    time = np.asarray(time, dtype='float64')
+    unit, _, _ = units.partition(' since ')
+    factor = UNIT_DAYS[unit.strip().lower().removesuffix('s')]
+    ref = cftime.num2date(0, units, calendar)
+    ref_seconds = ref.hour * 3600 + ref.minute * 60 + ref.second
+    # days since the start of the reference day, rounded to seconds
+    days = (np.round(time * factor * 86400) + ref_seconds) // 86400
+    month_days = MONTH_DAYS.get(calendar.lower())
+    if month_days is None:
+        udays, inverse = np.unique(days, return_inverse=True)
+        dates = cftime.num2date((udays * 86400 - ref_seconds) / (86400 * factor), units, calendar)
+        year, month, day = [np.array([getattr(d, a) for d in dates])[inverse]
+                            for a in ('year', 'month', 'day')]
+    else:
+        first = np.cumsum((0,) + month_days) # first day of each month in the year
+        days = days + ref.year * first[-1] + first[ref.month-1] + ref.day - 1
+        year, doy = np.divmod(days.astype('int64'), first[-1])
+        month = np.searchsorted(first, doy, side='right')
+        day = doy - first[month-1] + 1
+    if period == 'month':
+        return year * PERIODS[period] + month
+    return year * PERIODS[period] + month * 100 + day
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Show the dask chunks chosen for a collection of files')
+    parser.add_argument('files', nargs='+', help='input file(s)')
+    parser.add_argument('--variables', nargs='+', help='variables read per task')
+    parser.add_argument('--whole-dims', nargs='+', default=[],
+                        help='dimensions that must not be split')
+    parser.add_argument('-v', '--verbose', help='modify output verbosity',
+                        action='store_true')
+    args = parser.parse_args()
+    logging.basicConfig(
+        level=logging.INFO if args.verbose else logging.WARNING,
+        format="%(asctime)s %(levelname)s: %(message)s",
+        datefmt="%d-%m-%Y %H:%M:%S"
+    )
+    print(plan_chunks(args.files, args.variables, args.whole_dims))
+
+
+if __name__ == '__main__':
+    main()
@@ -17,6 +17,7 @@ import dask
 from dask.distributed import LocalCluster, Client, progress
 import netCDF4 as nc
 import xarray as xr
+from xarray_funcs import area_mean
 
 # files for medium resolution (0.5 deg atm, 0.1 deg ocn)
 
@@ -75,46 +76,6 @@ def shift_time(ds, ndays):
     return ds.assign(time=(ds.time.dims,(ds.time+dt).data,ds.time.attrs))
 
 
-def wmean(ds:[xr.Dataset,xr.DataArray], w:xr.DataArray, dims, **kwargs):
-    """wrapper for xarray weighted mean
-    
-    Input:
-    ds : data to average
-    w : weights
-    dims : iterable of dimensions to average over
-    kwargs : keyword arguments passed on to .mean(), e.g. keep_attrs
-    
-    Manual fixes:
-        1) only apply averaging along subset of dimensions that is also in 
-            dims (returns the unaveraged data if no overlapping dimensions)
-        2) always copy coordinate attributes to result
-        3) remove weighted operator if w.dims is no subset of ds.dims to 
-            prevent broadcasting
-        4) let function wmean determine keep_attrs per dataarray instead of 
-            map() which applies one value to the whole dataset
-    """
-    if isinstance(ds, xr.Dataset):
-        global WMEAN_ATTRS
-        WMEAN_ATTRS = {}
-        dsm = ds.map(wmean, False, [w, dims])
-        if kwargs.get('keep_attrs', False):
-            for v in dsm.data_vars:
-                dsm[v].attrs = WMEAN_ATTRS[v] # 4
-        return dsm
-    if 'WMEAN_ATTRS' in globals():
-        WMEAN_ATTRS[ds.name] = ds.attrs
-    avgdims = tuple(set(ds.dims).intersection(dims)) # 1
-    if len(avgdims)==0: # 1
-        return ds
-    coordattrs = {c:ds[c].attrs for c in ds.coords}
-    if set(w.dims).issubset(ds.dims):
-        dsm = ds.weighted(w).mean(avgdims, **kwargs)
-    else: # 3
-        dsm = ds.mean(avgdims, **kwargs)
-    for c in dsm.coords:
-        dsm[c].attrs.update(coordattrs[c]) # 2
-    return dsm
-
 open_kwargs = {'data_vars': 'minimal', 'coords': 'minimal', 'compat': 'override', 'parallel': True, 'decode_times':False}
 cam = {
     # 'cnt': shift_time(center_time(xr.open_mfdataset(camc, data_vars='minimal', coords='minimal', compat='override')), ndays=365*1800),
@@ -131,7 +92,7 @@ cam = {
     #'hrsf': center_time(xr.open_mfdataset(camhrsf, **open_kwargs))
 }
 
-camm = {k:wmean(wmean(v, v.gw, ('lat','lon'), keep_attrs=True), v.w_stag, ('slat', 'slon'), keep_attrs=True) for k,v in cam.items()}
+camm = {k:area_mean(v) for k,v in cam.items()}
 
 for sim in camm:
     print(sim)
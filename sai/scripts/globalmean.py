@@ -3,9 +3,15 @@
 
 """Read CESM output data and calculate global mean
 
-Run with >> python globalmean.py [-v,--verbose] *files outfile
+Run with >> python globalmean.py [-v,--verbose] [--chunk N] [--years N] *files outfile
 
-The vertical wind shear and other variables are stored in outfile.
+The global means of all variables are stored in outfile. The files are
+opened through the kerchunk loader and read in chunks of N time steps,
+each of which is read once and reduced for all variables on all grids
+(see xarray_funcs.area_mean), and written to outfile as it is computed.
+With --years N the files are processed per partition of N years, which
+can be restarted after an interruption (see batch.py). With --format zarr
+outfile is a Zarr store, to which later runs can --append (see output.py).
 """
 
 import os
@@ -13,28 +19,36 @@ import sys
 import time
 import argparse
 import logging
+from functools import partial
 print(f'Python version: {sys.version}')
 print(f'Path: {sys.path}')
 
 import numpy as np
 import xarray as xr
 xr.set_options(keep_attrs=True)
+from load_SAIdata import open_mfdataset
+from xarray_funcs import area_mean
+from gridweights import GridWeights
+from batch import add_arguments, batch_options, run_partitions
+from output import add_output_arguments, check_outfile, write_output
 
+TIME_CHUNK = 12 # time steps per chunk
 
-def global_mean(ds):
-    """Calculate global mean"""
-    gw = ds.gw # grid weights
-    # weighted mean does not work smoothly on whole dataset
-    # so only apply it to variables with the lat dimension
-    ds = ds.drop_vars('lat')
-    lvars = [v for v in ds.variables if 'lat' in ds[v].dims]
-    ds[lvars] = ds[lvars].weighted(ds.gw).mean('lat')
-    # repeat for staggered grid
-    ds = ds.drop_vars('slat')
-    lvars_w = [v for v in ds.variables if 'slat' in ds[v].dims]
-    ds[lvars_w] = ds[lvars_w].weighted(ds.w_stag).mean('slat')
-    ds = ds.mean(('lon','slon'))
-    return ds
+
+def global_mean(ds, skipna=True):
+    """Calculate global mean of all variables (lat, slat and ncol grids)"""
+    return area_mean(ds, GridWeights.from_dataset(ds).weights, skipna=skipna)
+
+
+def process(files, outfile, chunk=TIME_CHUNK, skipna=True, verbose=False, 
+            output_format='netcdf', append=False):
+    """Store global means of all variables in files to outfile"""
+    logging.info(f"opening files")
+    ds = open_mfdataset(files, verbose=verbose, decode_times=False, 
+                        chunks={'time': chunk})
+    ds = global_mean(ds, skipna)
+    logging.info(f"storing global means to {outfile}")
+    write_output(ds, outfile, output_format, append)
 
 
 def main():
@@ -45,9 +59,16 @@ def main():
     parser.add_argument('files', nargs='+', help='input file(s)')
     parser.add_argument('outfile', help='output file')
     parser.add_argument('-f', help='used by jupyter')
+    parser.add_argument('--chunk', type=int, default=TIME_CHUNK,
+                        help=f'time steps read per chunk (default: {TIME_CHUNK})')
+    parser.add_argument('--no-skipna', dest='skipna', action='store_false',
+                        help='data has no missing values, skip renormalisation')
+    add_arguments(parser)
+    add_output_arguments(parser)
     parser.add_argument('-v', '--verbose', help='modify output verbosity', 
                         action='store_true')
     args = parser.parse_args()
+    check_outfile(args)
 
     # set up logger 
     logging.basicConfig(
@@ -62,11 +83,14 @@ def main():
     )
     
     # 
-    logging.info(f"opening files")
-    ds = xr.open_mfdataset(args.files, decode_times=False)
-    ds = global_mean(ds)
-    logging.info(f"storing interpolated data to {args.outfile}")
-    ds.to_netcdf(args.outfile)
+    process_files = partial(process, chunk=args.chunk, skipna=args.skipna, 
+                            verbose=args.verbose)
+    if args.years is None:
+        process_files(args.files, args.outfile, output_format=args.output_format, 
+                      append=args.append)
+    else:
+        run_partitions(args.files, args.outfile, process_files, **batch_options(args),
+                       output_format=args.output_format, append=args.append)
     logging.info(f"SUCCES")
     time1 = time.perf_counter()
     logging.info(f"total script time: {time1-time0:.2f} seconds")
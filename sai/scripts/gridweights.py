@@ -0,0 +1,274 @@
+#!/usr/bin/env python3
+# *_* coding: utf-8 *_*
+
+"""Registry of precomputed normalised grid weights
+
+Grid weights (gw, w_stag, area), land/ocean fractions and masks of a
+model grid are computed once from a history file and stored as .npy
+files in GRIDWEIGHTS_DIR/<grid>. They are memory mapped when used, so
+repeated reductions over many cases and variables share one normalised
+copy instead of renormalising the weights of every dataset.
+
+    >> from gridweights import GridWeights
+    >> from xarray_funcs import area_mean
+    >> gw = GridWeights.from_dataset(ds)         # f05, f09, ne30, ...
+    >> area_mean(ds, gw.weights, skipna=False)   # NaN free data
+    >> area_mean(ds.TREFHT, gw.masked('land'))   # land mean
+
+Build or inspect the registry with
+    >> python gridweights.py [-v] file [file ...]
+"""
+
+import os
+import json
+import shutil
+import fcntl
+import tempfile
+import argparse
+import logging
+
+import numpy as np
+import xarray as xr
+
+GRIDWEIGHTS_DIR = '~/kerchunk/gridweights'
+GRIDS = { # horizontal dimension sizes of known grids
+    'f19': {'lat': 96, 'lon': 144},
+    'f09': {'lat': 192, 'lon': 288},
+    'f05': {'lat': 384, 'lon': 576},
+    'f02': {'lat': 768, 'lon': 1152},
+    'ne30': {'ncol': 48602},
+    'ne120': {'ncol': 777602},
+}
+WEIGHT_VARS = {'lat': 'gw', 'slat': 'w_stag', 'ncol': 'area'}
+FRACTION_VARS = {'landfrac': 'LANDFRAC', 'ocnfrac': 'OCNFRAC'}
+MASK_THRESHOLD = 0.5 # minimum fraction of land/ocean masks
+
+
+def grid_name(ds):
+    """Return name of the horizontal grid of ds, e.g. 'f05' or 'ne30'
+
+    Unknown grids are named by their shape, e.g. '12x12' or 'ncol1000'.
+    """
+    for (name, sizes) in GRIDS.items():
+        if all(ds.sizes.get(dim) == size for (dim, size) in sizes.items()):
+            return name
+    if 'ncol' in ds.dims:
+        return f"ncol{ds.sizes['ncol']}"
+    return f"{ds.sizes['lat']}x{ds.sizes['lon']}"
+
+
+class GridWeights:
+    '''Memory mapped normalised weights, fractions and masks of a grid
+
+    Attributes:
+        name: grid name (see GRIDS)
+        directory: directory with the .npy files and their dimensions
+        weights: {dim: normalised weights} of lat, slat, lon, slon or ncol,
+            to be passed to xarray_funcs.area_mean()
+        landfrac, ocnfrac: land and ocean fraction (first time step)
+
+    Methods:
+        from_dataset(ds): load the weights of the grid of ds, creating them
+            if they do not exist yet
+        mask(name): boolean mask, 'land', 'ocean' or added by add_mask()
+        masked(name): normalised 2D weights of the cells in mask
+        add_mask(name, mask): store a custom (regional) mask
+    '''
+
+    def __init__(self, name, directory=GRIDWEIGHTS_DIR):
+        self.name = name
+        self.directory = os.path.join(os.path.expanduser(directory), name)
+        if not os.path.exists(os.path.join(self.directory, 'dims.json')):
+            raise FileNotFoundError(f'no grid weights of {name} in {self.directory}, '
+                                    'use GridWeights.from_dataset()')
+        self._arrays = {}
+
+    @classmethod
+    def from_dataset(cls, ds, directory=GRIDWEIGHTS_DIR):
+        """Return GridWeights of the grid of ds, computing them if needed
+
+        Weights that ds has but the registry lacks (e.g. w_stag, if the
+        registry was created from a stream without it) are added.
+        """
+        name = grid_name(ds)
+        path = os.path.join(os.path.expanduser(directory), name)
+        if not set(_weight_keys(ds)).issubset(_read_dims(path) or {}):
+            cls.build(ds, name, directory)
+        return cls(name, directory)
+
+    @staticmethod
+    def build(ds, name=None, directory=GRIDWEIGHTS_DIR):
+        """Compute and store the normalised weights, fractions and masks of ds
+
+        A new registry is written to a temporary directory that is renamed
+        into place in one step, such that other processes never see part
+        of it. Entries missing from an existing registry are added.
+        """
+        name = grid_name(ds) if name is None else name
+        parent = os.path.expanduser(directory)
+        path = os.path.join(parent, name)
+        arrays = _grid_arrays(ds)
+        if _read_dims(path) is None:
+            logging.info(f'creating grid weights of {name} in {path}')
+            os.makedirs(parent, exist_ok=True)
+            tmp_path = tempfile.mkdtemp(prefix=f'.{name}.', dir=parent)
+            try:
+                for (key, (dims, data)) in arrays.items():
+                    np.save(os.path.join(tmp_path, f'{key}.npy'), np.asarray(data))
+                _write_dims(tmp_path, {key: list(dims) for (key, (dims, _)) in arrays.items()})
+                os.rename(tmp_path, path)
+            except OSError:
+                if _read_dims(path) is None:
+                    raise # not created by another process in the meantime
+            finally:
+                shutil.rmtree(tmp_path, ignore_errors=True) # gone if renamed
+        missing = {key: value for (key, value) in arrays.items() if key not in _read_dims(path)}
+        if missing:
+            logging.info(f'adding {list(missing)} to grid weights of {name} in {path}')
+            _save_arrays(path, missing)
+
+    @property
+    def weights(self):
+        return {key.removeprefix('weights.'): self._load(key)
+                for key in self._dims() if key.startswith('weights.')}
+
+    @property
+    def landfrac(self):
+        return self._load('landfrac')
+
+    @property
+    def ocnfrac(self):
+        return self._load('ocnfrac')
+
+    def mask(self, name):
+        """Return boolean mask of name, e.g. 'land' or 'ocean'"""
+        return self._load(f'mask.{name}')
+
+    def masked(self, name):
+        """Return {dims: normalised weights} of the cells in mask name
+
+        The weights are computed once per mask and stored next to it.
+        """
+        key = f'masked.{name}'
+        if key not in self._dims():
+            mask = self.mask(name)
+            w = xr.dot(*[self._load(f'weights.{dim}') for dim in mask.dims], dim=[])
+            w = w.transpose(*mask.dims).where(mask, 0).values
+            _save_arrays(self.directory, {key: (mask.dims, w / w.sum())})
+        w = self._load(key)
+        return {w.dims: w}
+
+    def add_mask(self, name, mask):
+        """Store boolean mask (DataArray on the grid) as name"""
+        mask = mask.reset_coords(drop=True)
+        _save_arrays(self.directory, {f'mask.{name}': (mask.dims, mask.values.astype(bool))},
+                     drop=[f'masked.{name}'])
+        self._arrays = {}
+
+    def _dims(self):
+        return _read_dims(self.directory)
+
+    def _load(self, key):
+        """Return memory mapped array key as DataArray"""
+        if key not in self._arrays:
+            dims = self._dims().get(key)
+            if dims is None:
+                raise KeyError(f'{key} not in grid weights of {self.name}, '
+                               f'choose from {list(self._dims())}')
+            data = np.load(os.path.join(self.directory, f'{key}.npy'), mmap_mode='r')
+            normalized = key.startswith(('weights.', 'masked.'))
+            self._arrays[key] = xr.DataArray(data, dims=dims,
+                                             attrs={'normalized': True} if normalized else {})
+        return self._arrays[key]
+
+    def __repr__(self):
+        return f'GridWeights({self.name!r}): {", ".join(self._dims())}'
+
+
+def _weight_keys(ds):
+    """Return the registry keys of the weights of the dimensions of ds"""
+    keys = [f'weights.{dim}' for (dim, var) in WEIGHT_VARS.items()
+            if (dim in ds.dims) and (var in ds.variables)]
+    return keys + [f'weights.{dim}' for dim in ['lon', 'slon'] if dim in ds.dims]
+
+
+def _grid_arrays(ds):
+    """Return {key: (dims, data)} of the normalised weights, fractions and masks of ds"""
+    arrays = {}
+    for (dim, var) in WEIGHT_VARS.items():
+        if (dim in ds.dims) and (var in ds.variables):
+            w = ds[var].isel({d: 0 for d in ds[var].dims if d != dim}).values
+            arrays[f'weights.{dim}'] = ((dim,), w / w.sum())
+    for dim in ['lon', 'slon']:
+        if dim in ds.dims:
+            arrays[f'weights.{dim}'] = ((dim,), np.full(ds.sizes[dim], 1/ds.sizes[dim]))
+    for (frac, var) in FRACTION_VARS.items():
+        if var in ds.variables:
+            da = ds[var].isel({d: 0 for d in ds[var].dims if d == 'time'})
+            arrays[frac] = (da.dims, da.values)
+    if 'landfrac' in arrays:
+        arrays['mask.land'] = (arrays['landfrac'][0], arrays['landfrac'][1] > MASK_THRESHOLD)
+    if 'ocnfrac' in arrays:
+        arrays['mask.ocean'] = (arrays['ocnfrac'][0], arrays['ocnfrac'][1] > MASK_THRESHOLD)
+    return arrays
+
+
+def _read_dims(directory):
+    """Return {key: dims} of the registry in directory, None if there is none"""
+    try:
+        with open(os.path.join(directory, 'dims.json')) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+
+def _save_arrays(directory, arrays, drop=()):
+    """Write arrays {key: (dims, data)} to an existing registry, dropping keys in drop
+
+    Arrays are written under per-process temporary names and replaced
+    atomically, dims.json is updated under a lock, such that processes
+    sharing the registry never lose each other's keys.
+    """
+    for (key, (_, data)) in arrays.items():
+        tmp_path = os.path.join(directory, f'.{key}.{os.getpid()}.tmp.npy')
+        np.save(tmp_path, np.asarray(data))
+        os.replace(tmp_path, os.path.join(directory, f'{key}.npy'))
+    with open(os.path.join(directory, 'dims.lock'), 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        all_dims = _read_dims(directory) or {}
+        all_dims.update({key: list(dims) for (key, (dims, _)) in arrays.items()})
+        dropped = [key for key in drop if all_dims.pop(key, None) is not None]
+        _write_dims(directory, all_dims)
+        for key in dropped: # no longer registered
+            os.remove(os.path.join(directory, f'{key}.npy'))
+
+
+def _write_dims(directory, all_dims):
+    """Atomically write dims.json (per-process temporary name)"""
+    tmp_path = os.path.join(directory, f'.dims.json.{os.getpid()}.tmp')
+    with open(tmp_path, 'w') as f:
+        json.dump(all_dims, f)
+    os.replace(tmp_path, os.path.join(directory, 'dims.json'))
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Create grid weight registry entries from history files')
+    parser.add_argument('files', nargs='+', help='history file(s), one per grid')
+    parser.add_argument('--directory', default=GRIDWEIGHTS_DIR,
+                        help=f'registry directory (default: {GRIDWEIGHTS_DIR})')
+    parser.add_argument('-v', '--verbose', help='modify output verbosity',
+                        action='store_true')
+    args = parser.parse_args()
+    logging.basicConfig(
+        level=logging.INFO if args.verbose else logging.WARNING,
+        format="%(asctime)s %(levelname)s: %(message)s",
+        datefmt="%d-%m-%Y %H:%M:%S"
+    )
+    for file in args.files:
+        with xr.open_dataset(file, decode_times=False) as ds:
+            print(GridWeights.from_dataset(ds, args.directory))
+
+
+if __name__ == '__main__':
+    main()
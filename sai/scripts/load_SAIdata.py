@@ -1,14 +1,31 @@
+import argparse
+import fnmatch
+import glob
+import hashlib
 import json
 import os
 import re
+import shutil
+import sqlite3
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, wait
 from kerchunk.netCDF3 import NetCDF3ToZarr
+from kerchunk.hdf import SingleHdf5ToZarr
 from kerchunk.combine import MultiZarrToZarr
 import numpy as np
-import dask.bag
 import xarray as xr
 
 
-def open_mfdataset(filepaths: list[str], ncstore_dir: str='~/kerchunk', verbose=True, **kwargs):
+NCSTORE_EXTENSIONS = {'json':'json', 'parquet':'parq'} # NC_STORE formats
+NCSTORE_SIDECARS = ['.manifest', '.parts', '.ctime'] # files next to each NC_STORE
+CATALOG = '~/kerchunk/catalog.db' # SQLite index of all netCDF files in Cases
+REFERENCE_WORKER_MEMORY = 2**30 # (bytes) memory reserved per reference worker
+
+
+def open_mfdataset(filepaths: list[str], ncstore_dir: str='~/kerchunk', verbose=True, 
+                   ncstore_format: str='json', variables: list[str]=None, 
+                   max_workers: int=None, center_time: bool=False, memory_limit: int=None,
+                   **kwargs):
     """a faster alternative to xr.open_mfdataset using kerchunk
     
     This function uses kerchunk to create an NC_STORE reference file,
@@ -16,6 +33,39 @@ def open_mfdataset(filepaths: list[str], ncstore_dir: str='~/kerchunk', verbose=
     Coordinates must be consistent throughout all files.
     The NC_STORE is saved after first use, and will be read on each 
     subsequent usage of this function.
+
+    References of individual files are cached in {ncstore_dir}/files,
+    keyed by path, size and modification time. Next to the NC_STORE a
+    manifest of all (path, size, mtime) entries is kept. If files were
+    only added at the end of the collection, the existing NC_STORE is
+    extended with the new files, otherwise it is recombined from the
+    cached references. Only new or changed files are translated.
+
+    With ncstore_format='parquet' the NC_STORE is written as a directory
+    of parquet files, partitioned by variable, that is loaded lazily on
+    opening. This is preferred for large collections (e.g. 6-hourly 3D
+    output) where parsing a single JSON file dominates opening time.
+    Existing JSON NC_STOREs can be converted with convert_ncstores().
+
+    If variables are given, the NC_STORE only contains references to these
+    variables, variables without time dimension (coordinates, gw, ...), 
+    time and its bounds. Such NC_STOREs are named with a hash of the
+    selected variable names.
+
+    Both netCDF3 and netCDF4/HDF5 files are supported, the format is
+    detected per file. Collections of files with different formats or
+    encodings are split into an NC_STORE per consecutive run of equally
+    encoded files, which are concatenated along time after opening.
+
+    With center_time=True the time coordinate is set to the center of the
+    time bounds (CESM stamps monthly means at the end of the month). The
+    centered times are computed once and cached next to the NC_STORE in
+    a .ctime file, and extended for files appended to the collection, so
+    the bounds are not read from every file at each opening.
+
+    New references are created in parallel by build_references(). To 
+    prebuild NC_STOREs of a case (e.g. in a SLURM job) run
+    >> python -m sai.scripts.load_SAIdata index <tag> [-j N]
     
     Parameters:
     filepaths : str or list[str]
@@ -24,13 +74,23 @@ def open_mfdataset(filepaths: list[str], ncstore_dir: str='~/kerchunk', verbose=
         Path where NC_STORE reference files will be saved
     verbose: Bool
         Whether to print NC_STORE reference file names when reading/writing
+    ncstore_format: str
+        NC_STORE format, 'json' (single file) or 'parquet' (directory)
+    variables: list[str]
+        names of time dependent variables to include (default: all)
+    max_workers: int
+        maximum number of processes creating references
+    center_time: Bool
+        set time to the center of the time bounds
+    memory_limit: int
+        maximum memory (bytes) of the processes creating references
     kwargs: dict
         any additional keyword arguments are passed on to xr.open_dataset
         
     Returns: xr.Dataset
         a Dataset instance containing all the netCDF data
         
-    v0.0
+    v0.5
     """
     
     # make sorted list of absolute filepaths
@@ -38,46 +98,551 @@ def open_mfdataset(filepaths: list[str], ncstore_dir: str='~/kerchunk', verbose=
         filepaths = glob.glob(filepaths)
     filepaths = sorted([os.path.abspath(fp) for fp in filepaths])
     if len(filepaths) == 1: # use xr.open_dataset directly if there is one file
-        return xr.open_dataset(filepaths[0], **kwargs)
+        ds = xr.open_dataset(filepaths[0], **kwargs)
+        if variables is not None:
+            bounds = ds.time.attrs.get('bounds', ds.time.encoding.get('bounds'))
+            ds = ds[[v for v in ds.data_vars if (v in variables) or (v == bounds) 
+                     or ('time' not in ds[v].dims)]]
+        return _center_time(ds) if center_time else ds
+    ncstore_paths = build_ncstore(filepaths, ncstore_dir, verbose, ncstore_format, 
+                                  variables, max_workers, memory_limit)
+
+    # set default keyword arguments for xr.open_dataset on NC_STORE file
+    storage_options = {'remote_protocol':'file'} if ncstore_format == 'parquet' else {'target_protocol':'file'}
+    required_kw = {'engine':'kerchunk', 'storage_options':storage_options}
+    for (k,v) in required_kw.items():
+        if k in kwargs:
+            print(f'open_mfdataset(): ignoring keyword {k}')
+    kwargs = kwargs | required_kw
+    
+    if len(ncstore_paths) == 1:
+        ds = xr.open_dataset(ncstore_paths[0], **kwargs)
+    else:
+        datasets = [xr.open_dataset(path, **kwargs) for path in ncstore_paths]
+        ds = xr.concat(datasets, 'time', data_vars='minimal', coords='minimal', 
+                       compat='override', combine_attrs='drop_conflicts')
+    if center_time:
+        ncstore_path = os.path.join(os.path.expanduser(ncstore_dir), 
+                                    _ncstore_name(filepaths, ncstore_format, variables))
+        ds = _center_time(ds, ncstore_path)
+    return ds
+
+
+def _center_time(ds, ncstore_path=None):
+    """Return ds with time at the center of its bounds
     
-    # create NC_STORE filename from netCDF filename, including timestamp
-    # of first and last file. Open and return dataset if the file already exists
+    The centered times (in the units of the time encoding) are cached in
+    {ncstore_path}.ctime together with the manifest they belong to. If
+    files were appended to the collection, only the bounds of the new 
+    time steps are read.
+    """
+    bounds = ds.time.attrs.get('bounds', ds.time.encoding.get('bounds'))
+    if bounds not in ds:
+        raise ValueError(f'cannot center time, bounds {bounds} not in dataset')
+    decoded = not np.issubdtype(ds.time.dtype, np.number)
+    units = ds.time.encoding.get('units', ds.time.attrs.get('units'))
+    calendar = ds.time.encoding.get('calendar', ds.time.attrs.get('calendar', 'standard'))
+    cache_path = None if ncstore_path is None else f'{ncstore_path}.ctime'
+    manifest = None if ncstore_path is None else _read_manifest(ncstore_path)
+    values = []
+    if (manifest is not None) and os.path.exists(cache_path):
+        with open(cache_path) as f:
+            cache = json.load(f)
+        n = len(cache['manifest'] or [])
+        if (n > 0) and (cache['manifest'] == manifest[:n]) and (cache['units'] == units) \
+                and (cache['calendar'] == calendar) and len(cache['values']) <= ds.sizes['time']:
+            values = cache['values']
+    if len(values) < ds.sizes['time']: # read bounds of new time steps only
+        new_bounds = ds[bounds].isel(time=slice(len(values), None)).values
+        if decoded:
+            new_bounds = xr.coding.times.encode_cf_datetime(new_bounds, units, calendar)[0]
+        values = values + new_bounds.astype('float64').mean(axis=-1).tolist()
+        if manifest is not None: # a cache without manifest could never be validated
+            with open(f'{cache_path}.tmp', 'w') as f:
+                json.dump({'manifest': manifest, 'units': units, 'calendar': calendar,
+                           'values': values}, f)
+            os.replace(f'{cache_path}.tmp', cache_path)
+    ctime = np.array(values)
+    if decoded:
+        ctime = xr.coding.times.decode_cf_datetime(ctime, units, calendar, 
+                                                   use_cftime=not np.issubdtype(ds.time.dtype, np.datetime64))
+    encoding = ds.time.encoding
+    ds = ds.assign_coords(time=('time', ctime, ds.time.attrs))
+    ds.time.encoding = encoding
+    return ds
+
+
+def build_ncstore(filepaths: list[str], ncstore_dir: str='~/kerchunk', verbose=True, 
+                  ncstore_format: str='json', variables: list[str]=None, 
+                  max_workers: int=None, memory_limit: int=None):
+    """Create or update the NC_STORE of filepaths and return its path(s)
+    
+    See open_mfdataset() for the parameters, memory_limit (bytes) bounds
+    the number of processes used by build_references(). If the files
+    differ in format or encoding, a separate NC_STORE is made for each
+    consecutive run of equally encoded files. The paths of all parts are
+    listed in a .parts file next to the manifest.
+
+    Returns: list[str]
+        NC_STORE path(s), to be concatenated along time after opening
+    """
+    filepaths = sorted([os.path.abspath(fp) for fp in filepaths])
+
+    # create NC_STORE filename from netCDF filename and compare the 
+    # manifest of the existing NC_STORE with the current files
     ncstore_dir = os.path.expanduser(ncstore_dir)
-    fparts = os.path.basename(filepaths[0]).split('.')
-    fpartsf = os.path.basename(filepaths[-1]).split('.')
-    fparts[-2] = f'{fparts[-2]}_{fpartsf[-2]}' # time string
-    fparts[-1] = 'json' # extension
-    ncstorefile = '.'.join(fparts)
-    ncstore_path = os.path.join(ncstore_dir, ncstorefile)
-    if not os.path.exists(ncstore_dir):
-        os.mkdir(ncstore_dir)
-    elif os.path.exists(ncstore_path):
+    os.makedirs(os.path.join(ncstore_dir, 'files'), exist_ok=True)
+    ncstore_path = os.path.join(ncstore_dir, _ncstore_name(filepaths, ncstore_format, variables))
+    manifest = [_file_key(fp) for fp in filepaths]
+    old_manifest = _read_manifest(ncstore_path)
+    if manifest == old_manifest:
         if verbose:
             print(f"Reading combined kerchunk reference file {ncstore_path}")
-        return xr.open_dataset(ncstore_path, **kwargs)
+        return _ncstore_parts(ncstore_path)
+    reffiles = _file_references(manifest, ncstore_dir, verbose, max_workers, memory_limit)
+    groups = _encoding_groups(reffiles)
+    if len(groups) == 1:
+        if _ncstore_parts(ncstore_path) != [ncstore_path]:
+            old_manifest = None
+        old_path = ncstore_path
+        if old_manifest is None: # extend the NC_STORE of the collection before appending
+            old_path, old_manifest = _previous_ncstore(ncstore_path, filepaths, manifest, 
+                                                       ncstore_format, variables)
+        _update_ncstore(ncstore_path, manifest, old_manifest, reffiles, verbose, variables, 
+                        old_path)
+        if old_path not in (None, ncstore_path): # superseded by the extended NC_STORE
+            _remove_ncstore(old_path, verbose)
+        parts = [ncstore_path]
+    else:
+        if verbose:
+            print(f"Files have {len(groups)} different formats/encodings, combining each separately")
+        parts = []
+        for (i0, i1) in groups:
+            part_path = os.path.join(ncstore_dir, 
+                _ncstore_name(filepaths[i0:i1], ncstore_format, variables, part=True))
+            old_part_manifest = _read_manifest(part_path)
+            old_path = part_path
+            if old_part_manifest is None:
+                old_path, old_part_manifest = _previous_ncstore(part_path, filepaths[i0:i1], 
+                    manifest[i0:i1], ncstore_format, variables, part=True)
+            if manifest[i0:i1] != old_part_manifest:
+                _update_ncstore(part_path, manifest[i0:i1], old_part_manifest, 
+                                reffiles[i0:i1], verbose, variables, old_path)
+                if old_path not in (None, part_path):
+                    _remove_ncstore(old_path, verbose)
+            parts.append(part_path)
+        with open(f"{ncstore_path}.manifest", "w") as f:
+            json.dump(manifest, f)
+    with open(f"{ncstore_path}.parts", "w") as f:
+        json.dump(parts, f)
+    return parts
+
+
+def build_references(filepaths: list[str], max_workers: int=None, memory_limit: int=None, 
+                     retries: int=2, verbose=True, callback=None):
+    """Create kerchunk references of netCDF files with a pool of processes
     
-    # make new NC_STORE data
-    with xr.open_dataset(filepaths[0]) as ds:
-        const_vars = [v for v in ds.variables if 'time' not in ds[v].dims]
-    filebag = dask.bag.from_sequence(filepaths, npartitions=None)
-    reffiles = (filebag.map(NetCDF3ToZarr, inline_threshold=0, max_chunk_size=0)
-                .map(lambda z: z.translate()).compute())
+    The number of processes is bounded by max_workers (default: available
+    cores) and by memory_limit (bytes, default: available memory), which
+    reserves REFERENCE_WORKER_MEMORY per process. At most two files per
+    process are submitted at once. Failed files are retried.
+
+    Parameters:
+    filepaths : list[str]
+        netCDF file names
+    max_workers: int
+        maximum number of processes
+    memory_limit: int
+        maximum memory (bytes) used by all processes together
+    retries: int
+        number of times a failed file is resubmitted
+    verbose: Bool
+        Whether to print progress
+    callback: Callable[[int, dict], Any]
+        called with the index in filepaths and references of each file 
+        as soon as it is completed (e.g. to cache the references)
+
+    Returns: list[dict]
+        kerchunk references of each file
+    """
+    ncpus, memory = available_resources()
+    max_workers = min(max_workers or ncpus, len(filepaths))
+    memory_limit = memory_limit or memory
+    max_workers = max(1, min(max_workers, memory_limit // REFERENCE_WORKER_MEMORY))
+    if verbose:
+        print(f"Creating kerchunk references for {len(filepaths)} files with {max_workers} processes")
+    results = [None] * len(filepaths)
+    attempts = [0] * len(filepaths)
+    failed = {}
+    todo = list(range(len(filepaths)))[::-1]
+    ndone, nreport, time0 = 0, max(1, len(filepaths)//20), time.perf_counter()
+    with ProcessPoolExecutor(max_workers) as pool:
+        running = {}
+        while todo or running:
+            while todo and (len(running) < 2*max_workers):
+                i = todo.pop()
+                attempts[i] += 1
+                running[pool.submit(_translate, filepaths[i])] = i
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                i = running.pop(future)
+                try:
+                    results[i] = future.result()
+                except Exception as e:
+                    if attempts[i] <= retries:
+                        if verbose:
+                            print(f"Retrying {filepaths[i]} after error: {e!r}")
+                        todo.append(i)
+                    else:
+                        failed[filepaths[i]] = e
+                    continue
+                if callback is not None:
+                    callback(i, results[i])
+                ndone += 1
+                if verbose and ((ndone % nreport == 0) or (ndone == len(filepaths))):
+                    print(f"[{ndone}/{len(filepaths)}] references created "
+                          f"({time.perf_counter()-time0:.1f} seconds)", flush=True)
+    if failed:
+        raise RuntimeError(f"could not create references for {len(failed)} file(s):\n" 
+                           + "\n".join(f"{fp}: {e!r}" for (fp, e) in failed.items()))
+    return results
+
+
+def _translate(filepath):
+    """Return kerchunk references of a single netCDF3 or netCDF4/HDF5 file"""
+    with open(filepath, 'rb') as f:
+        signature = f.read(8)
+    if signature.startswith(b'CDF'):
+        return NetCDF3ToZarr(filepath, inline_threshold=0, max_chunk_size=0).translate()
+    elif signature == b'\x89HDF\r\n\x1a\n':
+        return SingleHdf5ToZarr(filepath, inline_threshold=0).translate()
+    raise ValueError(f'{filepath} is not a netCDF3 or netCDF4/HDF5 file ({signature=})')
+
+
+def _encoding_groups(reffiles):
+    """Return (start, stop) indices of consecutive equally encoded references"""
+    encodings = [_encoding(refs) for refs in reffiles]
+    starts = [0] + [i for i in range(1, len(encodings)) if encodings[i] != encodings[i-1]]
+    return list(zip(starts, starts[1:] + [len(encodings)]))
+
+
+def _encoding(refs):
+    """Return data type and codecs of all arrays in kerchunk references"""
+    keys = ['dtype', 'fill_value', 'compressor', 'filters']
+    return {key.removesuffix('/.zarray'): [json.loads(value).get(k) for k in keys]
+            for (key, value) in refs['refs'].items() if key.endswith('/.zarray')}
+
+
+def available_resources():
+    """Return number of available cores and available memory (bytes)
+
+    Available memory includes reclaimable page cache (MemAvailable in
+    /proc/meminfo, free pages only if it cannot be read). Uses SLURM job
+    allocations or cgroup limits where present.
+    """
+    ncpus = len(os.sched_getaffinity(0))
+    if 'SLURM_CPUS_PER_TASK' in os.environ:
+        ncpus = min(ncpus, int(os.environ['SLURM_CPUS_PER_TASK']))
+    memory = _mem_available()
+    if 'SLURM_MEM_PER_NODE' in os.environ: # MB
+        memory = min(memory, int(os.environ['SLURM_MEM_PER_NODE']) * 2**20)
+    elif 'SLURM_MEM_PER_CPU' in os.environ:
+        memory = min(memory, int(os.environ['SLURM_MEM_PER_CPU']) * 2**20 * ncpus)
+    for cgroup_file in ['/sys/fs/cgroup/memory.max', '/sys/fs/cgroup/memory/memory.limit_in_bytes']:
+        try:
+            with open(cgroup_file) as f:
+                limit = f.read().strip()
+        except OSError:
+            continue
+        if limit.isnumeric():
+            memory = min(memory, int(limit))
+        break
+    return ncpus, memory
+
+
+def _mem_available():
+    """Return available memory (bytes) including reclaimable page cache"""
+    try:
+        with open('/proc/meminfo') as f:
+            for line in f:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) * 2**10 # kB
+    except OSError:
+        pass
+    return os.sysconf('SC_AVPHYS_PAGES') * os.sysconf('SC_PAGE_SIZE')
+
+
+def _ncstore_name(filepaths, ncstore_format='json', variables=None, part=False,
+                  filehash=None):
+    """NC_STORE filename: name of first file with json/parq extension
+    
+    A hash of all file paths is added, such that selections that start at
+    the same file but cover different ranges have their own NC_STORE 
+    (files appended to a collection give a new name, the NC_STORE of the
+    shorter collection is extended and then removed, so a growing run
+    keeps one NC_STORE, see _previous_ncstore()). A hash of
+    the variable names is added for NC_STOREs of a subset of variables, 
+    and 'part' for NC_STOREs that are part of a mixed collection.
+    filehash replaces the hash of the file paths (e.g. a glob pattern).
+    """
+    if ncstore_format not in NCSTORE_EXTENSIONS:
+        raise ValueError(f'unknown ncstore_format {ncstore_format}, choose from {list(NCSTORE_EXTENSIONS)}')
+    fparts = os.path.basename(filepaths[0]).split('.')
+    fparts[-1] = NCSTORE_EXTENSIONS[ncstore_format] # extension
+    if variables is not None:
+        varhash = hashlib.sha1(','.join(sorted(variables)).encode()).hexdigest()[:8]
+        fparts.insert(-1, f'v{varhash}')
+    if filehash is None:
+        filehash = hashlib.sha1('\n'.join(filepaths).encode()).hexdigest()[:8]
+    fparts.insert(-1, f'f{filehash}')
+    if part:
+        fparts.insert(-1, 'part')
+    return '.'.join(fparts)
+
+
+def _previous_ncstore(ncstore_path, filepaths, manifest, ncstore_format='json', 
+                      variables=None, part=False):
+    """Return (path, manifest) of the NC_STORE with the longest manifest 
+    that is a prefix of manifest (the collection before files were 
+    appended), (None, None) if there is none"""
+    pattern = _ncstore_name([glob.escape(filepaths[0])], ncstore_format, variables, part, 
+                            filehash='[0-9a-f]'*8)
+    best, best_manifest = None, None
+    for path in glob.glob(os.path.join(glob.escape(os.path.dirname(ncstore_path)), pattern)):
+        if path == ncstore_path:
+            continue
+        old_manifest = _read_manifest(path)
+        if (old_manifest is None) or (_ncstore_parts(path) != [path]):
+            continue
+        if (manifest[:len(old_manifest)] == old_manifest) and \
+                (best_manifest is None or len(old_manifest) > len(best_manifest)):
+            best, best_manifest = path, old_manifest
+    return best, best_manifest
+
+
+def _file_key(filepath):
+    """Return [path, size, mtime] identifying the state of filepath"""
+    stat = os.stat(filepath)
+    return [filepath, stat.st_size, stat.st_mtime_ns]
+
+
+def _read_manifest(ncstore_path):
+    """Return manifest of existing NC_STORE, or None if there is none"""
+    manifest_path = f'{ncstore_path}.manifest'
+    parts = _ncstore_parts(ncstore_path)
+    if not (all(os.path.exists(path) for path in parts) and os.path.exists(manifest_path)):
+        return None
+    with open(manifest_path) as f:
+        return json.load(f)
+
+
+def _ncstore_parts(ncstore_path):
+    """Return paths of all NC_STOREs that make up ncstore_path"""
+    if not os.path.exists(f'{ncstore_path}.parts'):
+        return [ncstore_path]
+    with open(f'{ncstore_path}.parts') as f:
+        return json.load(f)
+
+
+def _update_ncstore(ncstore_path, manifest, old_manifest, reffiles, verbose, variables=None,
+                    old_path=None):
+    """(Re)write NC_STORE from the references of all files in manifest
+
+    old_manifest belongs to the existing NC_STORE old_path (default: 
+    ncstore_path), which is extended if it holds a prefix of manifest.
+    """
+    old_path = old_path or ncstore_path
+    if variables is not None:
+        reffiles = [_select_variables(refs, variables, manifest[0][0]) for refs in reffiles]
+    const_vars = _const_vars(reffiles[0])
+    nold = len(old_manifest) if old_manifest is not None else 0
+    # only JSON NC_STOREs can be extended, parquet is rebuilt from the cache
+    if (nold > 0) and (manifest[:nold] == old_manifest) and ncstore_path.endswith('.json'):
+        if verbose:
+            print(f"Appending {len(manifest)-nold} file(s) to combined kerchunk reference file {old_path}")
+        with open(old_path) as f:
+            reffiles = [json.load(f)] + reffiles[nold:]
+    if (nold > 0) and (old_path != ncstore_path) and os.path.exists(f'{old_path}.ctime') \
+            and not os.path.exists(f'{ncstore_path}.ctime'):
+        shutil.copyfile(f'{old_path}.ctime', f'{ncstore_path}.ctime') # extended by _center_time
     mzz = MultiZarrToZarr(reffiles, concat_dims=['time'], identical_dims=const_vars) #coo_map={'time':'cf:time'})
     
-    # write NC_STORE data and return opened dataset
-    with open(f"{ncstore_path}", "wb") as f:
+    # write NC_STORE data and its manifest
+    if verbose:
+        print(f"Writing combined kerchunk reference file {ncstore_path}")
+    _write_ncstore(ncstore_path, mzz.translate())
+    with open(f"{ncstore_path}.manifest", "w") as f:
+        json.dump(manifest, f)
+
+
+def _remove_ncstore(ncstore_path, verbose=True):
+    """Remove NC_STORE (file or parquet directory) and its manifest, parts and ctime files"""
+    if verbose:
+        print(f"Removing superseded combined kerchunk reference file {ncstore_path}")
+    if os.path.isdir(ncstore_path):
+        shutil.rmtree(ncstore_path, ignore_errors=True)
+    for path in [ncstore_path] + [f'{ncstore_path}{suffix}' for suffix in NCSTORE_SIDECARS]:
+        try:
+            os.remove(path)
+        except (FileNotFoundError, IsADirectoryError):
+            pass
+
+
+def _write_ncstore(ncstore_path, refs):
+    """Write references to json file or parquet directory (by extension)"""
+    if ncstore_path.endswith('.parq'):
+        from kerchunk.df import refs_to_dataframe # requires fastparquet
+        if os.path.exists(ncstore_path):
+            shutil.rmtree(ncstore_path)
+        refs_to_dataframe(refs, ncstore_path)
+    else:
+        with open(f"{ncstore_path}", "wb") as f:
+            f.write(json.dumps(refs).encode())
+
+
+def convert_ncstores(ncstore_dir: str='~/kerchunk', remove=False, verbose=True):
+    """Convert all JSON NC_STOREs in ncstore_dir to parquet NC_STOREs
+
+    Parameters:
+    ncstore_dir: Pathlike
+        Path where NC_STORE reference files are saved
+    remove: Bool
+        Whether to remove the JSON NC_STOREs after conversion
+    verbose: Bool
+        Whether to print NC_STORE reference file names when converting
+
+    Returns: list[str]
+        paths of the new parquet NC_STOREs
+    """
+    ncstore_dir = os.path.expanduser(ncstore_dir)
+    converted = []
+    for json_path in sorted(glob.glob(os.path.join(ncstore_dir, '*.json'))):
+        parq_path = json_path.removesuffix('.json') + '.parq'
         if verbose:
-            print(f"Writing combined kerchunk reference file {ncstore_path}")
-        f.write(json.dumps(mzz.translate()).encode())
+            print(f"Converting {json_path} -> {parq_path}")
+        with open(json_path) as f:
+            _write_ncstore(parq_path, json.load(f))
+        if os.path.exists(f'{json_path}.manifest'):
+            shutil.copyfile(f'{json_path}.manifest', f'{parq_path}.manifest')
+        if os.path.exists(f'{json_path}.parts'):
+            with open(f'{parq_path}.parts', 'w') as f:
+                json.dump([path.removesuffix('.json') + '.parq' 
+                           for path in _ncstore_parts(json_path)], f)
+        if remove:
+            os.remove(json_path)
+            for suffix in ['.manifest', '.parts']:
+                if os.path.exists(f'{json_path}{suffix}'):
+                    os.remove(f'{json_path}{suffix}')
+        converted.append(parq_path)
+    return converted
 
-    # set default keyword arguments for xr.open_dataset on NC_STORE file
-    required_kw = {'engine':'kerchunk', 'storage_options':{'target_protocol':'file'}}
-    for (k,v) in required_kw.items():
-        if k in kwargs:
-            print(f'open_mfdataset(): ignoring keyword {k}')
-    kwargs = kwargs | required_kw
+
+def _select_variables(refs, variables, filepath=''):
+    """Return kerchunk references restricted to variables
+    
+    Variables without time dimension, time and its bounds are kept.
+    """
+    refvars = {key.split('/')[0] for key in refs['refs'] if '/' in key}
+    missing = set(variables) - refvars
+    if missing:
+        raise ValueError(f'variables {sorted(missing)} not in {filepath}')
+    keep = set(variables) | set(_const_vars(refs)) | {'time'}
+    if 'time/.zattrs' in refs['refs']:
+        keep.add(json.loads(refs['refs']['time/.zattrs']).get('bounds'))
+    refs = refs | {'refs': {key:value for (key,value) in refs['refs'].items() 
+                            if ('/' not in key) or (key.split('/')[0] in keep)}}
+    return refs
+
+
+def _const_vars(refs):
+    """Return variables in a kerchunk reference set without time dimension"""
+    const_vars = []
+    for key, value in refs['refs'].items():
+        if key.endswith('/.zattrs'):
+            dims = json.loads(value).get('_ARRAY_DIMENSIONS', [])
+            if 'time' not in dims:
+                const_vars.append(key.removesuffix('/.zattrs'))
+    return const_vars
+
+
+def _file_references(manifest, ncstore_dir, verbose, max_workers=None, memory_limit=None):
+    """Return kerchunk references of all files in manifest
+    
+    References are read from the cache in {ncstore_dir}/files if the
+    size and modification time of the file did not change, and created
+    with build_references() (and cached) otherwise.
+    """
+    cachepaths = [_reference_cache_path(key[0], ncstore_dir) for key in manifest]
+    reffiles = [None] * len(manifest)
+    missing = []
+    for i, (key, cachepath) in enumerate(zip(manifest, cachepaths)):
+        if os.path.exists(cachepath):
+            with open(cachepath) as f:
+                entry = json.load(f)
+            if [entry['path'], entry['size'], entry['mtime']] == key:
+                reffiles[i] = entry['refs']
+                continue
+        missing.append(i)
+    if len(missing) == 0:
+        return reffiles
+    if verbose:
+        print(f"{len(missing)} of {len(manifest)} files are new or changed")
+
+    def cache(j, refs): # store references as soon as a file is completed
+        i = missing[j]
+        reffiles[i] = refs
+        path, size, mtime = manifest[i]
+        with open(cachepaths[i], 'w') as f:
+            json.dump({'path':path, 'size':size, 'mtime':mtime, 'refs':refs}, f)
+
+    build_references([manifest[i][0] for i in missing], max_workers, memory_limit, 
+                     verbose=verbose, callback=cache)
+    return reffiles
+
+
+def _reference_cache_path(filepath, ncstore_dir):
+    """Per-file reference cache, unique for each absolute filepath"""
+    pathhash = hashlib.sha1(filepath.encode()).hexdigest()[:10]
+    fname = os.path.basename(filepath).removesuffix('.nc')
+    return os.path.join(ncstore_dir, 'files', f'{fname}.{pathhash}.json')
+
+
+def _connect_catalog(path):
+    """Open (and if needed create) the SQLite file catalog at path"""
+    path = os.path.expanduser(path)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    con = sqlite3.connect(path, timeout=60)
+    con.executescript("""
+        CREATE TABLE IF NOT EXISTS dirs (
+            path TEXT PRIMARY KEY, mtime INTEGER, subdirs TEXT);
+        CREATE TABLE IF NOT EXISTS files (
+            path TEXT PRIMARY KEY, dir TEXT, casedir TEXT, comp TEXT, stream TEXT,
+            tstart TEXT, tend TEXT, size INTEGER, mtime INTEGER);
+        CREATE INDEX IF NOT EXISTS files_stream ON files (casedir, comp, stream);
+        CREATE INDEX IF NOT EXISTS files_dir ON files (dir);
+        CREATE TABLE IF NOT EXISTS periods (
+            path TEXT, period TEXT, size INTEGER, mtime INTEGER, segments TEXT,
+            PRIMARY KEY (path, period));
+    """)
+    return con
+
+
+def _date_key(date, end=False):
+    """Return sortable (year, month, day, second) of 'YYYY[-MM[-DD[-SSSSS]]]'
     
-    return xr.open_dataset(ncstore_path, **kwargs)
+    Missing parts are set to the start of the period, or to its end if
+    end is True, such that '2073' compares as the end of 2073.
+    """
+    parts = [int(part) for part in str(date).split('-')]
+    fill = (9999, 12, 31, 86400) if end else (0, 1, 1, 0)
+    return tuple(parts + list(fill[len(parts):]))
+
+
+def _filename_date(fname):
+    """Return start date 'YYYY[-MM[-DD[-SSSSS]]]' in CESM filename, or None"""
+    match = re.search('[0-9]{4}(-[0-9]{2}){0,2}(-[0-9]{5})?$', 
+                      os.path.basename(fname).removesuffix('.nc'))
+    return match.group() if match else None
 
 
 class Cases:
@@ -86,12 +651,17 @@ class Cases:
     Class methods:
         select(comp, stream): select a specific model component and file stream
         open_mfdataset: open files with load_SAIdata.open_mfdataset (run after select()!)
+        open_ensemble(pattern, comp, stream): open all cases matching pattern at once
     
     Class data:
         cases: mapping from case tags to absolute case directories
         comps: mapping from CESM component names to their module names
         files: before select(): dict of all netCDF files in case directory
                after select(): list of all netCDF files in selection
+        catalog: SQLite file catalog, one row per netCDF file with model
+               component, file stream, start date, size and mtime. It is
+               refreshed for directories whose mtime changed, such that
+               the case directories are not walked on every construction.
     
     Examples:
     Easy opening of datasets:
@@ -107,9 +677,13 @@ class Cases:
         >> print(mydata)         # check time info from first file
         >> print(mydata.files)   # check files before opening 
         >> mydata.open_mfdataset() #
+
+    Opening all members of an ensemble along a new 'ensemble' dimension:
+        >> ds = Cases.open_ensemble('hres.sai.*', 'atm', 'h0')
     '''
 
     # general info and case overview
+    catalog = CATALOG
     comps = {'atm':'cam2','ocn':'pop','lnd':'clm2','ice':'cice', 'strataero':'strataero', 'volcaero':'volcaero'} # model components
     DIR1 = '/projects/0/prace_imau/prace_2013081679/cesm1_0_4' # root directory SAI
     DIR2 = '/projects/0/nwo2021025/archive' # root directory control
@@ -140,8 +714,12 @@ class Cases:
     }
 
     
-    def __init__(self, tag):
-        '''Initialize a specific case, identified by its tag.'''
+    def __init__(self, tag, refresh=True):
+        '''Initialize a specific case, identified by its tag.
+        
+        Set refresh=False to skip checking the case directories for 
+        changes and only query the file catalog.
+        '''
         self.tag = tag          # tag, e.g. hres.sai.1
         self.directory = self.cases[tag] # casedirectory
         if not os.path.isdir(self.directory):
@@ -149,7 +727,8 @@ class Cases:
         self.name = os.path.basename(self.directory.rstrip('/OUTPUT'))  # casename
         self.model_component = None
         self.file_stream = None
-        self.files = self._group_ncFiles()
+        self.variables = None
+        self.files = self._group_ncFiles(refresh)
 
 
     def __repr__(self):
@@ -169,20 +748,82 @@ class Cases:
         return msg
 
 
-    def select(self, comp, stream):
-        '''Select model component and output stream'''
+    def select(self, comp, stream, time=None, variables=None):
+        '''Select model component and output stream
+        
+        time: slice or str
+            time range, e.g. slice('2063','2073') or '2063'. Files are 
+            selected by the dates in their filenames, both ends inclusive.
+            Files partly overlapping the range are included, so use 
+            Dataset.sel(time=...) after opening for exact selection.
+        variables: list[str]
+            time dependent variables to include in open_mfdataset()
+        '''
         self.model_component = comp
         self.file_stream = stream
         self.files = self.files[comp][stream]
+        self.variables = variables
+        if time is not None:
+            if not isinstance(time, slice):
+                time = slice(time, time)
+            self.files = self._select_time(time.start, time.stop)
         return self
 
 
     def open_mfdataset(self, *args, **kwargs):
         '''Open netCDF files, wrapper for load_SAIdata.open_mfdataset'''
         assert isinstance(self.files, list), 'attempted to open dataset without selecting a model component and file stream'
+        kwargs.setdefault('variables', self.variables)
         return open_mfdataset(self.files, *args, **kwargs)
 
 
+    @classmethod
+    def open_ensemble(cls, pattern, comp, stream, time=None, variables=None, 
+                      max_workers=None, **kwargs):
+        '''Open a model component and stream of all cases matching pattern
+        
+        The reference stores of all members are built in parallel, after
+        which the members are concatenated along a new dimension 'ensemble'
+        (labeled by case tag). Variables without time dimension, such as 
+        coordinates, gw and hybrid coefficients, are taken from the first
+        member. Members with fewer time steps are padded with NaN.
+
+        pattern: str
+            shell-style wildcard pattern of case tags, e.g. 'hres.sai.*'
+        comp, stream, time, variables:
+            model component, file stream, time range and variables, 
+            see Cases.select()
+        max_workers: int
+            maximum number of members opened simultaneously, the available
+            cores and memory for building references are divided among them
+        kwargs: dict
+            passed on to load_SAIdata.open_mfdataset
+        '''
+        tags = sorted(fnmatch.filter(cls.cases, pattern))
+        if len(tags) == 0:
+            raise ValueError(f'no case tags match {pattern}, choose from {list(cls.cases)}')
+        kwargs.setdefault('chunks', {}) # lazy dask arrays for all members
+        nopen = min(max_workers or len(tags), len(tags))
+        ncpus, memory = available_resources()
+        kwargs['max_workers'] = max(1, ncpus // nopen)
+        kwargs['memory_limit'] = (kwargs.get('memory_limit') or memory) // nopen
+        open_member = lambda tag: (cls(tag).select(comp, stream, time, variables)
+                                   .open_mfdataset(**kwargs))
+        with ThreadPoolExecutor(nopen) as pool:
+            datasets = list(pool.map(open_member, tags))
+
+        # time bounds are shared by all members, take them from the longest
+        longest = max(datasets, key=lambda ds: ds.sizes.get('time', 0))
+        bounds = longest.time.attrs.get('bounds', longest.time.encoding.get('bounds'))
+        tvars = [v for v in longest.data_vars if ('time' in longest[v].dims) and (v != bounds)]
+        ensemble = xr.DataArray(tags, dims='ensemble', name='ensemble')
+        ds = xr.concat(datasets, dim=ensemble, data_vars=tvars, coords='minimal',
+                       compat='override', join='outer', combine_attrs='drop_conflicts')
+        if bounds in longest:
+            ds[bounds] = longest[bounds]
+        return ds
+
+
     def _nc_info(self):
         '''Open a netCDF file and return some basic info'''
         try:
@@ -199,34 +840,97 @@ class Cases:
         return msg
 
 
-    def _group_ncFiles(self):
+    def _group_ncFiles(self, refresh=True):
         '''Find all netCDF files and group by model component and file stream.'''
         result = {comp:{} for comp in self.comps.keys()}
-        for comp in self.comps:
-            ncFiles = [os.path.join(root,file) 
-                for root,dirs,files in os.walk(top=os.path.join(self.directory,comp)) 
-                for file in files if file.endswith('.nc')]
-            for file in ncFiles:
-                stream = self._process_filename(file)
-                if stream is None:
-                    continue
-                if (stream not in result[comp]) and (stream[0] in ['f','h']): # filter restarts/initial files
-                    result[comp][stream] = [file]
-                elif (stream in result[comp]):
-                    result[comp][stream].append(file)
+        with _connect_catalog(self.catalog) as con:
+            if refresh:
+                self._refresh_catalog(con)
+            rows = con.execute(
+                'SELECT comp, stream, path FROM files WHERE casedir=? ORDER BY comp, stream, path',
+                (self.directory,))
+            for comp, stream, path in rows:
+                result[comp].setdefault(stream, []).append(path)
+        con.close()
         for comp in result:
             result[comp] = dict(sorted(result[comp].items())) # sort streams
-            for stream in result[comp]:
-                result[comp][stream] = np.sort(result[comp][stream]).tolist() # sort files
         
         return result
 
 
+    def _refresh_catalog(self, con):
+        '''Update catalog rows of all directories whose mtime changed'''
+        stack = [(os.path.join(self.directory, comp), comp) for comp in self.comps]
+        changed = False
+        while stack:
+            dirpath, comp = stack.pop()
+            row = con.execute('SELECT mtime, subdirs FROM dirs WHERE path=?', (dirpath,)).fetchone()
+            try:
+                mtime = os.stat(dirpath).st_mtime_ns
+            except FileNotFoundError:
+                if row is not None: # directory was removed
+                    con.execute('DELETE FROM files WHERE dir=?', (dirpath,))
+                    con.execute('DELETE FROM dirs WHERE path=?', (dirpath,))
+                    stack.extend((d, comp) for d in json.loads(row[1]))
+                    changed = True
+                continue
+            if (row is not None) and (row[0] == mtime):
+                stack.extend((d, comp) for d in json.loads(row[1]))
+                continue
+            subdirs, entries = [], []
+            with os.scandir(dirpath) as it:
+                for entry in it:
+                    if entry.is_dir():
+                        subdirs.append(entry.path)
+                    elif entry.name.endswith('.nc'):
+                        stream = self._process_filename(entry.path)
+                        if (stream is None) or (stream[0] not in ['f','h']): # filter restarts/initial files
+                            continue
+                        stat = entry.stat()
+                        entries.append((entry.path, dirpath, self.directory, comp, stream,
+                                        _filename_date(entry.path), stat.st_size, stat.st_mtime_ns))
+            con.execute('DELETE FROM files WHERE dir=?', (dirpath,))
+            con.executemany('INSERT OR REPLACE INTO files VALUES (?,?,?,?,?,?,NULL,?,?)', entries)
+            con.execute('INSERT OR REPLACE INTO dirs VALUES (?,?,?)', (dirpath, mtime, json.dumps(subdirs)))
+            removed = set(json.loads(row[1])) - set(subdirs) if row is not None else set()
+            stack.extend((d, comp) for d in subdirs + sorted(removed))
+            changed = True
+        if changed: # end of each file is the start of the next file in its stream
+            con.execute('''UPDATE files SET tend = (
+                SELECT tnext FROM (
+                    SELECT path, LEAD(tstart) OVER (PARTITION BY comp, stream ORDER BY path) AS tnext
+                    FROM files WHERE casedir=:casedir) AS nxt
+                WHERE nxt.path = files.path) 
+                WHERE casedir=:casedir''', {'casedir':self.directory})
+
+
+    def _select_time(self, start, stop):
+        '''Return selected files overlapping with [start, stop]
+        
+        Each file spans from the date in its filename up to the date of
+        the next file in the stream (according to the catalog).
+        '''
+        with _connect_catalog(self.catalog) as con:
+            dates = dict(((path, (tstart, tend)) for (path, tstart, tend) in con.execute(
+                'SELECT path, tstart, tend FROM files WHERE casedir=? AND comp=? AND stream=?',
+                (self.directory, self.model_component, self.file_stream))))
+        con.close()
+        selection = []
+        for file in self.files:
+            tstart, tend = dates.get(file, (None, None))
+            if (stop is not None) and (tstart is not None) and (_date_key(tstart) > _date_key(stop, end=True)):
+                continue
+            if (start is not None) and (tend is not None) and (_date_key(tend) <= _date_key(start)):
+                continue
+            selection.append(file)
+        return selection
+
+
     def _process_filename(self, fname):
         '''Read filename "fname" and return model component and file stream.'''
         if ('volcaero' in fname) or ('strataero' in fname):
             if '/copy/' in fname:
-                return None, None
+                return None
             stream = fname.removesuffix('.nc').split('_')[-1].removeprefix('CAM')
             if re.match('^feedback-[0-9]{4}$', stream): # group yearly files
                 stream = 'feedback-YYYY'
@@ -236,7 +940,7 @@ class Cases:
         try:
             imod = [(m in parts) for m in mods].index(True)
         except ValueError:
-            return None, None
+            return None
         is0 = parts.index(mods[imod]) + 1 # stream starts right after model component
         for is1 in range(is0,len(parts)): # some filenames have multiple stream parts, e.g. (pop).h.nday1
             if parts[is1][0].isnumeric():
@@ -265,4 +969,47 @@ class Cases:
             print(self.files[0].removeprefix(self.directory))
             if len(self.files)>1:
                 print(f'...\n{self.files[-1].removeprefix(self.directory)}')
-            os.system(f'tree {self.directory}/{self.model_component}')
\ No newline at end of file
+            os.system(f'tree {self.directory}/{self.model_component}')
+
+
+def main():
+    """Command line interface, run with -h for help"""
+    parser = argparse.ArgumentParser(
+        prog='python -m sai.scripts.load_SAIdata',
+        description='Prebuild and convert kerchunk NC_STOREs of CESM cases')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    index = subparsers.add_parser('index', help='create NC_STOREs of all streams of case(s)')
+    index.add_argument('tag', help='case tag, may contain wildcards (e.g. "hres.sai.*")')
+    index.add_argument('--comp', nargs='*', help='model component(s) (default: all)')
+    index.add_argument('--stream', nargs='*', help='file stream(s) (default: all)')
+    index.add_argument('-j', '--max-workers', type=int, help='number of processes')
+    index.add_argument('--memory', type=float, help='memory limit in GB')
+    index.add_argument('--format', default='json', choices=list(NCSTORE_EXTENSIONS), 
+                       help='NC_STORE format')
+    index.add_argument('--ncstore-dir', default='~/kerchunk', help='NC_STORE directory')
+    convert = subparsers.add_parser('convert', help='convert JSON NC_STOREs to parquet')
+    convert.add_argument('--ncstore-dir', default='~/kerchunk', help='NC_STORE directory')
+    convert.add_argument('--remove', action='store_true', help='remove JSON NC_STOREs')
+    args = parser.parse_args()
+
+    if args.command == 'convert':
+        convert_ncstores(args.ncstore_dir, remove=args.remove)
+        return
+    tags = sorted(fnmatch.filter(Cases.cases, args.tag))
+    if len(tags) == 0:
+        parser.error(f'no case tags match {args.tag}, choose from {list(Cases.cases)}')
+    memory_limit = int(args.memory * 2**30) if args.memory else None
+    for tag in tags:
+        case = Cases(tag)
+        for comp in (args.comp or case.files):
+            for stream in (args.stream or case.files[comp]):
+                files = case.files[comp].get(stream, [])
+                if len(files) < 2: # single files are opened directly
+                    continue
+                print(f"{tag} {comp} {stream}: {len(files)} files", flush=True)
+                build_ncstore(files, args.ncstore_dir, True, args.format, 
+                              max_workers=args.max_workers, memory_limit=memory_limit)
+
+
+if __name__ == '__main__':
+    main()
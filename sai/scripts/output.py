@@ -0,0 +1,166 @@
+#!/usr/bin/env python3
+# *_* coding: utf-8 *_*
+
+"""Write diagnostics to netCDF or to a chunked, compressed Zarr store
+
+netCDF output is written by a single writer behind the HDF5 lock. With
+output_format='zarr' each dask chunk is a separate (compressed) Zarr
+chunk, so all tasks write their own region in parallel, and later runs
+can append new time steps to the same store:
+
+    >> write_output(ds, 'out.zarr', 'zarr')               # new store
+    >> write_output(ds_next, 'out.zarr', 'zarr', append=True)
+
+Time steps that are already in the store are skipped when appending.
+The scripts add the options --format and --append with
+add_output_arguments(parser). Export a store to netCDF for downstream
+tools with
+    >> python output.py [-v] store.zarr outfile.nc
+"""
+
+import os
+import argparse
+import logging
+
+import numpy as np
+import xarray as xr
+
+OUTPUT_FORMATS = ('netcdf', 'zarr')
+APPEND_DIM = 'time' # dimension along which stores are extended
+ZARR_CHUNK_BYTES = 2**24 # target size (bytes, uncompressed) of Zarr chunks
+ZARR_COMPRESSION = {'cname': 'zstd', 'clevel': 5} # Blosc compression
+STORAGE_ENCODING = ['chunks', 'preferred_chunks', 'chunksizes', 'compressor', 'compressors',
+                    'filters', 'serializer', 'zlib', 'complevel', 'shuffle', 'contiguous']
+
+
+def write_output(ds, outfile, output_format='netcdf', append=False):
+    """Write ds to outfile as netCDF or Zarr store
+
+    Input:
+    ds : dataset to write (lazy dask arrays are computed while writing)
+    outfile : netCDF file or Zarr store (directory)
+    output_format : 'netcdf' or 'zarr'
+    append : append time steps to an existing Zarr store (if it exists)
+    """
+    if output_format not in OUTPUT_FORMATS:
+        raise ValueError(f'unknown output format {output_format}, choose from {OUTPUT_FORMATS}')
+    if output_format == 'netcdf':
+        if append:
+            raise ValueError('appending is only supported for Zarr stores')
+        ds.to_netcdf(outfile)
+    elif append and os.path.exists(outfile):
+        _append_zarr(ds, outfile)
+    else:
+        logging.info(f"writing Zarr store {outfile}")
+        ds = _zarr_chunks(_drop_storage_encoding(ds))
+        ds.to_zarr(outfile, mode='w-', encoding=_zarr_encoding(ds))
+
+
+def _append_zarr(ds, store):
+    """Append time steps of ds after the last time step in store"""
+    decoded = not np.issubdtype(ds[APPEND_DIM].dtype, np.number) # as in ds
+    with xr.open_zarr(store, decode_times=decoded) as old:
+        if (not decoded) and (old[APPEND_DIM].attrs.get('units') != ds[APPEND_DIM].attrs.get('units')):
+            raise ValueError(f"units of {APPEND_DIM} differ from {store}: "
+                             f"{ds[APPEND_DIM].attrs.get('units')}, {old[APPEND_DIM].attrs.get('units')}")
+        nold = old.sizes[APPEND_DIM]
+        new = ds[APPEND_DIM] > old[APPEND_DIM][-1].item()
+        zchunk = _first_chunk(old)
+    if not new.all():
+        logging.warning(f"skipping {int((~new).sum())} time step(s) already in {store}")
+    ds = ds.isel({APPEND_DIM: new.values})
+    if ds.sizes[APPEND_DIM] == 0:
+        logging.warning(f"no new time steps to append to {store}")
+        return
+    # fill the partial last chunk of the store first, such that tasks
+    # never write to the same Zarr chunk
+    chunks, size, remaining = [], (zchunk - nold % zchunk) or zchunk, ds.sizes[APPEND_DIM]
+    while remaining > 0:
+        chunks.append(min(size, remaining))
+        remaining, size = remaining - chunks[-1], zchunk
+    logging.info(f"appending {sum(chunks)} time step(s) to {store}")
+    ds = ds.drop_vars([v for v in ds.variables if APPEND_DIM not in ds[v].dims])
+    ds = _drop_storage_encoding(ds).chunk({APPEND_DIM: tuple(chunks)})
+    ds.to_zarr(store, append_dim=APPEND_DIM)
+
+
+def _first_chunk(ds):
+    """Return Zarr chunk size along APPEND_DIM of variables in ds"""
+    for v in ds.data_vars:
+        if APPEND_DIM in ds[v].dims and ds[v].encoding.get('chunks'):
+            return ds[v].encoding['chunks'][ds[v].dims.index(APPEND_DIM)]
+    return 1
+
+
+def _zarr_chunks(ds):
+    """Chunk ds along APPEND_DIM, ZARR_CHUNK_BYTES per chunk of the largest variable"""
+    if APPEND_DIM not in ds.dims:
+        return ds.chunk()
+    step_bytes = max([ds[v].dtype.itemsize * ds[v].size // ds.sizes[APPEND_DIM]
+                      for v in ds.data_vars if APPEND_DIM in ds[v].dims] or [1])
+    nt = int(min(ds.sizes[APPEND_DIM], max(1, ZARR_CHUNK_BYTES // step_bytes)))
+    return ds.chunk({dim: (nt if dim == APPEND_DIM else -1) for dim in ds.dims})
+
+
+def _zarr_encoding(ds):
+    """Return Blosc compression encoding of all numeric variables"""
+    import zarr
+    if int(zarr.__version__.split('.')[0]) >= 3:
+        codec = {'compressors': (zarr.codecs.BloscCodec(**ZARR_COMPRESSION, shuffle='bitshuffle'),)}
+    else:
+        from numcodecs import Blosc
+        codec = {'compressor': Blosc(**ZARR_COMPRESSION, shuffle=Blosc.BITSHUFFLE)}
+    return {v: dict(codec) for v in ds.variables if np.issubdtype(ds[v].dtype, np.number)}
+
+
+def _drop_storage_encoding(ds):
+    """Return copy of ds without chunking/compression encoding of its source"""
+    ds = ds.copy()
+    for v in ds.variables:
+        ds[v].encoding = {k: val for (k, val) in ds[v].encoding.items()
+                          if k not in STORAGE_ENCODING}
+    return ds
+
+
+def export_netcdf(store, outfile):
+    """Export Zarr store to netCDF outfile"""
+    with xr.open_zarr(store) as ds:
+        _drop_storage_encoding(ds).to_netcdf(outfile)
+
+
+def add_output_arguments(parser):
+    """Add the options --format and --append to parser"""
+    parser.add_argument('--format', dest='output_format', choices=OUTPUT_FORMATS,
+                        default='netcdf', help='output format (default: netcdf)')
+    parser.add_argument('--append', action='store_true',
+                        help='append new time steps to an existing Zarr store')
+
+
+def check_outfile(args):
+    """Raise error if args.outfile exists, unless appending to a Zarr store"""
+    if os.path.exists(args.outfile) and not (args.append and args.output_format == 'zarr'):
+        raise ValueError(f'output file {args.outfile} already exists.')
+    if args.append and args.output_format != 'zarr':
+        raise ValueError('--append requires --format zarr')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Export a Zarr store to netCDF')
+    parser.add_argument('store', help='Zarr store')
+    parser.add_argument('outfile', help='netCDF output file')
+    parser.add_argument('-v', '--verbose', help='modify output verbosity',
+                        action='store_true')
+    args = parser.parse_args()
+    logging.basicConfig(
+        level=logging.INFO if args.verbose else logging.WARNING,
+        format="%(asctime)s %(levelname)s: %(message)s",
+        datefmt="%d-%m-%Y %H:%M:%S"
+    )
+    if os.path.exists(args.outfile):
+        raise ValueError(f'output file {args.outfile} already exists.')
+    logging.info(f"exporting {args.store} to {args.outfile}")
+    export_netcdf(args.store, args.outfile)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,137 @@
+#!/usr/bin/env python3
+# *_* coding: utf-8 *_*
+
+"""Area weighted means over many regions at once
+
+Regions are given as a table {name: region}, where a region is either a
+box {'lat': slice(south, north), 'lon': slice(west, east)} (inclusive,
+boxes with west > east cross the zero meridian) or a boolean DataArray
+mask on the horizontal grid. The normalised area weights of all regions
+are precomputed once as a sparse (region x gridcell) matrix, after which
+the region means of all variables follow from a single sparse matrix
+product per chunk:
+
+    >> regions = {'NA': {'lat': slice(5,20), 'lon': slice(275,345)},
+    >>            'TROP': {'lat': slice(-30,30)}}
+    >> rm = region_means(ds, regions, ['TREFHT','PRECL','PRECC'])
+    >> rm.TREFHT.sel(region='NA')
+"""
+
+import numpy as np
+import scipy.sparse
+import xarray as xr
+
+GRID_WEIGHTS = {('lat','lon'): 'gw', ('ncol',): 'area'} # cell weights per grid
+
+
+def horizontal_dims(ds):
+    """Return horizontal dimensions of ds, ('lat','lon') or ('ncol',)"""
+    for hdims in GRID_WEIGHTS:
+        if all(dim in ds.dims for dim in hdims):
+            return hdims
+    raise ValueError(f'no horizontal grid {list(GRID_WEIGHTS)} in {dict(ds.sizes)}')
+
+
+def region_mask(ds, region, hdims=None):
+    """Return boolean mask (DataArray on hdims) of a box or mask region"""
+    hdims = horizontal_dims(ds) if hdims is None else hdims
+    template = xr.DataArray(np.ones([ds.sizes[dim] for dim in hdims], dtype=bool), dims=hdims)
+    if isinstance(region, xr.DataArray):
+        return (region.reset_coords(drop=True).astype(bool) & template).transpose(*hdims)
+    mask = template
+    for (coord, bounds) in region.items():
+        c = ds[coord].reset_coords(drop=True)
+        lower = True if bounds.start is None else (c >= bounds.start)
+        upper = True if bounds.stop is None else (c <= bounds.stop)
+        if (coord == 'lon') and (None not in (bounds.start, bounds.stop)) \
+                and (bounds.start > bounds.stop):
+            mask = mask & (lower | upper) # crosses zero meridian
+        else:
+            mask = mask & lower & upper
+    return mask.drop_vars(hdims, errors='ignore').transpose(*hdims)
+
+
+def region_matrix(ds, regions, weights=None):
+    """Return sparse (region x gridcell) matrix of normalised area weights
+
+    Input:
+    ds : dataset on a ('lat','lon') or ('ncol',) grid
+    regions : {name: box or mask}, see module docstring
+    weights : cell weights (default: gw or area of ds), broadcast to the
+        horizontal grid
+
+    Rows sum to one, columns are the flattened horizontal grid cells.
+    """
+    hdims = horizontal_dims(ds)
+    if weights is None:
+        weights = ds[GRID_WEIGHTS[hdims]]
+    weights = weights.reset_coords(drop=True).drop_vars(hdims, errors='ignore')
+    weights = weights.isel({d: 0 for d in weights.dims if d not in hdims}) # time dependent copies
+    template = xr.DataArray(np.ones([ds.sizes[dim] for dim in hdims]), dims=hdims)
+    w = (weights * template).transpose(*hdims).values.ravel()
+    rows, cols, data = [], [], []
+    for (i, region) in enumerate(regions.values()):
+        cells = np.flatnonzero(region_mask(ds, region, hdims).values.ravel())
+        if len(cells) == 0:
+            raise ValueError(f'region {list(regions)[i]} contains no grid cells')
+        rows.append(np.full(len(cells), i))
+        cols.append(cells)
+        data.append(w[cells] / w[cells].sum())
+    return scipy.sparse.csr_matrix(
+        (np.concatenate(data), (np.concatenate(rows), np.concatenate(cols))),
+        shape=(len(regions), w.size))
+
+
+def region_means(ds, regions, variables=None, matrix=None, skipna=True, keep_attrs=True):
+    """Area weighted means of variables over all regions
+
+    Input:
+    ds : dataset on a ('lat','lon') or ('ncol',) grid
+    regions : {name: box or mask}, see module docstring
+    variables : names of variables to average (default: all with the
+        horizontal dimensions, except the weights)
+    matrix : precomputed region_matrix(ds, regions), e.g. to use other
+        weights or to reuse it for many datasets on the same grid
+    skipna : ignore missing values, the weights are renormalised per
+        region and point in time/level
+    keep_attrs : keep variable attributes
+
+    Variables with equal dimensions are stacked, such that each chunk of
+    data is reduced for all of them and all regions by one sparse matrix
+    product. Returns a dataset with a new dimension region.
+    """
+    hdims = horizontal_dims(ds)
+    if matrix is None:
+        matrix = region_matrix(ds, regions)
+    if variables is None:
+        variables = [v for v in ds.data_vars if set(hdims).issubset(ds[v].dims)
+                     and v not in GRID_WEIGHTS.values()]
+    groups = {}
+    for v in variables:
+        groups.setdefault(ds[v].dims, []).append(v)
+
+    def _matmul(data):
+        shape = data.shape[:-len(hdims)]
+        data = data.reshape(-1, matrix.shape[1])
+        if skipna:
+            valid = ~np.isnan(data)
+            result = (matrix @ np.where(valid, data, 0).T) / (matrix @ valid.T)
+        else:
+            result = matrix @ data.T
+        return np.asarray(result).T.reshape(*shape, matrix.shape[0])
+
+    dsm = {}
+    for (dims, group) in groups.items():
+        da = xr.concat([ds[v].reset_coords(drop=True) for v in group], 'variable',
+                       coords='minimal', compat='override', join='override')
+        if da.chunks is not None:
+            da = da.chunk({'variable': -1} | {dim: -1 for dim in hdims})
+        dam = xr.apply_ufunc(_matmul, da, input_core_dims=[hdims],
+                             output_core_dims=[['region']], dask='parallelized',
+                             output_dtypes=[np.result_type(da.dtype, np.float64)],
+                             dask_gufunc_kwargs={'output_sizes': {'region': matrix.shape[0]}})
+        for (i, v) in enumerate(group):
+            dsm[v] = dam.isel(variable=i, drop=True)
+            if keep_attrs:
+                dsm[v].attrs = ds[v].attrs
+    return xr.Dataset(dsm).assign_coords(region=list(regions))
@@ -1,66 +1,73 @@
 #!/usr/bin/env python3
 # *_* coding: utf-8 *_*
 
+import os
+import sys
+import argparse
+from time import perf_counter
+t0 = perf_counter()
+import numpy as np
+import xarray as xr
+import dask
+from dask.distributed import Client
 
-def main():
-    # read script arguments 
-    parser = argparse.ArgumentParser(
-        description='Calculate temperature gradients T0, T1 and T2 time series as in GLENS')
-    parser.add_argument('infiles', nargs='+', help='input netCDF files')
-    parser.add_argument('outfile', help='output netCDF file')
-    args = parser.parse_args()
-    if os.path.exists(args.outfile):
-        raise ValueError(f'output file {args.outfile} already exists.')
-    
-    # open dataset and set time to center of time_bnds
-    ds = xr.open_mfdataset(args.infiles, data_vars="minimal", coords="minimal", 
-    join="exact", compat="override", chunks=None)
+# module level: temperature_gradients() also runs in the partition processes
+from batch import add_arguments, batch_options, run_partitions
+from output import add_output_arguments, check_outfile, write_output
+from load_SAIdata import open_mfdataset
+from xarray_funcs import legendre_moments, resample_mean
+
+
+def temperature_gradients(infiles, outfile, output_format='netcdf', append=False):
+    """Store annual means of T0, T1 and T2 of infiles in outfile (see output.py)"""
+    # open dataset with time at center of time_bnds (cached by the loader)
+    ds = open_mfdataset(infiles, verbose=False, variables=['TREFHT'], center_time=True, 
+                        chunks={})
     print(f"+{perf_counter()-t0:.1f} sec: opened dataset")
-    time = ('time', ds.time_bnds.mean('nbnd').data, ds.time.attrs)
-    ds = ds.assign_coords({'ctime':time}).swap_dims({'time':'ctime'})
-    ds = ds.drop_vars('time').rename({'ctime':'time'})
 
-    # calculate T0, T1 and T2
-    sinlat = np.sin(np.deg2rad(ds.lat))
-    gmean = lambda da: da.weighted(ds.gw).mean(('lat','lon'), keep_attrs=True)
-    T0 = gmean(ds.TREFHT).rename('T0')
-    T1 = gmean(ds.TREFHT*sinlat).rename('T1')
+    # calculate T0, T1 and T2 (Legendre moments P0, P1, P2 of sin(lat)) in one pass
+    moments = legendre_moments(ds, degrees=(0, 1, 2), variables=['TREFHT']).TREFHT
+    T0 = moments.sel(degree=0, drop=True).rename('T0')
+    T1 = moments.sel(degree=1, drop=True).rename('T1')
     T1.attrs.update({'long_name':'Interhemispheric temperature gradient'})
-    T2 = gmean(ds.TREFHT*(3*sinlat**2-1)/2).rename('T2')
+    T2 = moments.sel(degree=2, drop=True).rename('T2')
     T2.attrs.update({'long_name':'Equator-pole temperature gradient'})
     dsm = xr.merge((T0,T1,T2,ds.time_bnds))
     dsm.time.attrs.update(ds.time.attrs) 
 
-    # take annual mean
-    mean_bnds = lambda da: xr.DataArray([da.values.min(), da.values.max()], 
-        {'time':da.time.mean('time', keep_attrs=True)}, 'nbnd')
-    dsy = dsm.groupby('time.year').mean('time', keep_attrs=True)
+    # take annual mean (weighted by month length, bounds spanning each year)
+    dsy = resample_mean(dsm, 'year')
     dsy.year.attrs = {
         'long_name':'time', 'units':'simulated year', 'calendar':'noleap'
     }
-    dsy = dsy.assign_coords(time = ('year',dsm.time.groupby('time.year').mean('time').data, dsm.time.attrs))
-    new_bounds = dsm.time_bnds.groupby('time.year').map(mean_bnds)
-    dsy['time_bnds'] = (new_bounds.dims, new_bounds.data, dsm.time_bnds.attrs)
-    dsm.close()
-    dsy = dsy.swap_dims({'year':'time'})
     dsy.time.encoding['units'] = 'days since 0001-01-01'
 
     # write output
-    dsy.attrs = {'history':f'python temperaturegradients.py [{args.infiles[0]} - {args.infiles[-1]}] {args.outfile}'}
-    dsy.to_netcdf(args.outfile)
-    print(f"+{perf_counter()-t0:.1f} sec: created {args.outfile}")
+    dsy.attrs = {'history':f'python temperaturegradients.py [{infiles[0]} - {infiles[-1]}] {outfile}'}
+    write_output(dsy, outfile, output_format, append)
+    print(f"+{perf_counter()-t0:.1f} sec: created {outfile}")
+
+
+def main():
+    # read script arguments 
+    parser = argparse.ArgumentParser(
+        description='Calculate temperature gradients T0, T1 and T2 time series as in GLENS')
+    parser.add_argument('infiles', nargs='+', help='input netCDF files')
+    parser.add_argument('outfile', help='output netCDF file or Zarr store')
+    add_arguments(parser)
+    add_output_arguments(parser)
+    args = parser.parse_args()
+    check_outfile(args)
+    
+    if args.years is None:
+        client = Client() # for parallel opening
+        print(f"+{perf_counter()-t0:.1f} sec: {client}")
+        temperature_gradients(args.infiles, args.outfile, args.output_format, args.append)
+    else: # restartable, per partition of years (see batch.py)
+        run_partitions(args.infiles, args.outfile, temperature_gradients, **batch_options(args),
+                       output_format=args.output_format, append=args.append)
+        print(f"+{perf_counter()-t0:.1f} sec: created {args.outfile}")
     
 
 if __name__ == '__main__':
-    import os
-    import sys
-    import argparse
-    from time import perf_counter
-    import numpy as np
-    import xarray as xr
-    import dask
-    from dask.distributed import Client
-    t0 = perf_counter()
-    client = Client() # for parallel opening
-    print(f"+{perf_counter()-t0:.1f} sec: {client}")
     main()
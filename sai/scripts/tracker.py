@@ -0,0 +1,484 @@
+#!/usr/bin/env python3
+# *_* coding: utf-8 *_*
+
+"""Detect tropical cyclone candidates in 3-hourly CESM output
+
+Script version of jobs/testing/tracker.ipynb. Run with
+    >> python tracker.py [-v] files store.zarr [-j JOBS] [--gridfile GRIDFILE]
+
+The files (h1 stream with PSL, U10, T850, U850, V850, U250 and V250) are
+split into days (see chunkplan.plan_periods, cached in the file
+catalog), which are processed by a pool of JOBS worker processes. The
+grid metric and latitude weights are read once and shared with the
+workers through shared memory, and each worker keeps its recent files
+open for the next days. The candidate tables of all days are appended,
+in order of the days, to a single Zarr store, of which the index (day,
+day_end) lists the completed days and the number of candidates up to
+each. Days in the index are skipped when the job is restarted.
+
+Detection works on whole (time, lat, lon) blocks, without a Python loop
+per grid point. A grid point is a candidate if:
+- the vorticity at 850 hPa (times the sign of lat) is at least
+  RVTHRESHOLD and exceeds that at 250 hPa by RVDIFFTHRESHOLD (warm core)
+- T850 exceeds its FIELDSIZE x FIELDSIZE degree (gw weighted) mean by
+  CORETEMPTHRESHOLD, the box means of all points follow from running
+  sums along lon (periodic) and lat
+- the 10 m wind speed exceeds U10THRESHOLD within U10THRESHOLD_MAXRADIUS,
+  counted from cumulative sums along lon at each row within the radius
+- no other candidate within RVDISTMIN has a lower sea level pressure:
+  points that are not the lowest in a neighbourhood box (inside
+  RVDISTMIN) of the points that satisfy the criteria above are dropped
+  with a minimum filter, then of the remaining local minima that are
+  within RVDISTMIN of each other only the lowest is kept. As in the
+  notebook no two candidates are within RVDISTMIN, but a candidate can
+  have a lower point within RVDISTMIN that was dropped itself
+The candidates are returned as a table with one row per candidate.
+
+The vorticity at 850 and 250 hPa is computed by a numba kernel in one
+pass over both levels, from inverse grid distances computed once per
+grid, into a buffer that each worker reuses for all its days. The
+periodic lon boundary is handled by index arithmetic instead of padded
+copies of the winds, and no temporary differences are stored.
+"""
+
+import os
+import sys
+import argparse
+import logging
+from functools import lru_cache
+from multiprocessing import shared_memory
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import xarray as xr
+from scipy import ndimage
+from numba import njit
+
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+from load_SAIdata import CATALOG, available_resources
+from chunkplan import plan_periods
+from output import _zarr_encoding
+
+LATMIN = -60
+LATMAX = 60
+RADIUSEARTH = 6371000.0
+RVTHRESHOLD = 6.0 * 10**(-5.0) # minimum for RV@850hPa
+RVDIFFTHRESHOLD = 6.0 * 10**(-5.0) # minimum for RV@850hPa - RV@250hPa
+CORETEMPTHRESHOLD = 0.0 # minimum temperature anomaly core w.r.t. 8x8 degree area
+FIELDSIZE = 8 # (degrees N x E) size of field to calculate reference temperature
+U10THRESHOLD = 10 # (m/s) minimum 10m wind speed
+U10THRESHOLD_MAXRADIUS = 100 # (km) U10 should be 10m/s within 100km
+RVDISTMIN = 250 # (km) min. distance between maxima (if less, only the one with lower PSL counts)
+GRIDFILE = '/home/jasperdj/files_rene/Atmosphere_0_25_DX_DY_AREA.nc' # DX and DY of grid cells
+OPEN_FILES = 4 # input files kept open per worker
+CANDIDATE_DIM = 'candidate' # dimension of the candidate table
+CANDIDATE_CHUNK = 2**16 # candidates per Zarr chunk
+DAY_CHUNK = 2**12 # days per Zarr chunk of the index
+CANDIDATE_ATTRS = {
+    'lon_index': {'long_name': 'Longitude index of low'},
+    'lat_index': {'long_name': f'Latitude index of low (0 = first lat north of {LATMIN})'},
+    'lat': {'long_name': 'latitude', 'units': 'degrees_north'},
+    'lon': {'long_name': 'longitude', 'units': 'degrees_east'},
+    'RV850': {'long_name': 'Relative vorticity at 850 hPa (times sign of lat)', 'units': 's-1'},
+    'RV250': {'long_name': 'Relative vorticity at 250 hPa (times sign of lat)', 'units': 's-1'},
+    'PSL': {'long_name': 'Sea level pressure', 'units': 'hPa'},
+    'TEMP': {'long_name': 'Temperature anomaly w.r.t. 8x8 mean', 'units': 'deg C'},
+}
+
+
+def grid_properties(filepath, gridfile=GRIDFILE):
+    """Return dict with the rows and metric of the tracking domain
+
+    i1, i2 : rows of the domain LATMIN - LATMAX, the winds are read with
+        one extra row on both sides
+    lat, lon, dlat, dlon : coordinates of the domain and grid spacing
+    lat_weight : latitude weights (gw) of the domain
+    x_factor, y_factor : 1 / zonal and meridional distance (m) between
+        the neighbours of each grid cell, from DX and DY in gridfile
+    """
+    with xr.open_dataset(filepath, decode_times=False) as ds:
+        lats0, lons0, gw = ds['lat'].values, ds['lon'].values, ds['gw'].values
+    assert np.all(lats0[1:] > lats0[:-1]), "latitude does not increase"
+    i1 = lats0.searchsorted(LATMIN) - 1 # lat. index of 60S
+    i2 = lats0.searchsorted(LATMAX) + 1 # lat. index of 60N
+    with xr.open_dataset(gridfile) as ds:
+        assert ds['lon'].size == lons0.size, f'Grid in {gridfile} does not match data.'
+        grid_x = ds['DX'].values[i1-1:i2+1] # zonal length of grid cell
+        grid_y = ds['DY'].values[i1-1:i2+1] # meridional length of grid cell
+    # distance between the neighbours of each cell (periodic in lon)
+    x_diff = 0.5 * np.roll(grid_x, -1, axis=-1) + 0.5 * np.roll(grid_x, 1, axis=-1) + grid_x
+    y_diff = 0.5 * grid_y[2:] + 0.5 * grid_y[:-2] + grid_y[1:-1]
+    return {'i1': i1, 'i2': i2, 'lat': lats0[i1:i2], 'lon': lons0, 'lat_weight': gw[i1:i2],
+            'dlat': np.mean(np.diff(lats0)), 'dlon': np.mean(np.diff(lons0)),
+            'x_factor': 1 / x_diff[1:-1], 'y_factor': 1 / y_diff}
+
+
+def read_data(segments, grid, out=None):
+    """Read the steps [(filepath, start, stop), ...] on the rows of grid
+
+    Returns time (center of time_bnds), PSL (hPa), U10, T850 and
+    vorticity at 850 and 250 hPa, written to out (2, time, lat, lon) if
+    given (see relative_vorticity).
+    """
+    i1, i2 = grid['i1'], grid['i2']
+    parts = [_open(filepath).isel(time=slice(start, stop)) for (filepath, start, stop) in segments]
+
+    def read(v, rows=slice(i1, i2)):
+        return np.concatenate([ds[v].isel(lat=rows).values for ds in parts])
+
+    time = np.concatenate([ds['time_bnds'].values.mean(axis=-1) if 'time_bnds' in ds
+                           else ds['time'].values for ds in parts])
+    pres = read('PSL') / 100.0 # sea level pressure (hPa)
+    U_10 = read('U10') # 10-meter wind speed (m/s)
+    temp = read('T850') # temperature 850 hPa
+    winds = {v: read(v, slice(i1-1, i2+1)) for v in ['U850', 'V850', 'U250', 'V250']}
+    vor_850, vor_250 = relative_vorticity((winds['U850'], winds['U250']),
+                                          (winds['V850'], winds['V250']), grid, out)
+    return time, pres, U_10, temp, vor_850, vor_250
+
+
+@lru_cache(maxsize=OPEN_FILES)
+def _open(filepath):
+    """Open filepath once per process, following days in the same file reuse it"""
+    return xr.open_dataset(filepath, decode_times=False)
+
+
+def periodic_boundaries(field, lon_grids=1):
+    """Add periodic zonal boundaries to field (..., lon)"""
+    return np.concatenate([field[..., -lon_grids:], field, field[..., :lon_grids]], axis=-1)
+
+
+def relative_vorticity(u_vel, v_vel, grid, out=None, div=None):
+    """Relative vorticity (and divergence) of the winds on several levels
+
+    Input:
+    u_vel, v_vel : tuples of zonal and meridional winds (time, lat+2, lon)
+        on the rows of grid plus one row on both sides, one per level
+    grid : grid properties with x_factor and y_factor (see grid_properties)
+    out, div : buffers (level, time, lat, lon) for the vorticity and
+        divergence, by default out is allocated and no divergence computed
+
+    All levels are computed in one pass by _curl_div, the winds are not
+    copied or converted (levels with different data types are done in
+    separate passes). Returns out.
+    """
+    u_vel = tuple(np.ascontiguousarray(u) for u in u_vel)
+    v_vel = tuple(np.ascontiguousarray(v) for v in v_vel)
+    nt, ny, nx = u_vel[0].shape
+    if out is None:
+        out = np.empty((len(u_vel), nt, ny-2, nx), dtype='float64')
+    if div is None:
+        div = np.empty((0, 0, 0, 0), dtype=out.dtype)
+    groups = {} # levels by data type of the winds
+    for (level, (u, v)) in enumerate(zip(u_vel, v_vel)):
+        groups.setdefault((u.dtype, v.dtype), []).append(level)
+    for levels in groups.values():
+        _curl_div(tuple(u_vel[l] for l in levels), tuple(v_vel[l] for l in levels),
+                  grid['x_factor'], grid['y_factor'], np.array(levels), out, div)
+    return out
+
+
+@njit(inline='always')
+def _curl_div_point(u, v, x_factor, y_factor, curl, div, t, j, i, west, east, divergence):
+    curl[t, j, i] = ((v[t, j+1, east] - v[t, j+1, west]) * x_factor[j, i]
+                     - (u[t, j+2, i] - u[t, j, i]) * y_factor[j, i])
+    if divergence:
+        div[t, j, i] = ((u[t, j+1, east] - u[t, j+1, west]) * x_factor[j, i]
+                        + (v[t, j+2, i] - v[t, j, i]) * y_factor[j, i])
+
+
+@njit(cache=True)
+def _curl_div(u_vel, v_vel, x_factor, y_factor, levels, curl, div):
+    """Centred differences of the winds at all levels, periodic in lon
+
+    u_vel, v_vel: tuples of (nt, ny+2, nx), written to curl[levels]
+    (nlev, nt, ny, nx), div is only computed if it is not empty. The first and last column are
+    done separately, such that the inner loop has no wrap-around.
+    """
+    nt, ny2, nx = u_vel[0].shape
+    divergence = div.size > 0
+    for t in range(nt):
+        for j in range(ny2-2):
+            for m in range(len(u_vel)):
+                u, v, c = u_vel[m], v_vel[m], curl[levels[m]]
+                d = div[levels[m]] if divergence else c # not written without divergence
+                if divergence:
+                    for i in range(1, nx-1):
+                        _curl_div_point(u, v, x_factor, y_factor, c, d, t, j, i, i-1, i+1, True)
+                else:
+                    for i in range(1, nx-1):
+                        _curl_div_point(u, v, x_factor, y_factor, c, d, t, j, i, i-1, i+1, False)
+                _curl_div_point(u, v, x_factor, y_factor, c, d, t, j, 0, nx-1, 1, divergence)
+                _curl_div_point(u, v, x_factor, y_factor, c, d, t, j, nx-1, nx-2, 0, divergence)
+
+
+def distance(lon_1, lat_1, lon_2, lat_2):
+    """Returns distance (m) between points on the globe (degrees), broadcasting arrays"""
+    lon_1, lat_1, lon_2, lat_2 = [np.radians(x) for x in (lon_1, lat_1, lon_2, lat_2)]
+    a = (np.sin((lat_2 - lat_1) / 2.0)**2
+         + np.cos(lat_1) * np.cos(lat_2) * np.sin((lon_2 - lon_1) / 2.0)**2)
+    return 2.0 * np.arcsin(np.sqrt(np.minimum(a, 1.0))) * RADIUSEARTH
+
+
+def detect_candidates(vor_850, vor_250, temp, U_10, pres, lat, lon, lat_weight):
+    """Return table {column: array} of the TC candidates of all time steps
+
+    Input:
+    vor_850, vor_250 : relative vorticity (s-1) at 850 and 250 hPa (time, lat, lon)
+    temp, U_10, pres : T850 (K), 10 m wind speed (m/s) and sea level
+        pressure (hPa) on the same grid
+    lat, lon : coordinates (degrees) of the regular grid, periodic in lon
+    lat_weight : latitude weights (gw) of the rows
+
+    The columns are the time step, lat_index and lon_index of each
+    candidate and lat, lon, RV850, RV250, PSL and TEMP (anomaly) there,
+    sorted by time step and sea level pressure.
+    """
+    dlat, dlon = np.mean(np.diff(lat)), np.mean(np.diff(lon))
+    nlat_box, nlon_box = round(FIELDSIZE/(2*dlat)), round(FIELDSIZE/(2*dlon))
+    sign = np.sign(lat)[:, None]
+    avor_850, avor_250 = vor_850 * sign, vor_250 * sign
+    temp_anom = temp - _box_mean(temp, lat_weight, nlat_box, nlon_box)
+    mask = ((avor_850 >= RVTHRESHOLD) & (avor_850 - avor_250 >= RVDIFFTHRESHOLD)
+            & (temp_anom >= CORETEMPTHRESHOLD) & np.isfinite(pres))
+    t, j, i = np.nonzero(mask)
+    windy = _windy(U_10 >= U10THRESHOLD, t, j, i, lat, dlon, nlat_box, nlon_box)
+    t, j, i = t[windy], j[windy], i[windy]
+    lowest = _lowest_pressure(pres, t, j, i, lat, lon)
+    t, j, i = t[lowest], j[lowest], i[lowest]
+    order = np.lexsort((pres[t, j, i], t))
+    t, j, i = t[order], j[order], i[order]
+    return {'step': t, 'lat_index': j, 'lon_index': i, 'lat': lat[j], 'lon': lon[i],
+            'RV850': avor_850[t, j, i], 'RV250': avor_250[t, j, i], 'PSL': pres[t, j, i],
+            'TEMP': temp_anom[t, j, i]}
+
+
+def _box_mean(field, lat_weight, nlat_box, nlon_box):
+    """Weighted mean of field (..., lat, lon) over the box around each point
+
+    The box spans nlat_box rows (cut off at the edges) and nlon_box
+    columns (periodic) on both sides, rows are weighted by lat_weight.
+    """
+    row_mean = ndimage.uniform_filter1d(field.astype('float64'), 2*nlon_box+1, axis=-1,
+                                        mode='wrap')
+    kernel = np.ones(2*nlat_box+1)
+    weight = np.asarray(lat_weight, dtype='float64')
+    total = ndimage.correlate1d(row_mean * weight[:, None], kernel, axis=-2, mode='constant')
+    return total / ndimage.correlate1d(weight, kernel, mode='constant')[:, None]
+
+
+def _windy(strong, t, j, i, lat, dlon, nlat_box, nlon_box):
+    """True for points (t, j, i) with strong winds within U10THRESHOLD_MAXRADIUS
+
+    Only points inside the FIELDSIZE box count. The number of strong
+    points in a row segment follows from the cumulative sum along lon.
+    """
+    ny = strong.shape[-2]
+    radius = 1000 * U10THRESHOLD_MAXRADIUS
+    padded = periodic_boundaries(strong, nlon_box) if nlon_box > 0 else strong
+    counts = np.zeros(padded.shape[:-1] + (padded.shape[-1]+1,), dtype=np.int32)
+    np.cumsum(padded, axis=-1, out=counts[..., 1:])
+    offsets = np.arange(nlon_box+1) * dlon
+    nrows = min(nlat_box, int(np.degrees(radius / RADIUSEARTH) // np.mean(np.diff(lat))))
+    found = np.zeros(t.size, dtype=bool)
+    for dj in range(-nrows, nrows+1):
+        jj = j + dj
+        inside = (jj >= 0) & (jj < ny)
+        jj = np.clip(jj, 0, ny-1)
+        # largest zonal offset within the radius (-1 if none)
+        width = (distance(0, lat[j, None], offsets, lat[jj, None]) <= radius).sum(axis=-1) - 1
+        n = counts[t, jj, i+nlon_box+width+1] - counts[t, jj, i+nlon_box-width]
+        found |= inside & (width >= 0) & (n > 0)
+    return found
+
+
+def _lowest_pressure(pres, t, j, i, lat, lon):
+    """True for the points (t, j, i) kept as candidates, no two within RVDISTMIN
+
+    Of points within RVDISTMIN of each other the lower pressure wins.
+    Points that are not the lowest in a box within RVDISTMIN are dropped
+    first, so a kept point can have a lower (dropped) point within
+    RVDISTMIN.
+    """
+    dlat, dlon = np.mean(np.diff(lat)), np.mean(np.diff(lon))
+    radius = 1000 * RVDISTMIN
+    # local minima in a box of which all points are within radius
+    nbox = int(np.degrees(radius / RADIUSEARTH) // (dlat + dlon))
+    field = np.full(pres.shape, np.inf)
+    field[t, j, i] = pres[t, j, i]
+    lowest = ndimage.minimum_filter(field, size=(1, 2*nbox+1, 2*nbox+1),
+                                    mode=('nearest', 'constant', 'wrap'), cval=np.inf)
+    keep = field[t, j, i] <= lowest[t, j, i]
+    # of the remaining local minima, drop those with a lower one nearby
+    # (equal pressures: the first in the table is lower)
+    for step in np.unique(t[keep]):
+        k = np.nonzero(keep & (t == step))[0]
+        p = pres[t[k], j[k], i[k]]
+        lower = (p[None, :] < p[:, None]) | ((p[None, :] == p[:, None]) & (k[None, :] < k[:, None]))
+        near = distance(lon[i[k], None], lat[j[k], None], lon[i[k]], lat[j[k]]) < radius
+        keep[k] = ~(near & lower).any(axis=-1)
+    return keep
+
+
+def share_grid(grid):
+    """Copy the arrays of grid to shared memory
+
+    Returns the description {key: value or (name, shape, dtype)} of the
+    grid, to attach to with _init_worker, and the shared memory blocks
+    (to close and unlink when done).
+    """
+    spec, blocks = {}, []
+    for (key, value) in grid.items():
+        if isinstance(value, np.ndarray):
+            shm = shared_memory.SharedMemory(create=True, size=max(value.nbytes, 1))
+            np.ndarray(value.shape, value.dtype, buffer=shm.buf)[...] = value
+            spec[key] = (shm.name, value.shape, value.dtype.str)
+            blocks.append(shm)
+        else:
+            spec[key] = value
+    return spec, blocks
+
+
+def _init_worker(files, spec):
+    """Attach the worker process to the shared grid (read-only)"""
+    global _FILES, _GRID, _BLOCKS, _VORTICITY
+    _FILES, _GRID, _BLOCKS = files, {}, []
+    _VORTICITY = np.empty(0) # vorticity buffer, reused by the days of the worker
+    for (key, value) in spec.items():
+        if isinstance(value, tuple):
+            shm = shared_memory.SharedMemory(name=value[0])
+            _BLOCKS.append(shm) # keep the buffer alive
+            _GRID[key] = np.ndarray(value[1], np.dtype(value[2]), buffer=shm.buf)
+            _GRID[key].flags.writeable = False
+        else:
+            _GRID[key] = value
+
+
+def _track(segments):
+    """Return the candidate table of one day [(file index, start, stop), ...] (in a worker)"""
+    global _VORTICITY
+    segments = [(_FILES[fid], start, stop) for (fid, start, stop) in segments]
+    shape = (2, sum(stop - start for (_, start, stop) in segments),
+             _GRID['i2'] - _GRID['i1'], _GRID['lon'].size)
+    if _VORTICITY.size < np.prod(shape): # sized on the first (longest) day
+        _VORTICITY = np.empty(np.prod(shape), dtype='float64')
+    out = _VORTICITY[:np.prod(shape)].reshape(shape)
+    time, pres, U_10, temp, vor_850, vor_250 = read_data(segments, _GRID, out)
+    table = detect_candidates(vor_850, vor_250, temp, U_10, pres, _GRID['lat'], _GRID['lon'],
+                              _GRID['lat_weight'])
+    table['time'] = time[table.pop('step')]
+    return table
+
+
+def read_index(store):
+    """Return the days (YYYYMMDD) completed in store and their number of candidates
+
+    Candidates of an interrupted day (after the last day in the index)
+    are removed from the store.
+    """
+    if not os.path.exists(store):
+        return set(), 0
+    with xr.open_zarr(store, decode_times=False) as ds:
+        days = ds['day'].values if 'day' in ds.variables else np.array([], dtype=int)
+        end = int(ds['day_end'].values[-1]) if days.size else 0
+        columns = [v for v in ds.variables if ds[v].dims == (CANDIDATE_DIM,)]
+        nrows = ds.sizes.get(CANDIDATE_DIM, 0)
+    if nrows > end:
+        import zarr
+        logging.warning(f"removing {nrows-end} candidate(s) of an interrupted day from {store}")
+        group = zarr.open_group(store, mode='r+')
+        for v in columns:
+            group[v].resize((end,))
+        zarr.consolidate_metadata(store)
+    return set(days.tolist()), end
+
+
+def append_day(store, day, table, nrows, time_attrs):
+    """Append the candidate table of day to store and add day to the index
+
+    nrows is the number of candidates in store, returns the new number.
+    """
+    ds = xr.Dataset({v: (CANDIDATE_DIM, table[v], CANDIDATE_ATTRS.get(v, time_attrs))
+                     for v in table})
+    nrows += ds.sizes[CANDIDATE_DIM]
+    index = xr.Dataset({'day': ('day', [day]), 'day_end': ('day', [nrows])})
+    index['day_end'].attrs = {'long_name': 'number of candidates up to and including day'}
+    for (dsw, dim, chunk) in [(ds, CANDIDATE_DIM, CANDIDATE_CHUNK), (index, 'day', DAY_CHUNK)]:
+        if os.path.isdir(os.path.join(store, list(dsw.data_vars)[0])):
+            if dsw.sizes[dim] > 0:
+                dsw.to_zarr(store, append_dim=dim)
+        else: # first day
+            encoding = {v: dict(enc, chunks=(chunk,)) for (v, enc) in _zarr_encoding(dsw).items()}
+            dsw.to_zarr(store, mode='a' if os.path.exists(store) else 'w-', encoding=encoding)
+    return nrows
+
+
+def track(files, store, gridfile=GRIDFILE, max_workers=None, catalog=CATALOG):
+    """Detect the candidates of all days in files and append them to store
+
+    Input:
+    files : input files (h1 stream), sorted by date
+    store : Zarr store of the candidate table, days in its index are skipped
+    gridfile : file with DX and DY of the grid
+    max_workers : number of worker processes (default: available cores)
+    catalog : file catalog caching the days in each file (see chunkplan.plan_periods)
+    """
+    grid = grid_properties(files[0], gridfile)
+    with xr.open_dataset(files[0], decode_times=False) as ds:
+        time_attrs = {'units': ds['time'].units,
+                      'calendar': ds['time'].attrs.get('calendar', 'standard')}
+    done, nrows = read_index(store)
+    tasks = plan_periods(files, 'day', catalog)
+    todo = [task for task in tasks if task[0] not in done]
+    logging.info(f"{len(tasks)} days in {len(files)} files, "
+                 f"{len(tasks)-len(todo)} done before, {len(todo)} to do")
+    if not todo:
+        return
+    max_workers = min(max_workers or available_resources()[0], len(todo))
+    spec, blocks = share_grid(grid)
+    failed = []
+    try:
+        with ProcessPoolExecutor(max_workers, initializer=_init_worker,
+                                 initargs=(files, spec)) as pool:
+            futures = [(day, pool.submit(_track, segments)) for (day, segments) in todo]
+            for (day, future) in futures: # in order of the days
+                try:
+                    table = future.result()
+                except Exception as e:
+                    logging.error(f"day {day} failed: {e!r}")
+                    failed.append(day)
+                    continue
+                nrows = append_day(store, day, table, nrows, time_attrs)
+                logging.info(f"{day}: {table['time'].size} candidates")
+    finally:
+        for shm in blocks:
+            shm.close()
+            shm.unlink()
+    if failed:
+        raise RuntimeError(f"{len(failed)} day(s) failed: {failed}, rerun to process only these")
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Detect tropical cyclone candidates in 3-hourly CESM output')
+    parser.add_argument('files', nargs='+', help='input files (h1 stream)')
+    parser.add_argument('store', help='output Zarr store of the candidates')
+    parser.add_argument('--gridfile', default=GRIDFILE,
+                        help=f'file with DX and DY of the grid (default: {GRIDFILE})')
+    parser.add_argument('--catalog', default=CATALOG,
+                        help=f'file catalog caching the days per file (default: {CATALOG})')
+    parser.add_argument('-j', '--jobs', type=int,
+                        help='number of worker processes (default: available cores)')
+    parser.add_argument('-v', '--verbose', help='modify output verbosity',
+                        action='store_true')
+    args = parser.parse_args()
+    logging.basicConfig(
+        level=logging.INFO if args.verbose else logging.WARNING,
+        format="%(asctime)s %(levelname)s: %(message)s",
+        datefmt="%d-%m-%Y %H:%M:%S"
+    )
+    track(sorted(args.files), args.store, args.gridfile, args.jobs, args.catalog)
+
+
+if __name__ == '__main__':
+    main()
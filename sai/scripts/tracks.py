@@ -0,0 +1,176 @@
+#!/usr/bin/env python3
+# *_* coding: utf-8 *_*
+
+"""Link TC candidates of tracker.py into tracks
+
+Run with >> python tracks.py [-v] stores outfile [--format zarr] [-j JOBS]
+
+The candidates of each store (one per ensemble member) are linked from
+one time step to the next: the candidates of every step are put in a
+k-d tree on the unit sphere (scipy.spatial.cKDTree), in which the
+TRACK_NEIGHBOURS nearest candidates within the travel distance
+TRACK_MAXSPEED * time step are found for all candidates of the previous
+step at once. Conflicts are resolved in favour of the shortest link, a
+candidate without a link starts a new track, and tracks end at gaps in
+time. This is a single pass over the time steps, no distances are
+computed between all pairs of candidates.
+
+The tracks of all members are written as one columnar table, a
+contiguous ragged array (CF discrete sampling geometry): the columns of
+the candidates along obs, sorted by track and time, and the number of
+observations (row_size) and member of every track along track. Tracks
+shorter than TRACK_MINSTEPS steps are left out. The stores of the
+members are linked in parallel processes.
+"""
+
+import os
+import sys
+import argparse
+import logging
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import xarray as xr
+from scipy.spatial import cKDTree
+
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+from chunkplan import UNIT_DAYS
+from output import OUTPUT_FORMATS, write_output
+from tracker import CANDIDATE_DIM, RADIUSEARTH
+
+TRACK_MAXSPEED = 80 # (km/h) max. travel speed of a center between time steps
+TRACK_NEIGHBOURS = 3 # nearest candidates considered per link
+TRACK_MINSTEPS = 8 # min. number of time steps of a track (8: one day of 3-hourly data)
+MAXGAP = 1.5 # (time steps) tracks end at larger gaps in time
+
+
+def link_candidates(time, lat, lon, maxdist):
+    """Return track number of each candidate
+
+    Input:
+    time, lat, lon : time (numeric) and position (degrees) of the candidates
+    maxdist : max. distance (m) between the positions of a track in
+        consecutive time steps
+
+    Tracks are numbered from 0 in order of their first time step.
+    """
+    order = np.argsort(time, kind='stable')
+    times, starts = np.unique(time[order], return_index=True)
+    stops = np.append(starts[1:], time.size)
+    step = np.min(np.diff(times)) if times.size > 1 else 0
+    chord = 2 * np.sin(maxdist / RADIUSEARTH / 2) # on the unit sphere
+    lat, lon = np.radians(lat), np.radians(lon)
+    xyz = np.stack([np.cos(lat) * np.cos(lon), np.cos(lat) * np.sin(lon), np.sin(lat)], axis=-1)
+    track = np.full(time.size, -1, dtype='int64')
+    ntracks, prev = 0, order[:0]
+    for (k, (start, stop)) in enumerate(zip(starts, stops)):
+        cur = order[start:stop]
+        ids = np.full(cur.size, -1, dtype='int64')
+        if prev.size and (times[k] - times[k-1] <= MAXGAP * step):
+            nn = min(TRACK_NEIGHBOURS, cur.size)
+            dist, j = cKDTree(xyz[cur]).query(xyz[prev], k=nn, distance_upper_bound=chord)
+            dist, j = dist.reshape(prev.size, nn), j.reshape(prev.size, nn)
+            linked = np.zeros(prev.size, dtype=bool)
+            # n-th nearest candidates, of which each is linked to the closest track
+            for n in range(nn):
+                i = np.flatnonzero(~linked & np.isfinite(dist[:, n]))
+                i = i[ids[j[i, n]] < 0]
+                i = i[np.lexsort((dist[i, n], j[i, n]))]
+                i = i[np.unique(j[i, n], return_index=True)[1]]
+                ids[j[i, n]] = track[prev[i]]
+                linked[i] = True
+        new = ids < 0
+        ids[new] = ntracks + np.arange(new.sum())
+        ntracks += new.sum()
+        track[cur] = ids
+        prev = cur
+    return track
+
+
+def link_store(store, maxspeed=TRACK_MAXSPEED, min_steps=TRACK_MINSTEPS):
+    """Return candidate columns {name: array} of store with track number, and time attributes
+
+    Only candidates of tracks with at least min_steps time steps are
+    returned, sorted by track and time.
+    """
+    with xr.open_zarr(store, decode_times=False) as ds:
+        columns = {v: ds[v].values for v in ds.variables if ds[v].dims == (CANDIDATE_DIM,)}
+        time_attrs = ds['time'].attrs
+    time = columns['time']
+    times = np.unique(time)
+    unit = time_attrs['units'].partition(' since ')[0].strip().lower().removesuffix('s')
+    hours = (np.min(np.diff(times)) if times.size > 1 else 0) * UNIT_DAYS[unit] * 24
+    track = link_candidates(time, columns['lat'], columns['lon'], 1000 * maxspeed * hours)
+    steps = np.bincount(track)
+    keep = np.flatnonzero(steps[track] >= min_steps)
+    keep = keep[np.lexsort((time[keep], track[keep]))]
+    _, track = np.unique(track[keep], return_inverse=True) # renumber from 0
+    columns = {v: values[keep] for (v, values) in columns.items()}
+    columns['track_index'] = track.reshape(-1)
+    logging.info(f"{store}: {track.max()+1 if track.size else 0} tracks "
+                 f"of {time.size} candidates at {times.size} times")
+    return columns, time_attrs
+
+
+def track_table(members, stores):
+    """Return contiguous ragged array dataset of the tracks of all members
+
+    members: list of link_store results, stores: their names
+    """
+    tables, offset, attrs = [], 0, members[0][1]
+    for (m, (columns, time_attrs)) in enumerate(members):
+        if time_attrs.get('units') != attrs.get('units'):
+            raise ValueError(f"time units of {stores[m]} differ: {time_attrs.get('units')}, "
+                             f"{attrs.get('units')}")
+        track = columns.pop('track_index')
+        row_size = np.bincount(track)
+        ds = xr.Dataset({v: ('obs', values) for (v, values) in columns.items()})
+        ds['track_index'] = ('obs', track + offset)
+        ds['row_size'] = ('track', row_size)
+        ds['member'] = ('track', np.full(row_size.size, m, dtype='int32'))
+        tables.append(ds)
+        offset += row_size.size
+    ds = xr.merge([xr.concat([t.drop_dims('track') for t in tables], 'obs'),
+                   xr.concat([t.drop_dims('obs') for t in tables], 'track')])
+    ds['time'].attrs = attrs
+    ds['track_index'].attrs = {'long_name': 'track of the observation', 'cf_role': 'trajectory_id'}
+    ds['row_size'].attrs = {'long_name': 'number of observations of the track',
+                            'sample_dimension': 'obs'}
+    ds['member'].attrs = {'long_name': 'ensemble member (index in members)'}
+    ds.attrs = {'featureType': 'trajectory', 'members': ', '.join(stores)}
+    return ds
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Link TC candidates of tracker.py into tracks')
+    parser.add_argument('stores', nargs='+', help='candidate stores of tracker.py (one per member)')
+    parser.add_argument('outfile', help='output file')
+    parser.add_argument('--format', dest='output_format', choices=OUTPUT_FORMATS,
+                        default='netcdf', help='output format (default: netcdf)')
+    parser.add_argument('--max-speed', type=float, default=TRACK_MAXSPEED,
+                        help=f'max. travel speed in km/h (default: {TRACK_MAXSPEED})')
+    parser.add_argument('--min-steps', type=int, default=TRACK_MINSTEPS,
+                        help=f'min. number of time steps of a track (default: {TRACK_MINSTEPS})')
+    parser.add_argument('-j', '--jobs', type=int, help='number of members linked at once')
+    parser.add_argument('-v', '--verbose', help='modify output verbosity',
+                        action='store_true')
+    args = parser.parse_args()
+    logging.basicConfig(
+        level=logging.INFO if args.verbose else logging.WARNING,
+        format="%(asctime)s %(levelname)s: %(message)s",
+        datefmt="%d-%m-%Y %H:%M:%S"
+    )
+    if os.path.exists(args.outfile):
+        raise ValueError(f'output file {args.outfile} already exists.')
+    n = len(args.stores)
+    with ProcessPoolExecutor(min(args.jobs or n, n)) as pool:
+        members = list(pool.map(link_store, args.stores, [args.max_speed] * n,
+                                [args.min_steps] * n))
+    ds = track_table(members, args.stores)
+    ds.attrs['history'] = f"python tracks.py {' '.join(args.stores)} {args.outfile}"
+    write_output(ds, args.outfile, args.output_format)
+    logging.info(f"created {args.outfile} ({ds.sizes['track']} tracks)")
+
+
+if __name__ == '__main__':
+    main()
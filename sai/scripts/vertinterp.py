@@ -0,0 +1,267 @@
+#!/usr/bin/env python3
+# *_* coding: utf-8 *_*
+
+"""Vertical interpolation to pressure levels, linear in ln(p)
+
+The numba kernels operate on whole (outer, lev, inner) blocks of data,
+e.g. (time, lev, lat*lon) or (time, lev, ncol), instead of a gufunc call
+per column. Target levels are located by a binary search on the
+(monotone, ascending or descending) model pressure, and only the
+pressures bracketing a target level are used, so ln(p) is evaluated
+twice per output value and ln(target pressure) once per block. For
+hybrid levels the pressure hyam*P0 + hybm*PS is evaluated on the fly
+from PS, the 4D pressure field is never created. The kernels are
+serial, parallelism comes from dask over blocks (chunks along time).
+
+The bracketing level and weight of every target level are computed once
+per column and block, and then applied to all variables on the same
+grid, so interpolating U, V, T and Z3 costs one search instead of four.
+
+    >> from vertinterp import interpolate
+    >> ds_p = interpolate(ds[['U','V','T','Z3']], plev=[850, 250], ps=ds.PS, 
+    >>                    hyam=ds.hyam, hybm=ds.hybm, p0=ds.P0)
+
+Values outside the pressure range of a column are NaN. Run as a script
+to write a pressure level dataset that other diagnostics read directly:
+    >> python vertinterp.py [-v] files outfile [--plev 850 500 250] [--variables U V]
+           [--format zarr] [--append]
+"""
+
+import os
+import argparse
+import logging
+
+import numpy as np
+import xarray as xr
+from numba import njit
+
+VDIM = 'lev' # vertical dimension of input data
+PLEVS = (1000, 925, 850, 700, 500, 400, 300, 250, 200, 100) # default levels (hPa)
+PLEV_ATTRS = {'standard_name': 'air_pressure', 'long_name': 'air pressure', 'units': 'hPa'}
+
+
+@njit(inline='always')
+def _hybrid_pressure(hyam, hybm, p0, ps, k):
+    return hyam[k] * p0 + hybm[k] * ps
+
+
+@njit(cache=True)
+def _hybrid_weights(hyam, hybm, p0, ps, pi, logpi, k, w):
+    """Bracketing level k and weight w of level k+1 for hybrid levels
+
+    ps: surface pressure (nout, nin), k, w: (nout, npi, nin), k=-1 where
+    pi is outside the column
+    """
+    nout, nin = ps.shape
+    nlev, npi = hyam.size, pi.size
+    for j in range(nout * nin):
+        t, x = j // nin, j % nin
+        psx = ps[t, x]
+        ptop = _hybrid_pressure(hyam, hybm, p0, psx, 0)
+        pbot = _hybrid_pressure(hyam, hybm, p0, psx, nlev-1)
+        ascending = pbot > ptop
+        pmin, pmax = min(ptop, pbot), max(ptop, pbot)
+        for i in range(npi):
+            if (pi[i] < pmin) or (pi[i] > pmax):
+                k[t, i, x] = -1
+                continue
+            # binary search for k: p[k] <= pi <= p[k+1] (in ascending order)
+            lo, hi = 0, nlev - 1
+            while hi - lo > 1:
+                mid = (lo + hi) // 2
+                kmid = mid if ascending else nlev - 1 - mid
+                if _hybrid_pressure(hyam, hybm, p0, psx, kmid) <= pi[i]:
+                    lo = mid
+                else:
+                    hi = mid
+            k0 = lo if ascending else nlev - 1 - hi
+            logp0 = np.log(_hybrid_pressure(hyam, hybm, p0, psx, k0))
+            logp1 = np.log(_hybrid_pressure(hyam, hybm, p0, psx, k0+1))
+            k[t, i, x] = k0
+            w[t, i, x] = (logpi[i] - logp0) / (logp1 - logp0)
+
+
+@njit(cache=True)
+def _pressure_weights(p, pi, logpi, k, w):
+    """Bracketing level k and weight w of level k+1 for pressure p (nout, nlev, nin)"""
+    nout, nlev, nin = p.shape
+    npi = pi.size
+    for j in range(nout * nin):
+        t, x = j // nin, j % nin
+        ascending = p[t, nlev-1, x] > p[t, 0, x]
+        pmin, pmax = min(p[t, 0, x], p[t, nlev-1, x]), max(p[t, 0, x], p[t, nlev-1, x])
+        for i in range(npi):
+            if (pi[i] < pmin) or (pi[i] > pmax):
+                k[t, i, x] = -1
+                continue
+            lo, hi = 0, nlev - 1
+            while hi - lo > 1:
+                mid = (lo + hi) // 2
+                kmid = mid if ascending else nlev - 1 - mid
+                if p[t, kmid, x] <= pi[i]:
+                    lo = mid
+                else:
+                    hi = mid
+            k0 = lo if ascending else nlev - 1 - hi
+            logp0, logp1 = np.log(p[t, k0, x]), np.log(p[t, k0+1, x])
+            k[t, i, x] = k0
+            w[t, i, x] = (logpi[i] - logp0) / (logp1 - logp0)
+
+
+@njit(cache=True)
+def _apply_weights(f, k, w, out):
+    """Interpolate f (nout, nlev, nin) with levels k and weights w (nout, npi, nin)"""
+    nout, npi, nin = k.shape
+    for t in range(nout):
+        for i in range(npi):
+            for x in range(nin):
+                k0 = k[t, i, x]
+                if k0 < 0:
+                    out[t, i, x] = np.nan
+                else:
+                    out[t, i, x] = f[t, k0, x] + w[t, i, x] * (f[t, k0+1, x] - f[t, k0, x])
+
+
+def interpolate(ds:[xr.Dataset,xr.DataArray], plev, ps=None, hyam=None, hybm=None,
+                p0=None, pres=None, vdim:str=VDIM):
+    """Interpolate all variables with dimension vdim to pressure levels
+
+    Input:
+    ds : data on model levels
+    plev : target pressure levels (hPa), in any order
+    ps, hyam, hybm, p0 : surface pressure (Pa), hybrid coefficients and
+        reference pressure (Pa), used if pres is not given
+    pres : 3D air pressure (Pa), same dimensions as the data
+    vdim : vertical dimension
+
+    Returns data with dimension plev instead of vdim. Dimensions after
+    vdim (lat/lon or ncol) are processed as one contiguous block, so
+    data should not be chunked along them for best performance. All
+    variables on the grid of ps (or pres) share one set of interpolation
+    weights per block. Variables on other grids (e.g. staggered US) 
+    are dropped.
+    """
+    if isinstance(ds, xr.DataArray):
+        name = ds.name if ds.name is not None else '__data__'
+        dsp = interpolate(ds.to_dataset(name=name), plev, ps, hyam, hybm, p0, pres, vdim)
+        return dsp[name].rename(ds.name)
+    
+    # variables on the grid of the pressure (dimensions after vdim)
+    variables = [v for v in ds.data_vars if (vdim in ds[v].dims) and (ds[v].dims[-1] != vdim)]
+    pdims = ps.dims if pres is None else pres.dims
+    inner = {v: list(ds[v].dims[ds[v].dims.index(vdim)+1:]) for v in variables}
+    valid = [v for v in variables if set(inner[v]).issubset(pdims)]
+    inner = inner[valid[0]] if len(valid) > 0 else []
+    valid = [v for v in valid if ds[v].dims[ds[v].dims.index(vdim)+1:] == tuple(inner)]
+    if len(valid) < len(variables):
+        logging.warning(f'not interpolating {set(variables)-set(valid)}: dimensions '
+                        f'after {vdim} differ from pressure dimensions {pdims}')
+    if len(valid) == 0:
+        return ds.drop_vars(variables)
+    plev = xr.DataArray(np.asarray(plev, dtype='float64'), dims='plev', name='plev',
+                        attrs=PLEV_ATTRS)
+    pi = 100 * plev.values
+    logpi = np.log(pi)
+    fs = [ds[v] for v in valid]
+    if fs[0].chunks is not None:
+        fs = [f.chunk({vdim: -1} | {dim: -1 for dim in inner}) for f in fs]
+
+    def _reshape(f, nlev):
+        shape = f.shape[:f.ndim-len(inner)-(nlev>0)]
+        nin = int(np.prod(f.shape[f.ndim-len(inner):]))
+        return shape, np.ascontiguousarray(f).reshape(-1, *([nlev] if nlev else []), nin)
+
+    def _interpolate(fs, k, w, shape):
+        outs = []
+        for f in fs:
+            _, f3 = _reshape(f, f.shape[-len(inner)-1])
+            out = np.empty(k.shape, dtype=f.dtype)
+            _apply_weights(f3, k, w, out)
+            outs.append(out.reshape(*shape, pi.size, *f.shape[f.ndim-len(inner):]))
+        return tuple(outs) if len(outs) > 1 else outs[0]
+
+    if pres is None:
+        # hybrid coefficients are small, pass them to the kernel directly
+        hyam, hybm = [c.isel({d: 0 for d in c.dims if d != vdim}).values.astype('float64')
+                      for c in (hyam, hybm)]
+        p0 = float(np.ravel(p0)[0])
+        def _kernel(ps, *fs):
+            shape = fs[0].shape[:fs[0].ndim-len(inner)-1]
+            _, ps2 = _reshape(np.broadcast_to(ps, (*shape, *ps.shape[ps.ndim-len(inner):]))
+                              .astype('float64'), 0)
+            k = np.empty((ps2.shape[0], pi.size, ps2.shape[1]), dtype=np.int32)
+            w = np.empty(k.shape, dtype='float64')
+            _hybrid_weights(hyam, hybm, p0, ps2, pi, logpi, k, w)
+            return _interpolate(fs, k, w, shape)
+        if ps.chunks is not None:
+            ps = ps.chunk({dim: -1 for dim in inner})
+        args, core = [ps], [inner]
+    else:
+        def _kernel(p, *fs):
+            shape = fs[0].shape[:fs[0].ndim-len(inner)-1]
+            nlev = fs[0].shape[fs[0].ndim-len(inner)-1]
+            _, p3 = _reshape(np.broadcast_to(p, fs[0].shape).astype('float64'), nlev)
+            k = np.empty((p3.shape[0], pi.size, p3.shape[2]), dtype=np.int32)
+            w = np.empty(k.shape, dtype='float64')
+            _pressure_weights(p3, pi, logpi, k, w)
+            return _interpolate(fs, k, w, shape)
+        if pres.chunks is not None:
+            pres = pres.chunk({vdim: -1} | {dim: -1 for dim in inner})
+        args, core = [pres], [[vdim, *inner]]
+    outs = xr.apply_ufunc(
+        _kernel, *args, *fs,
+        input_core_dims=core + [[vdim, *inner]] * len(fs),
+        output_core_dims=[['plev', *inner]] * len(fs),
+        exclude_dims={vdim},
+        dask='parallelized',
+        output_dtypes=[f.dtype for f in fs],
+        dask_gufunc_kwargs={'output_sizes': {'plev': plev.size}},
+        keep_attrs=True,
+    )
+    outs = outs if isinstance(outs, tuple) else (outs,)
+    dsp = ds.drop_vars(variables)
+    for (v, out) in zip(valid, outs):
+        dsp[v] = out.assign_attrs(ds[v].attrs)
+    return dsp.assign_coords(plev=plev)
+
+
+def main():
+    from output import add_output_arguments, check_outfile, write_output
+    parser = argparse.ArgumentParser(
+        description='Interpolate CESM model level output to pressure levels')
+    parser.add_argument('files', nargs='+', help='input file(s)')
+    parser.add_argument('outfile', help='output file')
+    add_output_arguments(parser)
+    parser.add_argument('--plev', nargs='+', type=float, default=PLEVS,
+                        help=f'pressure levels in hPa (default: {PLEVS})')
+    parser.add_argument('--variables', nargs='+', 
+                        help='3D variables to interpolate (default: all)')
+    parser.add_argument('--chunk', type=int, default=1, help='time steps per chunk')
+    parser.add_argument('-v', '--verbose', help='modify output verbosity', 
+                        action='store_true')
+    args = parser.parse_args()
+    check_outfile(args)
+    logging.basicConfig(
+        level=logging.INFO if args.verbose else logging.WARNING,
+        format="%(asctime)s %(levelname)s: %(message)s",
+        datefmt="%d-%m-%Y %H:%M:%S"
+    )
+    from load_SAIdata import open_mfdataset
+    variables = args.variables
+    if (variables is not None) and ('P' not in variables):
+        variables = variables + ['PS'] # surface pressure for hybrid levels
+    ds = open_mfdataset(args.files, verbose=args.verbose, variables=variables, 
+                        chunks={'time': args.chunk})
+    logging.info(f"interpolating to {args.plev} hPa")
+    if 'P' in ds:
+        dsp = interpolate(ds.drop_vars('P'), args.plev, pres=ds.P)
+    else:
+        dsp = interpolate(ds, args.plev, ps=ds.PS, hyam=ds.hyam, hybm=ds.hybm, p0=ds.P0)
+    dsp.attrs.update({'history': 
+        f'python vertinterp.py [{args.files[0]} - {args.files[-1]}] {args.outfile}'})
+    write_output(dsp, args.outfile, args.output_format, args.append)
+    logging.info(f"created {args.outfile}")
+
+
+if __name__ == '__main__':
+    main()
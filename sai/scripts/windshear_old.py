@@ -3,24 +3,28 @@
 
 """Read CESM output data and calculate vertical wind shear
 
-Run with >> python windshear.py [-v,--verbose] *files outfile
+Run with >> python windshear.py [-v,--verbose] [--years N] *files outfile
 
 This script reads CESM output data, interpolates variables NAMES to
 pressure levels PLEVS. The wind shear is then calculated as the 
 difference between the horizontal winds at these levels. 
 
-The interpolation is performed linearly in ln(P) coordinates by applying
-logpressure_interp1d_gu() over every 1D vertical column in the data. If 
-the  pressure P is not present in the data, P will be calculated using
-FORMULA_TERMS, a mapping to relevant dataset variables to convert
-hybrid coordinates to pressure. 
-
-Parallel computing is supported by mapping the 1D vertical interpolation
-function to different chunks of the data arrays, controllable by the
-CHUNKS parameter. Mind that the vertical dimension is not allowed to be 
-chunked because the gufunc operates along this dimension (leave VDIM:-1)
-
-The vertical wind shear and other variables are stored in outfile.
+The interpolation is performed linearly in ln(P) coordinates by
+vertinterp.interpolate(), which computes the interpolation weights once
+per column and applies them to all variables. If the pressure P is not
+present in the data, P is evaluated from the hybrid coefficients HYAM, 
+HYBM, P0 and surface pressure PS.
+
+Parallel computing is supported by interpolating different chunks of the
+data arrays, controllable by the CHUNKS parameter. Mind that only the
+time dimension should be chunked, the kernel operates on whole columns 
+and horizontal grids.
+
+The files of the years in YEAR_RANGE are processed per partition of N
+years (default: 1), each stored in outfile.parts/ and marked as done,
+such that an interrupted job continues with the remaining partitions
+when restarted (see batch.py). The vertical wind shear and other 
+variables of all partitions are concatenated in outfile.
 """
 
 import os
@@ -31,11 +35,12 @@ import logging
 print(f'Python version: {sys.version}')
 print(f'Path: {sys.path}')
 
-from numba import guvectorize
 import numpy as np
 import xarray as xr
 xr.set_options(keep_attrs=True)
 xr.show_versions()
+from vertinterp import interpolate
+from batch import add_arguments, batch_options, file_year, run_partitions
 
 # define constants
 YEAR_RANGE = range(2070,2093) # years to analyze
@@ -49,7 +54,7 @@ NAMES = []   # list of variables to interpolate/store
 U, V = 'U', 'V' # zonal and meridional wind
 LABEL = 'upper' # ['upper','lower'], level where VSHEAR is defined
 VDIM = 'lev'  # vertical dimension (e.g. 'lev','plev','z','hybrid')
-CHUNKS = {'time':1,'ncol':'auto', VDIM:-1} # array chunk size for parallel computation
+CHUNKS = {'time':1} # array chunk size for parallel computation
 NEWPRES = xr.DataArray(
     data=100*np.array(sorted(PLEVS, reverse=True), dtype='float64'),
     dims='plev',
@@ -60,54 +65,25 @@ NEWPRES = xr.DataArray(
 )
 
 
-@guvectorize([
-    "(float64[:], float64[:], float64[:], float64[:])",
-    "(float32[:], float32[:], float64[:], float32[:])"
-], " (n), (n), (m) -> (m)", nopython=True, cache=True)
-def logpressure_interp1d_gu(f, p, pi, out):
-    """interpolate field f(p) to pi in ln(p) coordinates"""
-    i, imax, p0, f0 = 0, len(pi), p[0], f[0]
-    while pi[i]>p0 and i < imax:
-        out[i] = np.nan      
-        i = i + 1 
-    for p1,f1 in zip(p[1:], f[1:]):
-        while pi[i] >= p1 and i < imax:
-            out[i] = (f1-f0)/np.log(p1/p0)*np.log(pi[i]/p0)+f0
-            i = i + 1
-        p0, f0 = p1, f1
-    while i < imax:
-        out[i] = np.nan
-        i = i + 1
-
-
 def xr_interpolate_pressure(ds):
-    """wrapper for logpressure_interp1d_gu"""
-    # calculate pressure if needed and interpolate
+    """Interpolate NAMES to NEWPRES (see vertinterp.interpolate)"""
+    # the interpolation weights are computed once and shared by all NAMES
+    ds = ds[list(dict.fromkeys(NAMES + [v for v in [PS, PRES] if v in ds]))]
+    logging.info(f"new coordinate: {NEWPRES.dims[0]} {list(NEWPRES.values/100)} hPa")
+    logging.info("starting interpolation...")
     if PRES not in ds:
-        logging.info(f"calculating {PRES} from hybrid parameters")
-        pres = ds[HYAM] * ds[P0] + ds[HYBM] * ds[PS]   
+        logging.info(f"calculating {PRES} from hybrid parameters on the fly")
+        dsp = interpolate(ds, NEWPRES.values/100, ps=ds[PS], hyam=ds[HYAM], 
+                          hybm=ds[HYBM], p0=ds[P0], vdim=VDIM)
     else:
-        pres = ds[PRES]
-    ds = ds[NAMES].assign_coords({NEWPRES.name:NEWPRES})
-    logging.info(f"new coordinate: {ds[NEWPRES.name].coords}")
-    logging.info("starting interpolation...")
-    vdimvars = [v for v in ds.data_vars if hasattr(ds[v], VDIM)]
-    if len(vdimvars) == 1:
-        vdimvars = vdimvars[0]
-    ds[vdimvars] = xr.apply_ufunc(
-        logpressure_interp1d_gu,  ds[vdimvars], pres, NEWPRES,
-        input_core_dims=[[VDIM], [VDIM], [*NEWPRES.dims]], 
-        output_core_dims=[[*NEWPRES.dims]], 
-        exclude_dims=set((VDIM,)),
-        dask="parallelized",
-        keep_attrs=True,
-    ).transpose(*NEWPRES.dims,...)
+        dsp = interpolate(ds.drop_vars(PRES), NEWPRES.values/100, pres=ds[PRES], vdim=VDIM)
+    return dsp.assign_coords({NEWPRES.name:NEWPRES})
     
 
 def wind_shear(ds):
     """Calculate windshear"""
-    USHEAR = ds[U].diff(NEWPRES.name, label=LABEL)
-    VSHEAR = ds[V].diff(NEWPRES.name, label=LABEL)
+    USHEAR = ds[U].diff(NEWPRES.dims[0], label=LABEL)
+    VSHEAR = ds[V].diff(NEWPRES.dims[0], label=LABEL)
     VWS = np.sqrt(USHEAR**2 + VSHEAR**2)
     levstr = f'{max(PLEVS)}-{min(PLEVS)} hPa'
     USHEAR.attrs.update({
@@ -179,7 +155,6 @@ def check_globals(ds):
         fatal = True
     else:
         logging.info(f"variables to interpolate: {NAMES}")
-    logging.info(f"output file: {os.path.abspath(args.outfile)}")
     if fatal:
         logging.critical(f"fatal errors occurred for dataset:\n{ds}")
         logging.critical(f"resolve errors first, aborting...")
@@ -187,6 +162,19 @@ def check_globals(ds):
     return
 
 
+def process(files, outfile):
+    """Calculate wind shear of files (one partition) and store it in outfile"""
+    logging.info(f"opening {[os.path.basename(f) for f in files]} with chunks {CHUNKS}")
+    with xr.open_mfdataset(files, data_vars='minimal', coords='minimal',
+                           compat='override', chunks=CHUNKS) as ds:
+        logging.info(f"...succes!")
+        check_globals(ds)
+        ds = xr_interpolate_pressure(ds)
+        ds = wind_shear(ds) # calculate wind shear
+        logging.info(f"storing interpolated data in {outfile}")
+        ds.to_netcdf(outfile)
+
+
 def main():
     time0 = time.perf_counter()  # start timer
 
@@ -197,6 +185,7 @@ def main():
     parser.add_argument('-f', help='used by jupyter')
     parser.add_argument('-v', '--verbose', help='modify output verbosity', 
                         action='store_true')
+    add_arguments(parser)
     args = parser.parse_args()
 
     # set up logger 
@@ -211,28 +200,17 @@ def main():
         f"\n{os.linesep.join([os.path.basename(f) for f in args.files])}"
     )
     
-    # 
-    for year in YEAR_RANGE:
-        files_year = [f for f in args.files 
-                      if int(file.split('.')[-2][:4]) == year]
-        logging.info(f"opening {files_year} with chunks {CHUNKS}")
-        try:
-            datasets = [xr.open_dataset(f, chunks=CHUNKS) for f in files_year]
-        except Exception:
-            [ds.close() for ds in datasets]
-            raise
-        with xr.merge(datasets, join='exact', 
-                      combine_attrs='no_conflicts') as ds:
-            logging.info(f"...succes!")
-            check_globals(ds)
-            ds = wind_shear(ds) # calculate wind shear
-            logging.info(f"storing interpolated data")
-            outfile = list(os.path.splitext(args.outfile))
-            outfile.insert(1,f'{year}')
-            ds.to_netcdf(''.join(outfile))
-            logging.info(f"SUCCES")
-            time1 = time.perf_counter()
-            logging.info(f"total script time: {time1-time0:.2f} seconds")
+    # wind shear per partition of years
+    files = [f for f in args.files if file_year(f) in YEAR_RANGE]
+    if len(files) == 0:
+        raise ValueError(f'no files in years {YEAR_RANGE}')
+    logging.info(f"output file: {os.path.abspath(args.outfile)}")
+    options = batch_options(args)
+    options['years'] = options['years'] or 1
+    run_partitions(files, args.outfile, process, **options)
+    logging.info(f"SUCCES")
+    time1 = time.perf_counter()
+    logging.info(f"total script time: {time1-time0:.2f} seconds")
 
 
 if __name__ == '__main__':
@@ -1,8 +1,95 @@
 #!/usr/bin/env python3
 # *_* coding: utf-8 *_*
 
+import numpy as np
 import xarray as xr
 
+# weights of the meridional dimension of each horizontal grid, zonal
+# dimensions are uniformly weighted
+AREA_WEIGHTS = {'lat': 'gw', 'slat': 'w_stag', 'ncol': 'area'}
+ZONAL_DIMS = ('lon', 'slon')
+
+
+def area_mean(ds:[xr.Dataset,xr.DataArray], weights:dict=None, dims=None, 
+              skipna:bool=True, keep_attrs:bool=True):
+    """Area weighted horizontal mean of all variables in a single pass
+    
+    Input:
+    ds : data to average, variables can be on different horizontal grids
+        (lat/lon, slat/lon, lat/slon, ncol)
+    weights : {dim(s): weights} of the meridional (or ncol) dimensions,
+        keys can be tuples for multidimensional weights, e.g. masked 
+        ('lat','lon') weights. Weights with attribute normalized=True are
+        used as is (see gridweights.py). Default: gw, w_stag and area 
+        from ds (see AREA_WEIGHTS), required for DataArrays
+    dims : iterable of dimensions to average over, dimensions without
+        weights are uniformly weighted (default: weighted and zonal dims)
+    skipna : ignore missing values, the weights are renormalised per
+        point in time/level. Use skipna=False for data without missing 
+        values, which saves a second contraction
+    keep_attrs : keep variable and dataset attributes
+    
+    The weights of every grid are normalised once and each variable is
+    reduced with a single xr.dot contraction over all its averaged
+    dimensions, instead of separate .weighted().mean() calls per grid
+    and dimension. For dask backed data all variables of a time chunk are 
+    thus reduced after reading the chunk once. Variables without averaged
+    dimensions are returned unchanged, weight variables and averaged
+    coordinates are dropped.
+    """
+    if isinstance(ds, xr.DataArray):
+        if weights is None:
+            raise ValueError('weights are required to average a DataArray')
+        name = ds.name if ds.name is not None else '__data__'
+        dsm = area_mean(ds.to_dataset(name=name), weights, dims, skipna, keep_attrs)
+        return dsm[name].rename(ds.name)
+    if weights is None:
+        weights = {dim: ds[w] for (dim, w) in AREA_WEIGHTS.items() 
+                   if (dim in ds.dims) and (w in ds.variables)}
+    weights = {((wdims,) if isinstance(wdims, str) else tuple(wdims)): w 
+               for (wdims, w) in weights.items()}
+    if dims is None:
+        dims = [dim for wdims in weights for dim in wdims]
+        dims += [dim for dim in ZONAL_DIMS if dim in ds.dims]
+    dims = [dim for dim in dims if dim in ds.dims]
+    
+    norm_weights = {}
+    for (wdims, w) in weights.items():
+        if not set(wdims).issubset(dims):
+            continue
+        w = w.reset_coords(drop=True).drop_vars(wdims, errors='ignore')
+        w = w.isel({d: 0 for d in w.dims if d not in wdims}) # time dependent copies
+        if not w.attrs.get('normalized', False):
+            w = (w / w.sum()).astype(w.dtype)
+        norm_weights[wdims] = w
+    uniform = {dim: xr.DataArray(np.full(ds.sizes[dim], 1/ds.sizes[dim]), dims=dim)
+               for dim in dims}
+    
+    drop = [w.name for w in weights.values() if w.name is not None] + dims
+    drop += [w for (dim, w) in AREA_WEIGHTS.items() if dim in dims]
+    dsm = {}
+    for (v, da) in ds.data_vars.items():
+        if v in drop:
+            continue
+        hdims = [dim for dim in da.dims if dim in dims]
+        if len(hdims) == 0:
+            dsm[v] = da
+            continue
+        ws = [w for (wdims, w) in norm_weights.items() if set(wdims).issubset(hdims)]
+        wdims = {dim for w in ws for dim in w.dims}
+        ws += [uniform[dim] for dim in hdims if dim not in wdims]
+        da = da.drop_vars(hdims, errors='ignore')
+        if skipna:
+            dam = (xr.dot(da.fillna(0), *ws, dim=hdims) 
+                   / xr.dot(da.notnull(), *ws, dim=hdims))
+        else:
+            dam = xr.dot(da, *ws, dim=hdims)
+        if keep_attrs:
+            dam.attrs = da.attrs
+        dsm[v] = dam
+    dsm = xr.Dataset(dsm, attrs=ds.attrs if keep_attrs else {})
+    return dsm.drop_vars([c for c in dsm.coords if c in drop], errors='ignore')
+
 
 def wmean(ds:[xr.Dataset,xr.DataArray], w:xr.DataArray, dims, **kwargs):
     """wrapper for xarray weighted mean
@@ -21,6 +108,8 @@ def wmean(ds:[xr.Dataset,xr.DataArray], w:xr.DataArray, dims, **kwargs):
             prevent broadcasting
         4) let function wmean determine keep_attrs per dataarray instead of 
             map() which applies one value to the whole dataset
+
+    Kept unchanged for existing notebooks, new code should use area_mean().
     """
     if isinstance(ds, xr.Dataset):
         global WMEAN_ATTRS
@@ -32,7 +121,6 @@ def wmean(ds:[xr.Dataset,xr.DataArray], w:xr.DataArray, dims, **kwargs):
         return dsm
     if 'WMEAN_ATTRS' in globals():
         WMEAN_ATTRS[ds.name] = ds.attrs
-    #avgdims = tuple(set(ds.dims).intersection(dims)) # 1
     coordattrs = {c:ds[c].attrs for c in ds.coords}
     avgdims = [dim for dim in dims if (dim in ds.dims) and not (dim in w.dims)]
     for dim in avgdims:
@@ -40,17 +128,145 @@ def wmean(ds:[xr.Dataset,xr.DataArray], w:xr.DataArray, dims, **kwargs):
     avgdims = [dim for dim in dims if (dim in ds.dims) and (dim in w.dims)]
     for dim in avgdims:
         ds = ds.weighted(w).mean(avgdims, **kwargs)
-    # if len(avgdims)==0: # 1
-    #     print(f'{dims=} not in {ds.dims=}')
-    #     print(set(ds.dims),dims,set(ds.dims).intersection(dims))
-    #     return ds
-    # coordattrs = {c:ds[c].attrs for c in ds.coords}
-    # if set(w.dims).issubset(ds.dims):
-    #     print('taking weighted mean')
-    #     dsm = ds.weighted(w).mean(avgdims, **kwargs)
-    # else: # 3
-    #     print('taking unweighted mean')
-    #     dsm = ds.mean(avgdims, **kwargs)
     for c in ds.coords:
         ds[c].attrs.update(coordattrs[c]) # 2
-    return ds
\ No newline at end of file
+    return ds
+
+
+def legendre_moments(ds:xr.Dataset, degrees=(0, 1, 2), variables=None, weights=None,
+                     skipna:bool=True, keep_attrs:bool=True):
+    """Area weighted projections onto Legendre polynomials of sin(lat)
+    
+    Input:
+    ds : dataset on a lat/lon or ncol grid, with lat (coordinate or, for
+        ncol, variable) and weights gw or area (see AREA_WEIGHTS)
+    degrees : degrees n of the polynomials P_n(sin(lat)), e.g. (0, 1, 2)
+        for global mean T0, interhemispheric gradient T1 and equator-pole
+        gradient T2 as in GLENS
+    variables : variables to project (default: all on the horizontal grid)
+    weights : cell weights on lat or ncol (default: gw or area of ds)
+    skipna : ignore missing values, the weights are renormalised per
+        point in time/level
+    keep_attrs : keep variable attributes
+    
+    Returns the area weighted means of variable*P_n with a new dimension
+    degree. All moments of a variable are computed in one xr.dot 
+    contraction with a (degree x lat) or (degree x ncol) matrix of
+    normalised weights, so each chunk of data is read once and no
+    weighted copies of the field are made.
+    """
+    hdims = ('ncol',) if 'ncol' in ds.dims else ('lat', 'lon')
+    wdim = hdims[0]
+    if weights is None:
+        weights = ds[AREA_WEIGHTS[wdim]]
+    weights = weights.reset_coords(drop=True).drop_vars(wdim, errors='ignore')
+    weights = weights.isel({d: 0 for d in weights.dims if d != wdim}) # time dependent copies
+    weights = weights / weights.sum()
+    mu = np.sin(np.deg2rad(ds['lat'].reset_coords(drop=True).drop_vars(wdim, errors='ignore')))
+    mu = mu.isel({d: 0 for d in mu.dims if d != wdim})
+    degrees = list(degrees)
+    basis = xr.DataArray(
+        np.stack([np.polynomial.legendre.legval(mu.values, np.eye(n+1)[n]) for n in degrees]),
+        dims=('degree', wdim), coords={'degree': degrees})
+    matrix = basis * weights
+    ws = [xr.DataArray(np.full(ds.sizes[dim], 1/ds.sizes[dim]), dims=dim) for dim in hdims[1:]]
+    if variables is None:
+        variables = [v for v in ds.data_vars if set(hdims).issubset(ds[v].dims)
+                     and v not in AREA_WEIGHTS.values() and v != 'lat']
+    dsm = {}
+    for v in variables:
+        da = ds[v].drop_vars(hdims, errors='ignore')
+        if skipna:
+            dam = (xr.dot(da.fillna(0), matrix, *ws, dim=hdims)
+                   / xr.dot(da.notnull(), weights, *ws, dim=hdims))
+        else:
+            dam = xr.dot(da, matrix, *ws, dim=hdims)
+        if keep_attrs:
+            dam.attrs = da.attrs
+        dsm[v] = dam
+    return xr.Dataset(dsm).transpose(..., 'degree')
+
+
+MONTHS = 'JFMAMJJASOND' # initials of the months, seasons are substrings
+
+
+def season_months(period:str='year'):
+    """Return months (1-12) of 'year' or a season, e.g. 'JJASON' or 'DJF'"""
+    if period == 'year':
+        return list(range(1, 13))
+    start = (2*MONTHS).find(period)
+    if (start < 0) or (len(period) > 12):
+        raise ValueError(f"unknown period {period}, use 'year' or consecutive month initials")
+    return [(start+i) % 12 + 1 for i in range(len(period))]
+
+
+def resample_mean(ds:xr.Dataset, period:str='year', bounds:str=None, 
+                  skipna:bool=True, keep_attrs:bool=True):
+    """Time weighted annual or seasonal means of all variables in a single pass
+    
+    Input:
+    ds : dataset with time bounds, e.g. monthly CESM output
+    period : 'year' or a season of consecutive month initials, e.g. 'JJA',
+        'JJASON' (TC season) or 'DJF', seasons crossing the end of the 
+        year are labeled by the year of their last month
+    bounds : name of the time bounds (default: from time attributes)
+    skipna : ignore missing values, the weights are renormalised per
+        point in space
+    keep_attrs : keep variable and dataset attributes
+    
+    Each time step is weighted by its length from the time bounds, which
+    gives month lengths of the model calendar (e.g. noleap). Only complete
+    periods (all months present) are returned. The time steps of each 
+    period are averaged with one xr.dot contraction over a (period x time)
+    weight matrix, which stays lazy for dask arrays. The bounds of the
+    result span the averaged steps and time is set to their center, the
+    label year is added as coordinate 'year'.
+    """
+    if bounds is None:
+        bounds = ds.time.attrs.get('bounds', ds.time.encoding.get('bounds'))
+    tbnds = ds[bounds].reset_coords(drop=True).load() # small
+    bdim = [dim for dim in tbnds.dims if dim != 'time'][0]
+    lower, upper = tbnds.isel({bdim: 0}).values, tbnds.isel({bdim: 1}).values
+    length = ((tbnds.isel({bdim: 1}) - tbnds.isel({bdim: 0})) / np.timedelta64(1, 'D')).values
+    center = xr.DataArray(lower + (upper - lower) / 2, dims='time')
+    month, year = center.dt.month.values, center.dt.year.values
+    
+    # label years of the periods, periods with all months present
+    months = season_months(period)
+    member = np.isin(month, months)
+    label = year + ((months[0] > months[-1]) & (month >= months[0])) # crossing years
+    labels = [y for y in np.unique(label[member])
+              if set(month[member & (label == y)]) == set(months)]
+    weights = np.zeros((len(labels), ds.sizes['time']))
+    for (i, y) in enumerate(labels):
+        steps = member & (label == y)
+        weights[i, steps] = length[steps] / length[steps].sum()
+    weights = xr.DataArray(weights, dims=('period', 'time'))
+    new_lower = np.array([lower[member & (label == y)].min() for y in labels])
+    new_upper = np.array([upper[member & (label == y)].max() for y in labels])
+    
+    dsm = {}
+    for (v, da) in ds.data_vars.items():
+        if v == bounds:
+            continue
+        if 'time' not in da.dims:
+            dsm[v] = da
+            continue
+        da = da.reset_coords(drop=True).drop_vars('time', errors='ignore')
+        if skipna:
+            dam = (xr.dot(da.fillna(0), weights, dim='time') 
+                   / xr.dot(da.notnull(), weights, dim='time'))
+        else:
+            dam = xr.dot(da, weights, dim='time')
+        dam = dam.transpose('period', ...)
+        if keep_attrs:
+            dam.attrs = da.attrs
+        dsm[v] = dam
+    dsm = xr.Dataset(dsm, attrs=ds.attrs if keep_attrs else {}).rename({'period': 'time'})
+    dsm = dsm.assign_coords(
+        time=('time', new_lower + (new_upper - new_lower) / 2, ds.time.attrs),
+        year=('time', np.array(labels), {'long_name': f'{period} of year'}))
+    dsm[bounds] = (('time', bdim), np.stack([new_lower, new_upper], axis=1), tbnds.attrs)
+    dsm.time.encoding = {k: v for (k, v) in ds.time.encoding.items() 
+                         if k in ('units', 'calendar', 'dtype')}
+    return dsm
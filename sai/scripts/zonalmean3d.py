@@ -0,0 +1,199 @@
+#!/usr/bin/env python3
+# *_* coding: utf-8 *_*
+
+"""Zonal means of 3D variables on pressure levels
+
+Run with >> python zonalmean3d.py [-v,--verbose] files outfile [--plev ...] [--format zarr]
+
+Variables on model levels are interpolated linearly in ln(p) to pressure
+levels and averaged over longitude in a single fused pass: the sum and
+count of every (time, plev, lat) point are accumulated in place while
+interpolating each column, the (plev, lon) field is never stored.
+Missing values (levels below the surface or above the model top) are
+left out of the mean. The bracketing levels and weights are computed
+once per block (see vertinterp.py) and shared by all variables.
+
+Chunks may be along time and lat, the vertical and longitude dimensions
+are kept whole.
+"""
+
+import os
+import argparse
+import logging
+from time import perf_counter
+
+import numpy as np
+import xarray as xr
+from numba import njit
+
+from vertinterp import PLEVS, PLEV_ATTRS, VDIM, _hybrid_weights, _pressure_weights
+
+XDIM = 'lon' # longitudinal dimension (will be averaged over)
+CHUNKS = {'time': 1} # chunks of input data, leave VDIM and XDIM whole
+
+
+@njit(cache=True)
+def _zonal_mean(f, k, w, out):
+    """Zonal mean of f (nt, ny, nlev, nlon) interpolated with k, w (nt, ny, npi, nlon)
+
+    out: (nt, ny, npi), f can have any memory layout
+    """
+    nt, ny, npi, nlon = k.shape
+    for t in range(nt):
+        for y in range(ny):
+            for i in range(npi):
+                total, count = 0.0, 0
+                for x in range(nlon):
+                    k0 = k[t, y, i, x]
+                    if k0 < 0:
+                        continue
+                    value = f[t, y, k0, x] + w[t, y, i, x] * (f[t, y, k0+1, x] - f[t, y, k0, x])
+                    if not np.isnan(value):
+                        total += value
+                        count += 1
+                out[t, y, i] = total / count if count > 0 else np.nan
+
+
+def _rows(a, ncore):
+    """View a (*outer, *core) with at most 2 outer dims as (n1, n2, *core)"""
+    outer = a.shape[:a.ndim-ncore]
+    assert len(outer) <= 2, 'merging outer dims could copy, loop over them instead'
+    return a.reshape((1,) * (2-len(outer)) + a.shape) # adds axes only, never copies
+
+
+def zonalmean3d(ds, plev, ps=None, hyam=None, hybm=None, p0=None, pres=None,
+                vdim:str=VDIM, xdim:str=XDIM):
+    """Interpolate variables to pressure levels and take the zonal mean
+
+    Input:
+    ds : dataset with 3D variables (..., vdim, ..., xdim)
+    plev : target pressure levels (hPa)
+    ps, hyam, hybm, p0 : surface pressure (Pa), hybrid coefficients and
+        reference pressure (Pa), used if pres is not given
+    pres : 3D air pressure (Pa)
+    vdim, xdim : vertical and zonal dimension
+
+    Returns dataset of zonal means (..., plev, ...) of all variables with
+    vdim and xdim on the grid of the pressure.
+    """
+    pdims = ps.dims if pres is None else pres.dims
+    variables = [v for v in ds.data_vars if {vdim, xdim}.issubset(ds[v].dims)
+                 and set(ds[v].dims) - {vdim} <= set(pdims)]
+    if len(variables) == 0:
+        raise ValueError(f'no variables with {vdim} and {xdim} on the pressure grid {pdims}')
+    plev = xr.DataArray(np.asarray(plev, dtype='float64'), dims='plev', name='plev',
+                        attrs=PLEV_ATTRS)
+    pi = 100 * plev.values
+    logpi = np.log(pi)
+    # outer dims (e.g. time) and inner dims (e.g. lat) of the block
+    dims = ds[variables[0]].dims
+    inner = [dim for dim in dims if dim not in (vdim, xdim)]
+    fs = [ds[v].transpose(*inner, vdim, xdim) for v in variables]
+    fs = [f.chunk({vdim: -1, xdim: -1}) if f.chunks is not None else f for f in fs]
+
+    def _kernel(p, *fs):
+        shape = fs[0].shape[:-2] # (*inner)
+        nlev, nlon = fs[0].shape[-2:]
+        p = np.broadcast_to(p, (*shape, nlon) if pres is None else fs[0].shape)
+        outs = [np.empty((*shape, pi.size), dtype=f.dtype) for f in fs]
+        # the (transposed) blocks are passed as views, leading dims beyond
+        # two are looped over since merging them could copy
+        for lead in np.ndindex(*shape[:-2]):
+            f4s = [_rows(f[lead], 2) for f in fs]
+            nt, ny = f4s[0].shape[:2]
+            # bracketing levels and weights, shared by all variables
+            k = np.empty((nt*ny, pi.size, nlon), dtype=np.int32)
+            w = np.empty(k.shape, dtype='float64')
+            if pres is None:
+                ps2 = p[lead].astype('float64').reshape(nt*ny, nlon)
+                _hybrid_weights(hyam_, hybm_, p0_, ps2, pi, logpi, k, w)
+            else:
+                p3 = p[lead].astype('float64').reshape(nt*ny, nlev, nlon)
+                _pressure_weights(p3, pi, logpi, k, w)
+            k, w = k.reshape(nt, ny, pi.size, nlon), w.reshape(nt, ny, pi.size, nlon)
+            for (f4, out) in zip(f4s, outs):
+                _zonal_mean(f4, k, w, _rows(out[lead], 1))
+        return tuple(outs) if len(outs) > 1 else outs[0]
+
+    if pres is None:
+        hyam_, hybm_ = [c.isel({d: 0 for d in c.dims if d != vdim}).values.astype('float64')
+                        for c in (hyam, hybm)]
+        p0_ = float(np.ravel(p0)[0])
+        p = ps.transpose(*[d for d in inner if d in ps.dims], xdim)
+        if p.chunks is not None:
+            p = p.chunk({xdim: -1})
+        pcore = [xdim]
+    else:
+        p = pres.transpose(*[d for d in inner if d in pres.dims], vdim, xdim)
+        if p.chunks is not None:
+            p = p.chunk({vdim: -1, xdim: -1})
+        pcore = [vdim, xdim]
+    outs = xr.apply_ufunc(
+        _kernel, p, *fs,
+        input_core_dims=[pcore] + [[vdim, xdim]] * len(fs),
+        output_core_dims=[['plev']] * len(fs),
+        exclude_dims={vdim},
+        dask='parallelized',
+        output_dtypes=[f.dtype for f in fs],
+        dask_gufunc_kwargs={'output_sizes': {'plev': plev.size}},
+    )
+    outs = outs if isinstance(outs, tuple) else (outs,)
+    dsz = xr.Dataset({v: out.assign_attrs(ds[v].attrs) for (v, out) in zip(variables, outs)})
+    dsz = dsz.assign_coords(plev=plev)
+    return dsz.transpose(*[d for d in dims if d not in (vdim, xdim)][:1], 'plev', ...)
+
+
+def main():
+    from output import add_output_arguments, check_outfile, write_output
+    time0 = perf_counter()  # start timer
+
+    # parse command line arguments
+    parser = argparse.ArgumentParser(
+        description='Zonal means of 3D variables on pressure levels')
+    parser.add_argument('files', nargs='+', help='input file(s)')
+    parser.add_argument('outfile', help='output file')
+    add_output_arguments(parser)
+    parser.add_argument('--plev', nargs='+', type=float, default=PLEVS,
+                        help=f'pressure levels in hPa (default: {PLEVS})')
+    parser.add_argument('--variables', nargs='+',
+                        help='3D variables to average (default: all)')
+    parser.add_argument('-v', '--verbose', help='modify output verbosity',
+                        action='store_true')
+    args = parser.parse_args()
+    check_outfile(args)
+
+    # set up logger
+    logging.basicConfig(
+        level=logging.INFO if args.verbose else logging.WARNING,
+        format="%(asctime)s %(levelname)s: %(message)s",
+        datefmt="%d-%m-%Y %H:%M:%S"
+    )
+    logging.info(
+        f"read path: {os.path.dirname(os.path.abspath(args.files[0]))}:"
+        "\ninput file(s):"
+        f"\n{os.linesep.join([os.path.basename(f) for f in args.files])}"
+    )
+
+    from load_SAIdata import open_mfdataset
+    variables = args.variables
+    if (variables is not None) and ('P' not in variables):
+        variables = variables + ['PS'] # surface pressure for hybrid levels
+    logging.info(f"opening files with chunks {CHUNKS}")
+    ds = open_mfdataset(args.files, verbose=args.verbose, variables=variables, chunks=CHUNKS)
+    logging.info(f"zonal mean at {args.plev} hPa")
+    if 'P' in ds:
+        dsz = zonalmean3d(ds.drop_vars('P'), args.plev, pres=ds.P)
+    else:
+        dsz = zonalmean3d(ds.drop_vars('PS'), args.plev, ps=ds.PS, hyam=ds.hyam,
+                          hybm=ds.hybm, p0=ds.P0)
+    for v in ['gw', 'time_bnds']:
+        if v in ds:
+            dsz[v] = ds[v]
+    dsz.attrs.update({'history':
+        f'python zonalmean3d.py [{args.files[0]} - {args.files[-1]}] {args.outfile}'})
+    write_output(dsz, args.outfile, args.output_format, args.append)
+    logging.info(f"created {args.outfile} in {perf_counter()-time0:.2f} seconds")
+
+
+if __name__ == '__main__':
+    main()